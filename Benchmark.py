@@ -0,0 +1,710 @@
+'''
+Benchmarks for the P2P file sharing system.
+Each benchmark runs on the loopback interface and prints a small table, for example:
+
+    python Benchmark.py seeder --connections 500 --chunks 20
+
+seeder    - holds many leecher sessions open against the threaded and the event loop seeder servers
+download  - downloads one file from several seeders, one of them slowed down, with every chunk scheduler,
+            with and without the endgame
+tracker   - file requests and heartbeats against a tracker holding many registered files, and requests for one
+            popular file with and without the response cache
+soak      - days of simulated seeder churn and leecher traffic against one tracker, sampling its memory
+load      - file requests per second over UDP against the tracker with different numbers of worker processes
+restart   - how long the tracker takes to restore its registrations from a snapshot and journal when it starts
+library   - scans of a seeder's published folder: the first one, after a restart and while polling for changes
+upload    - one leecher pipelining far more requests than the others against a seeder with and without an upload limit
+'''
+
+import argparse
+import asyncio
+import base64
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import Leecher
+import Protocol
+import Scheduler
+import Seeder
+import Tracker
+
+try:
+    import resource  # Not available on Windows, where server usage is not reported
+except ImportError:
+    resource = None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def quiet(message):
+    pass
+
+
+'''
+Seeder load benchmark.
+The server runs in a child process so its CPU time, peak memory and peak thread count can be measured on their own.
+The load generator is a single asyncio loop that first opens every connection, then has all of them request their chunks at once.
+'''
+def run_seeder_server(mode, port, folder, conn):
+    os.chdir(folder)
+    threading.Thread(target=Seeder.serve, args=("127.0.0.1", port, mode, quiet), daemon=True).start()
+    peak_threads = [threading.active_count()]
+
+    def sample_threads():
+        while True:
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.01)
+
+    threading.Thread(target=sample_threads, daemon=True).start()
+    conn.send("ready")
+    conn.recv()  # The parent asks for the report once the load is done
+    usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    conn.send({
+        "threads": peak_threads[0],
+        "cpu": usage.ru_utime + usage.ru_stime if usage else None,
+        "maxrss_mb": usage.ru_maxrss / 1024 if usage else None,  # ru_maxrss is in KiB on Linux
+    })
+
+
+async def seeder_load(port, file_name, connections, chunks, piece_size):
+    all_connected = asyncio.Event()
+    connected = [0]
+    failures = [0]
+
+    async def leecher():
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 60)
+        except (OSError, asyncio.TimeoutError):
+            failures[0] += 1
+            connected[0] += 1
+            if connected[0] == connections:
+                all_connected.set()
+            return 0
+        connected[0] += 1
+        if connected[0] == connections:
+            all_connected.set()
+        await all_connected.wait()
+
+        received = 0
+        try:
+            requests = b"".join(f"REQUEST {file_name} {chunk_id} {piece_size}\n".encode() for chunk_id in range(chunks))
+            writer.write(Seeder.SESSION_HELLO + requests)
+            await writer.drain()
+            await reader.readline()  # SESSION OK
+            for _ in range(chunks):
+                header = (await reader.readline()).split()
+                received += len(await reader.readexactly(int(header[2])))
+            writer.write(b"BYE\n")
+        except (OSError, IndexError, ValueError, asyncio.IncompleteReadError):
+            failures[0] += 1
+        writer.close()
+        return received
+
+    started = time.perf_counter()
+    received = await asyncio.gather(*(leecher() for _ in range(connections)))
+    return time.perf_counter() - started, sum(received), failures[0]
+
+
+def bench_seeder(args):
+    folder = tempfile.mkdtemp()
+    file_name = "bench.bin"
+    with open(os.path.join(folder, file_name), "wb") as f:
+        f.write(os.urandom(args.chunks * args.piece_size))
+
+    print(f"{args.connections} concurrent sessions x {args.chunks} chunks of {args.piece_size} bytes")
+    print(f"{'mode':<10} {'seconds':>8} {'MB/s':>8} {'failed':>7} {'threads':>8} {'cpu s':>7} {'rss MB':>7}")
+    for mode in args.modes:
+        port = free_port()
+        parent, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=run_seeder_server, args=(mode, port, folder, child), daemon=True)
+        server.start()
+        parent.recv()
+        time.sleep(0.2)  # Let the server reach accept()
+
+        seconds, received, failures = asyncio.run(seeder_load(port, file_name, args.connections, args.chunks, args.piece_size))
+        parent.send("report")
+        report = parent.recv()
+        server.terminate()
+
+        cpu = f"{report['cpu']:.2f}" if report["cpu"] is not None else "-"
+        rss = f"{report['maxrss_mb']:.1f}" if report["maxrss_mb"] is not None else "-"
+        print(f"{mode:<10} {seconds:>8.2f} {received / seconds / 1e6:>8.2f} {failures:>7} "
+              f"{report['threads']:>8} {cpu:>7} {rss:>7}")
+
+
+'''
+Download benchmark.
+Every seeder runs in its own child process; the first --slow seeders sleep --delay seconds before sending each chunk,
+standing in for an overloaded or distant peer. The same file is then downloaded once with every scheduler and
+endgame setting; "tail saved" is the engine's own estimate of how much later the download would have finished
+without the duplicate requests.
+'''
+def run_download_seeder(port, folder, delay, conn):
+    os.chdir(folder)
+    if delay:
+        send_chunk = Seeder.sendChunk
+
+        def slow_send(sock, chunk, *args):
+            time.sleep(delay)
+            return send_chunk(sock, chunk, *args)
+
+        Seeder.sendChunk = slow_send
+    threading.Thread(target=Seeder.serve, args=("127.0.0.1", port, "threaded", quiet), daemon=True).start()
+    conn.send("ready")
+    conn.recv()  # Runs until the parent terminates it
+
+
+def bench_download(args):
+    folder = tempfile.mkdtemp()
+    file_name = "bench.bin"
+    with open(os.path.join(folder, file_name), "wb") as f:
+        f.write(os.urandom(args.chunks * args.piece_size))
+
+    seeders, servers = [], []
+    for index in range(args.seeders):
+        port = free_port()
+        parent, child = multiprocessing.Pipe()
+        delay = args.delay if index < args.slow else 0
+        server = multiprocessing.Process(target=run_download_seeder, args=(port, folder, delay, child), daemon=True)
+        server.start()
+        parent.recv()
+        seeders.append(f"127.0.0.1,{port}")
+        servers.append(server)
+    time.sleep(0.2)  # Let the servers reach accept()
+
+    print(f"{args.chunks} chunks of {args.piece_size} bytes from {args.seeders} seeders, "
+          f"{args.slow} of them {args.delay * 1000:.0f} ms slower per chunk")
+    print(f"{'scheduler':<11} {'endgame':>7} {'seconds':>8} {'MB/s':>8} {'failed':>7} {'stolen':>7} {'dups':>5} "
+          f"{'won':>4} {'tail saved':>10}  chunks per seeder (slow first)")
+    try:
+        for name in args.schedulers:
+            for endgame in args.endgame:
+                engine = Leecher.DownloadEngine(file_name, seeders, args.piece_size, log=quiet, scheduler=name,
+                                                endgame=endgame)
+                started = time.perf_counter()
+                results = engine.run(range(args.chunks))
+                seconds = time.perf_counter() - started
+
+                received = sum(result.size for result in results.values())
+                failed = sum(not result.ok for result in results.values())
+                per_seeder = [sum(result.ok and result.seeder == seeder for result in results.values()) for seeder in seeders]
+                stats = engine.endgame_stats()
+                print(f"{name:<11} {endgame:>7} {seconds:>8.2f} {received / seconds / 1e6:>8.2f} {failed:>7} "
+                      f"{engine.scheduler.stolen:>7} {stats['duplicates']:>5} {stats['duplicate_wins']:>4} "
+                      f"{stats['tail_saved']:>9.3f}s  {' '.join(str(count) for count in per_seeder)}")
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+'''
+Tracker benchmark.
+The tracker's message handler is called directly, without sockets, so only its own lookups are measured. The indexed
+lookups are compared with a full scan over every seeder and file, which is how the tracker used to find them, and an
+expiry check with no seeder due is compared with a sweep that looks at every seeder's last heartbeat.
+'''
+def scan_file(file_name):
+    return [(seeder_info, file_info) for seeder_info in Tracker.seeders.values()
+            for file_info in seeder_info.files.values() if file_info.file_name == file_name]
+
+
+def scan_address(ip, port):
+    return next((seeder_id for seeder_id, data in Tracker.seeders.items() if data.ip == ip and data.port == port), None)
+
+
+def scan_expired(current_time):
+    return [seeder_id for seeder_id, data in Tracker.seeders.items() if current_time - data.last_seen > Tracker.SEEDER_TIMEOUT]
+
+
+def per_op(run, operations):
+    started = time.perf_counter()
+    for operation in operations:
+        run(operation)
+    return (time.perf_counter() - started) / len(operations) * 1e6
+
+
+def bench_tracker(args):
+    Tracker.log = quiet
+    address = ("127.0.0.1", 0)
+    seeders = max(1, args.files // args.files_per_seeder)
+    ports = [str(10000 + index) for index in range(seeders)]
+
+    started = time.perf_counter()
+    for index, port in enumerate(ports):
+        files = ",".join(f"file{index * args.files_per_seeder + offset}.bin:{1 << 20}"
+                         for offset in range(args.files_per_seeder))
+        Tracker.handle_message(f"REGISTER_FILES 127.0.0.1 {port} {files}".encode(), address)
+    register = (time.perf_counter() - started) / seeders * 1e6
+
+    names = [f"file{random.randrange(seeders * args.files_per_seeder)}.bin" for _ in range(args.lookups)]
+    targets = [random.choice(ports) for _ in range(args.lookups)]
+    scans = max(1, args.lookups // 100)
+
+    print(f"{seeders} seeders x {args.files_per_seeder} files = {seeders * args.files_per_seeder} registered files")
+    print(f"{'operation':<22} {'indexed us':>11} {'full scan us':>13}")
+    print(f"{'REGISTER_FILES':<22} {register:>11.1f} {'-':>13}")
+    request = per_op(lambda name: Tracker.handle_message(f"REQUEST {name} V2".encode(), address), names)
+    print(f"{'REQUEST lookup':<22} {request:>11.1f} {per_op(scan_file, names[:scans]):>13.1f}")
+    binary = per_op(lambda name: Tracker.handle_message(Protocol.pack_lookup(1, name), address), names)
+    print(f"{'binary LOOKUP':<22} {binary:>11.1f} {'-':>13}")
+    batches = Protocol.batch_entries(names, Protocol.BATCH_BYTES - Protocol.HEADER.size - Protocol.COUNT.size)
+    answered = 0
+    started = time.perf_counter()
+    for batch in batches:
+        _, _, body = Protocol.unpack_header(Tracker.handle_message(Protocol.pack_lookup_many(1, batch), address))
+        answered += Protocol.COUNT.unpack_from(body)[0]
+    many = (time.perf_counter() - started) / len(names) * 1e6
+    print(f"{'LOOKUP_MANY per file':<22} {many:>11.1f} {'-':>13}  ({len(names)} files, {answered} answered, "
+          f"in {len(batches)} datagrams)")
+    heartbeat = per_op(lambda port: Tracker.handle_message(f"HEARTBEAT 127.0.0.1 {port}".encode(), address), targets)
+    print(f"{'HEARTBEAT lookup':<22} {heartbeat:>11.1f} "
+          f"{per_op(lambda port: scan_address('127.0.0.1', port), targets[:scans]):>13.1f}")
+    checks = [int(time.time())] * scans
+    print(f"{'expiry check':<22} {per_op(lambda now: Tracker.expire_inactive(), checks):>11.1f} "
+          f"{per_op(scan_expired, checks):>13.1f}")
+
+    # A seeder with a large library, announced over as many datagrams as it takes
+    library = [f"library{index}.bin:{1 << 20}:{bytes(32).hex()}" for index in range(args.library)]
+    batches = Protocol.batch_entries(library, Protocol.BATCH_BYTES - len("REGISTER_MORE 127.0.2.1 30000 "))
+    started = time.perf_counter()
+    for index, batch in enumerate(batches):
+        command = "REGISTER_FILES" if index == 0 else "REGISTER_MORE"
+        Tracker.handle_message(f"{command} 127.0.2.1 30000 {','.join(batch)}".encode(), address)
+    announce = (time.perf_counter() - started) / len(library) * 1e6
+    print(f"bulk announce of {len(library)} files in {len(batches)} datagrams: {announce:.1f} us per file")
+
+    # One more file for that seeder, as a numbered change and as a full announce of its library
+    changes = [f"ADD 127.0.2.1 30000 {version} extra{version}.bin:{1 << 20}".encode() for version in range(1, 1001)]
+    delta = per_op(lambda message: Tracker.handle_message(message, address), changes)
+    print(f"one more file for it: {delta:.1f} us as an ADD, {announce * len(library):.0f} us announcing every file again")
+
+    # A popular file held by many seeders, answered from the response cache and rebuilt every time
+    for index in range(args.hot_seeders):
+        Tracker.handle_message(f"REGISTER_FILES 127.0.1.1 {20000 + index} hot.bin:{1 << 30}".encode(), address)
+    hot = [b"REQUEST hot.bin V2"] * args.lookups
+    cached = per_op(lambda message: Tracker.handle_message(message, address), hot)
+    stats = Tracker.handle_message(b"STATS", address).decode()
+    cache_size, Tracker.RESPONSE_CACHE_BYTES = Tracker.RESPONSE_CACHE_BYTES, 0
+    Tracker.invalidate("hot.bin")
+    rebuilt = per_op(lambda message: Tracker.handle_message(message, address), hot)
+    Tracker.RESPONSE_CACHE_BYTES = cache_size
+    print(f"hot file with {args.hot_seeders} seeders: {cached:.1f} us cached, {rebuilt:.1f} us rebuilt every time")
+    print(stats)
+
+
+'''
+Tracker soak benchmark.
+The tracker's clock is replaced with a simulated one, so --days of traffic run in a few minutes. Every 30 simulated seconds
+each live seeder sends a heartbeat, a few seeders leave without a word and new ones register in their place, and
+--requests leechers ask for a file from a new address each. Half of those leechers report pieces they hold, and most
+of them never report that they finished. The tracker's memory (as traced by tracemalloc) should stay flat.
+'''
+class SimulatedClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+def bench_soak(args):
+    Tracker.log = quiet
+    clock = Tracker.time = SimulatedClock()
+    tick, files = 30, 50
+    piece_count = Protocol.total_pieces(1 << 20, Protocol.piece_size_for(1 << 20))
+    tracker = ("127.0.0.1", 0)
+    live, next_port, next_leecher = [], 10000, 0
+
+    def register():
+        nonlocal next_port
+        port = str(next_port)
+        next_port += 1
+        shared = ",".join(f"file{random.randrange(files)}.bin:{1 << 20}" for _ in range(5))
+        Tracker.handle_message(f"REGISTER_FILES 127.0.0.1 {port} {shared}".encode(), tracker)
+        live.append(port)
+
+    for _ in range(args.seeders):
+        register()
+
+    tracemalloc.start()
+    print(f"{args.days} simulated days, {args.seeders} seeders, {args.requests} leecher requests every {tick} s")
+    print(f"{'day':>5} {'messages':>10} {'seeders':>8} {'leechers':>9} {'holders':>8} {'timers':>7} {'traced MB':>10}")
+    messages, started = 0, time.perf_counter()
+    ticks_per_day = 86400 // tick
+    for step in range(1, int(args.days * ticks_per_day) + 1):
+        clock.now += tick
+        for port in live:
+            Tracker.handle_message(f"HEARTBEAT 127.0.0.1 {port}".encode(), tracker)
+        # Churn: a seeder that leaves stops sending heartbeats and is replaced by a new one
+        for _ in range(max(1, args.seeders // 100)):
+            live.pop(random.randrange(len(live)))
+            register()
+        for _ in range(args.requests):
+            address = (f"10.{next_leecher >> 16 & 255}.{next_leecher >> 8 & 255}.{next_leecher & 255}", 40000 + next_leecher % 20000)
+            next_leecher += 1
+            file_name = f"file{random.randrange(files)}.bin"
+            Tracker.handle_message(f"REQUEST {file_name} V2".encode(), address)
+            if random.random() < 0.5:
+                pieces = bytes(random.getrandbits(8) for _ in range(-(-piece_count // 8)))
+                report = "DONE" if random.random() < 0.2 else base64.b64encode(pieces).decode()
+                Tracker.handle_message(f"HAVE {address[0]} {address[1]} {file_name} {Protocol.MIN_PIECE_SIZE} {report}".encode(), tracker)
+                messages += 1
+        messages += len(live) + args.requests
+        Tracker.expire_inactive()
+
+        if step % ticks_per_day == 0 or step == 1:
+            holders = sum(len(entry["Holders"]) for entry in Tracker.partial_holders.values())
+            print(f"{step * tick / 86400:>5.1f} {messages:>10} {len(Tracker.seeders):>8} {len(Tracker.leechers):>9} "
+                  f"{holders:>8} {len(Tracker.expiry_heap):>7} {tracemalloc.get_traced_memory()[0] / 1e6:>10.2f}")
+    print(f"{time.perf_counter() - started:.1f} s, peak traced {tracemalloc.get_traced_memory()[1] / 1e6:.2f} MB")
+
+
+'''
+Tracker load benchmark.
+The tracker runs in a child process, either as the single-process loop or with --workers processes sharing the port.
+Every client process keeps one request in flight on each of its --sockets sockets (the kernel spreads the sockets,
+not the datagrams, across SO_REUSEPORT workers), and a --writes share of the messages are heartbeats, which go
+through the owner process. Lost datagrams are sent again after a short timeout.
+'''
+def run_tracker(port, workers):
+    Tracker.log = quiet
+    if workers > 1:
+        Tracker.serve_workers("127.0.0.1", port, workers)
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", port))
+    Tracker.serve(sock)
+
+
+def tracker_client(port, sockets, seconds, files, seeders, writes, conn):
+    selector = selectors.DefaultSelector()
+    sent_at = {}
+    for _ in range(sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        sent_at[sock] = 0
+
+    def send(sock):
+        if random.random() < writes:
+            message = f"HEARTBEAT 127.0.0.1 {10000 + random.randrange(seeders)}"
+        else:
+            message = f"REQUEST file{random.randrange(files)}.bin V2"
+        sock.sendto(message.encode(), ("127.0.0.1", port))
+        sent_at[sock] = time.monotonic()
+
+    conn.recv()  # Every client starts at the same time
+    answered, deadline = 0, time.monotonic() + seconds
+    for sock in sent_at:
+        send(sock)
+    while time.monotonic() < deadline:
+        for key, events in selector.select(0.05):
+            try:
+                key.fileobj.recv(65535)
+            except OSError:
+                continue
+            answered += 1
+            send(key.fileobj)
+        for sock, when in sent_at.items():
+            if time.monotonic() - when > 0.2:
+                send(sock)  # The request or its answer was lost
+    conn.send(answered)
+
+
+def bench_load(args):
+    print(f"{args.clients} client processes x {args.sockets} sockets for {args.seconds} s each run, "
+          f"{args.writes:.0%} heartbeats, {os.cpu_count()} CPUs")
+    print(f"{'workers':>7} {'messages/s':>11} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        port = free_port()
+        tracker = multiprocessing.Process(target=run_tracker, args=(port, workers))
+        tracker.start()
+        time.sleep(0.5)  # Let the tracker bind its port
+
+        setup = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        setup.settimeout(2)
+        for index in range(args.seeders):
+            shared = ",".join(f"file{(index * 10 + offset) % args.files}.bin:{1 << 20}" for offset in range(10))
+            setup.sendto(f"REGISTER_FILES 127.0.0.1 {10000 + index} {shared}".encode(), ("127.0.0.1", port))
+            setup.recv(65535)
+        time.sleep(Tracker.BATCH_INTERVAL * 2)  # Let the registrations reach every worker
+
+        pipes, clients = [], []
+        for _ in range(args.clients):
+            parent, child = multiprocessing.Pipe()
+            client = multiprocessing.Process(target=tracker_client, daemon=True,
+                                             args=(port, args.sockets, args.seconds, args.files, args.seeders, args.writes, child))
+            client.start()
+            pipes.append(parent)
+            clients.append(client)
+        for pipe in pipes:
+            pipe.send("start")
+        rate = sum(pipe.recv() for pipe in pipes) / args.seconds
+        tracker.terminate()
+        tracker.join()
+
+        baseline = baseline or rate
+        print(f"{workers:>7} {rate:>11.0f} {rate / baseline:>7.2f}x")
+
+
+'''
+Seeder library benchmark.
+Fills a temporary folder with --files files of --size bytes in folders of 100, then times the scans of a published
+library: the first scan hashes every file, a restart reads the cache and hashes nothing, an idle poll only stats the
+files, and a poll after --changed files were modified hashes just those.
+'''
+def bench_library(args):
+    def timed_scan(library):
+        started = time.perf_counter()
+        changed, removed = library.scan()
+        return time.perf_counter() - started, len(changed), len(removed), library.hashed
+
+    with tempfile.TemporaryDirectory() as folder:
+        settled = time.time() - 2 * Seeder.LIBRARY_SETTLE
+        for index in range(args.files):
+            path = os.path.join(folder, f"shelf{index // 100}", f"file{index}.bin")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(os.urandom(args.size))
+            os.utime(path, (settled, settled))
+
+        print(f"{args.files} files of {args.size} bytes")
+        print(f"{'scan':<22} {'seconds':>8} {'changed':>8} {'removed':>8} {'hashed':>7}")
+        library = Seeder.Library(folder)
+        rows = [("first scan", timed_scan(library))]
+        library.close()
+        library = Seeder.Library(folder)   #a restarted seeder, starting from the cache
+        rows.append(("after a restart", timed_scan(library)))
+        rows.append(("idle poll", timed_scan(library)))
+        for index in range(args.changed):
+            path = os.path.join(folder, f"shelf{index // 100}", f"file{index}.bin")
+            with open(path, "ab") as file:
+                file.write(b"changed")
+            os.utime(path, (settled, settled + 1))
+        rows.append((f"poll, {args.changed} changed", timed_scan(library)))
+        library.close()
+        for name, (seconds, changed, removed, hashed) in rows:
+            print(f"{name:<22} {seconds:>8.3f} {changed:>8} {removed:>8} {hashed:>7}")
+
+
+'''
+Upload limit benchmark.
+The seeder runs in a child process with the given upload limit. One "greedy" leecher keeps --greedy-depth chunk requests
+in flight and the others --depth each, all for --seconds; every leecher counts the chunk bytes it received. With the
+limit the total should stay at the limit and every leecher should get about the same share of it.
+'''
+def run_upload_seeder(mode, port, folder, limit, conn):
+    os.chdir(folder)
+    Seeder.setUploadLimit(limit)
+    threading.Thread(target=Seeder.serve, args=("127.0.0.1", port, mode, quiet), daemon=True).start()
+    conn.send("ready")
+    conn.recv()  # Runs until the parent terminates it
+
+
+async def upload_load(port, file_name, chunks, piece_size, depths, seconds):
+    async def leecher(depth):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(Seeder.SESSION_HELLO)
+        await reader.readline()  # SESSION OK
+        received, next_chunk = 0, 0
+        deadline = time.perf_counter() + seconds
+
+        def request():
+            nonlocal next_chunk
+            writer.write(f"REQUEST {file_name} {next_chunk % chunks} {piece_size}\n".encode())
+            next_chunk += 1
+
+        for _ in range(depth):
+            request()
+        while time.perf_counter() < deadline:
+            header = (await reader.readline()).split()
+            data = await reader.readexactly(int(header[2]))
+            if time.perf_counter() < deadline:
+                received += len(data)
+            request()
+        writer.close()
+        return received
+
+    return await asyncio.gather(*(leecher(depth) for depth in depths))
+
+
+def bench_upload(args):
+    folder = tempfile.mkdtemp()
+    file_name = "bench.bin"
+    with open(os.path.join(folder, file_name), "wb") as f:
+        f.write(os.urandom(args.chunks * args.piece_size))
+    depths = [args.greedy_depth] + [args.depth] * (args.leechers - 1)
+
+    print(f"{args.leechers} leechers for {args.seconds:.0f} s, one with {args.greedy_depth} requests in flight "
+          f"and the others with {args.depth}, chunks of {args.piece_size} bytes")
+    print(f"{'mode':<10} {'limit MB/s':>10} {'total MB/s':>10} {'greedy MB/s':>11}  others MB/s")
+    for mode in args.modes:
+        for limit in args.limits:
+            port = free_port()
+            parent, child = multiprocessing.Pipe()
+            server = multiprocessing.Process(target=run_upload_seeder, args=(mode, port, folder, limit, child), daemon=True)
+            server.start()
+            parent.recv()
+            time.sleep(0.2)  # Let the server reach accept()
+            try:
+                received = asyncio.run(upload_load(port, file_name, args.chunks, args.piece_size, depths, args.seconds))
+            finally:
+                server.terminate()
+            rates = [count / args.seconds / 1e6 for count in received]
+            print(f"{mode:<10} {f'{limit / 1e6:.2f}' if limit else 'none':>10} {sum(rates):>10.2f} {rates[0]:>11.2f}  "
+                  f"{' '.join(f'{rate:.2f}' for rate in rates[1:])}")
+
+
+'''
+Tracker restart benchmark.
+Registers --files files, writes a snapshot, journals --journal more registrations and expiries on top of it, then
+empties the tracker's state and times restore(), which should take well under a second for 100,000 files.
+Snapshot and journal go to a temporary folder.
+'''
+def reset_tracker():
+    for table in (Tracker.seeders, Tracker.files_index, Tracker.address_index, Tracker.peer_index, Tracker.response_cache,
+                  Tracker.expiry_heap):
+        table.clear()
+
+
+def bench_restart(args):
+    Tracker.log = quiet
+    address = ("127.0.0.1", 0)
+    seeders = max(1, args.files // args.files_per_seeder)
+
+    def register(index):
+        files = ",".join(f"file{index * args.files_per_seeder + offset}.bin:{1 << 20}:{bytes(32).hex()}"
+                         for offset in range(args.files_per_seeder))
+        Tracker.handle_message(f"REGISTER_FILES 127.0.0.1 {10000 + index} {files}".encode(), address)
+
+    with tempfile.TemporaryDirectory() as folder:
+        Tracker.SNAPSHOT_PATH = os.path.join(folder, "tracker_state.snapshot")
+        Tracker.JOURNAL_PATH = os.path.join(folder, "tracker_state.journal")
+        Tracker.restore()  # Starts from nothing and opens the journal
+
+        started = time.perf_counter()
+        for index in range(seeders):
+            register(index)
+        registering = time.perf_counter() - started
+        started = time.perf_counter()
+        Tracker.write_snapshot()
+        snapshotting = time.perf_counter() - started
+
+        # Registrations of new seeders, and every tenth journal record the expiry of a seeder from the snapshot
+        for record in range(args.journal):
+            if record % 10 == 9:
+                seeder_id = next(iter(Tracker.seeders))
+                Tracker.remove_seeder(seeder_id)
+                Tracker.write_journal(f"EXPIRE {seeder_id}")
+            else:
+                register(seeders + record)
+        expected = (len(Tracker.seeders), len(Tracker.files_index))
+        snapshot_size = os.path.getsize(Tracker.SNAPSHOT_PATH)
+        journal_size = os.path.getsize(Tracker.JOURNAL_PATH)
+
+        reset_tracker()
+        started = time.perf_counter()
+        Tracker.restore()
+        restoring = time.perf_counter() - started
+        restored = (len(Tracker.seeders), len(Tracker.files_index))
+        Tracker.journal.close()
+        Tracker.journal = None
+
+    print(f"{seeders} seeders x {args.files_per_seeder} files, then {args.journal} journal records")
+    print(f"registering by message {registering:8.3f} s")
+    print(f"writing the snapshot   {snapshotting:8.3f} s  ({snapshot_size / 1e6:.1f} MB)")
+    print(f"restoring at startup   {restoring:8.3f} s  (snapshot plus {journal_size / 1e6:.1f} MB of journal)")
+    print(f"restored {restored[0]} seeders and {restored[1]} files, expected {expected[0]} and {expected[1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmarks for the P2P file sharing system")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    seeder = benchmarks.add_parser("seeder", help="threaded vs event loop seeder under many concurrent sessions")
+    seeder.add_argument("--connections", type=int, default=500)
+    seeder.add_argument("--chunks", type=int, default=20, help="chunks requested on every session")
+    seeder.add_argument("--piece-size", type=int, default=Protocol.LEGACY_CHUNK_SIZE)
+    seeder.add_argument("--modes", nargs="+", default=["threaded", "eventloop"])
+    seeder.set_defaults(run=bench_seeder)
+
+    download = benchmarks.add_parser("download", help="chunk schedulers downloading from seeders of uneven speed")
+    download.add_argument("--chunks", type=int, default=400)
+    download.add_argument("--piece-size", type=int, default=Protocol.MIN_PIECE_SIZE)
+    download.add_argument("--seeders", type=int, default=3)
+    download.add_argument("--slow", type=int, default=1, help="how many of the seeders are slowed down")
+    download.add_argument("--delay", type=float, default=0.02, help="seconds a slow seeder waits before every chunk")
+    download.add_argument("--schedulers", nargs="+", default=list(Scheduler.SCHEDULERS))
+    download.add_argument("--endgame", nargs="+", type=int, default=[0, Leecher.ENDGAME_CHUNKS],
+                          help="chunks left when the endgame starts, 0 for no endgame")
+    download.set_defaults(run=bench_download)
+
+    tracker = benchmarks.add_parser("tracker", help="tracker lookups with many registered files")
+    tracker.add_argument("--files", type=int, default=100000)
+    tracker.add_argument("--files-per-seeder", type=int, default=10)
+    tracker.add_argument("--lookups", type=int, default=20000)
+    tracker.add_argument("--hot-seeders", type=int, default=200, help="seeders of the popular file")
+    tracker.add_argument("--library", type=int, default=5000, help="files announced by the seeder with a large library")
+    tracker.set_defaults(run=bench_tracker)
+
+    soak = benchmarks.add_parser("soak", help="tracker memory over days of simulated traffic")
+    soak.add_argument("--days", type=float, default=3)
+    soak.add_argument("--seeders", type=int, default=100)
+    soak.add_argument("--requests", type=int, default=50, help="leecher requests every 30 simulated seconds")
+    soak.set_defaults(run=bench_soak)
+
+    load = benchmarks.add_parser("load", help="tracker messages per second with several worker processes")
+    load.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    load.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    load.add_argument("--sockets", type=int, default=32, help="sockets per client, each with one request in flight")
+    load.add_argument("--seconds", type=float, default=5)
+    load.add_argument("--files", type=int, default=1000)
+    load.add_argument("--seeders", type=int, default=200)
+    load.add_argument("--writes", type=float, default=0.05, help="share of the messages that are heartbeats")
+    load.set_defaults(run=bench_load)
+
+    restart = benchmarks.add_parser("restart", help="tracker startup from a snapshot and journal")
+    restart.add_argument("--files", type=int, default=100000)
+    restart.add_argument("--files-per-seeder", type=int, default=10)
+    restart.add_argument("--journal", type=int, default=1000, help="records journaled after the snapshot")
+    restart.set_defaults(run=bench_restart)
+
+    library = benchmarks.add_parser("library", help="scans of a seeder's published folder")
+    library.add_argument("--files", type=int, default=20000)
+    library.add_argument("--size", type=int, default=64 * 1024)
+    library.add_argument("--changed", type=int, default=10)
+    library.set_defaults(run=bench_library)
+
+    upload = benchmarks.add_parser("upload", help="seeder upload limit and fairness between leechers")
+    upload.add_argument("--leechers", type=int, default=4)
+    upload.add_argument("--greedy-depth", type=int, default=64, help="requests the greedy leecher keeps in flight")
+    upload.add_argument("--depth", type=int, default=2, help="requests every other leecher keeps in flight")
+    upload.add_argument("--seconds", type=float, default=3)
+    upload.add_argument("--chunks", type=int, default=64)
+    upload.add_argument("--piece-size", type=int, default=64 * 1024)
+    upload.add_argument("--limits", nargs="+", type=int, default=[0, 8000000],
+                        help="upload limits in bytes per second, 0 for no limit")
+    upload.add_argument("--modes", nargs="+", default=["eventloop", "threaded"])
+    upload.set_defaults(run=bench_upload)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
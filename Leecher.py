@@ -1,19 +1,25 @@
 '''Leecher Class 
-This class gets list of seeders from the tracker that has the specific file it has requested and it creates connection with those seeders to download chunks and assemble the chunks to the file then the file is checked if it is the same as the original if it is the same it transition to a Seeder immediately.
+This class gets list of seeders from the tracker that has the specific file it has requested and it creates connection with those seeders to download chunks and assemble the chunks to the file. Every chunk is checked against the piece manifest the seeders published as it arrives, and once the whole file is downloaded it transition to a Seeder immediately.
 '''
 
 import socket
 import threading # To handle multiple downloads simultaneously
 import os
 import Seeder
+import Protocol
+import Scheduler
 import hashlib
 import time
+import base64
+import random
+import heapq
+import struct
+from collections import deque, namedtuple
 
 # Set tracker parameters for the connection
 ip_address = "127.0.0.1"  
 port_number = 6000
 format = 'utf-8'
-chunk_storage = {}  # Dictionary to store downloaded chunks
 
 leecherIP = "127.0.0.1"
 leecherPortNum = 6010
@@ -21,158 +27,1132 @@ leecherPortNum = 6010
 trackerIP = "127.0.0.1"
 trackerPortNum = 6000
 
-CHUNK_SIZE = 1024  # Size of each chunk to download
+PIPELINE_DEPTH = 16  # Chunk requests kept in flight on one seeder session
+SESSION_TIMEOUT = 10  # Seconds to wait on a seeder before giving up on the session
+MAX_WORKERS = 8  # Most seeder connections one download keeps open at the same time
+MAX_PER_SEEDER = 2  # Most connections one download keeps open to a single seeder
+ENDGAME_CHUNKS = 8  # Once every chunk is requested and this few are left, they are also requested from other seeders
+MAX_CHUNK_ATTEMPTS = 6  # Failed deliveries of one chunk, over all seeders, before the download gives up on it
+RETRY_BASE_DELAY = 0.25  # Seconds before the first retry of a chunk or connection, doubled for every further retry
+RETRY_MAX_DELAY = 8.0  # Longest backoff between retries
+BREAKER_THRESHOLD = 3  # Failures in a row after which a seeder is left alone for a while
+BREAKER_COOLDOWN = 5.0  # Seconds a seeder is left alone the first time, doubled every time it happens again
+BREAKER_MAX_TRIPS = 3  # Times a seeder may be left alone before it is dropped from the download
+TRACKER_TIMEOUT = 5  # Seconds to wait for the tracker to answer
+TRACKER_PROTOCOL = "binary"  # How seeder lists are asked for: "binary", falling back to "text" for older trackers
+MAX_PEERS = 200  # Most seeders asked of the tracker for one download
+MAX_ROUNDS = 4  # Rounds of multi-file lookups before the files still unanswered are looked up one at a time
+TRACKER_REFRESH_INTERVAL = 5.0  # Least seconds between two requests for a fresh seeder list during a download
+MAX_TRACKER_REFRESHES = 5  # Fresh seeder lists one download may ask the tracker for
+SCHEDULER = "adaptive"  # How chunks are spread over the seeders, one of Scheduler.SCHEDULERS ("adaptive" or "roundrobin")
+RESUME_FLUSH_CHUNKS = 64  # Completed chunks recorded in memory before the resume file is rewritten
+RESUME_FLUSH_INTERVAL = 2.0  # Seconds after which recorded chunks are flushed to the resume file anyway
 
-''' 
-Function to calculate SHA-256 hash of a file to ensure integrity after downloading.
-This function reads the file in chunks and calculates the hash progressively.
-'''
-def get_file_hash(file_path):
-    hash_sha256 = hashlib.sha256()  
-    with open(file_path, 'rb') as file:  
-        
-        while chunk := file.read(8192):
-            hash_sha256.update(chunk)
-    return hash_sha256.hexdigest()  
+# Outcome of one chunk job; seeder is the "ip,port" string the chunk was last requested from
+ChunkResult = namedtuple("ChunkResult", ["chunk_id", "seeder", "ok", "size", "error"])
+
+# What the tracker knows about a file; root is None when the seeders published no piece manifest and availability
+# (how many peers hold each piece) is None when no leecher partway through the file has reported its pieces
+FileInfo = namedtuple("FileInfo", ["file_name", "seeders", "total_chunks", "piece_size", "file_size", "root",
+                                   "availability"])
 
 ''' 
-Function to get a list of seeders from the tracker and the total number of chunks for a file.
-The tracker will provide a list of available seeders and the total number of chunks for the file.
+Function to get a list of seeders from the tracker, the total number of chunks for a file and the piece size of those chunks,
+returned as a FileInfo together with the file's size and manifest root when the tracker knows them.
+The tracker picks the piece size from the file's size; an older tracker only knows legacy 1 KiB chunks.
 '''
-def get_seeders_and_chunks(file_name):
-    
+def get_seeders_and_chunks(file_name, log=print):
+    if TRACKER_PROTOCOL == "binary":
+        info = lookup_binary(file_name, log)
+        if info is not None:
+            return info
+        log("The tracker does not answer binary lookups, asking again in text")
+
     # Send a request to the tracker to get a list of seeders and chunks and it's using UDP for communication
     
     leecherSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    message = f"REQUEST {file_name}"
+    leecherSocket.settimeout(TRACKER_TIMEOUT)
+    message = f"REQUEST {file_name} V2"
     leecherSocket.sendto(message.encode(), (ip_address, port_number))
-    print("Request list of seeders")
+    log("Request list of seeders")
     
     # Receive the response from the tracker
-    response, _ = leecherSocket.recvfrom(1024)
+    try:
+        response, _ = leecherSocket.recvfrom(65535)
+    except socket.timeout:
+        log("The tracker did not answer")
+        return FileInfo(file_name, [], 0, Protocol.LEGACY_CHUNK_SIZE, None, None, None)
+    finally:
+        leecherSocket.close()  
     data = response.decode().strip().split(" ")
     
-    # Extracting all elements which is the list of seeders except the last one are seeders and the last item is total chunks
-    
-    seeders = data[:-1]  
-    total_chunks = int(data[-1])  
-    print(f"List of seeders received: {seeders}")
-    print(f"Total chunks: {total_chunks}")
-    
-    leecherSocket.close()  
-    return seeders, total_chunks
+    if data[0] == "PEERS":
+        # Format: PEERS chunks=N piece=BYTES size=BYTES [root=HEX] [avail=BASE64] ip,port ip,port
+        details = dict(item.split('=', 1) for item in data[1:] if '=' in item)
+        seeders = [item for item in data[1:] if '=' not in item]
+        availability = list(base64.b64decode(details["avail"])) if "avail" in details else None
+        info = FileInfo(file_name, seeders, int(details["chunks"]), int(details["piece"]), int(details["size"]),
+                        details.get("root"), availability)
+    elif data[-1].isdigit():
+        # Extracting all elements which is the list of seeders except the last one are seeders and the last item is total chunks
+        info = FileInfo(file_name, data[:-1], int(data[-1]), Protocol.LEGACY_CHUNK_SIZE, None, None, None)
+    else:
+        log(response.decode())
+        return FileInfo(file_name, [], 0, Protocol.LEGACY_CHUNK_SIZE, None, None, None)
+
+    log(f"List of seeders received: {info.seeders}")
+    log(f"Total chunks: {info.total_chunks} of {info.piece_size} bytes")
+    return info
+
+''' 
+Function to look a file up with the binary tracker protocol (see Protocol.py), reading the seeder list a page at a time
+until it has MAX_PEERS seeders or the whole swarm. A first page without peers gives a FileInfo without seeders.
+Returns None when the tracker does not answer in the binary protocol.
+'''
+def lookup_binary(file_name, log):
+    transaction = random.getrandbits(32)
+    leecherSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    leecherSocket.settimeout(TRACKER_TIMEOUT)
+    log("Request list of seeders")
+    first_page, peers = None, []
+    try:
+        while first_page is None or len(peers) < min(first_page["total"], MAX_PEERS):
+            leecherSocket.sendto(Protocol.pack_lookup(transaction, file_name, len(peers), MAX_PEERS - len(peers)),
+                                 (ip_address, port_number))
+            try:
+                action, body = read_tracker_reply(leecherSocket, transaction)
+            except socket.timeout:
+                if first_page is None:
+                    return None
+                break  # Download from the seeders of the pages that arrived
+            if action is None:
+                return None
+            if action == Protocol.FAILURE:
+                log(body.decode())
+                return FileInfo(file_name, [], 0, Protocol.LEGACY_CHUNK_SIZE, None, None, None)
+            page = Protocol.unpack_peers(body)
+            first_page = first_page or page  # Even without peers, the first page describes the file
+            if page["first"] != len(peers) or not page["peers"]:
+                break  # The swarm shrank while it was being read, or has no peers this leecher can reach
+            peers.extend(page["peers"])
+    finally:
+        leecherSocket.close()
+
+    info = page_info(file_name, first_page, peers)
+    log(f"List of seeders received: {info.seeders}")
+    log(f"Total chunks: {info.total_chunks} of {info.piece_size} bytes")
+    return info
+
+# FileInfo of a file from the first page of its binary lookup answer and the seeders read from every page
+def page_info(file_name, page, peers):
+    return FileInfo(file_name, peers, page["chunks"], page["piece"], page["size"], page["root"], page["avail"])
+
+''' 
+Function to look many files up at once. The names are packed into multi-file lookups of at most Protocol.BATCH_BYTES,
+all of which are sent before the answers are read, so a few round trips cover hundreds of files. Files the tracker left
+out of an answer to keep it within a datagram are asked for again in the next round; files whose swarm did not fit in
+one page, and every file of a tracker that does not answer multi-file lookups, are looked up one at a time.
+Returns {file name: FileInfo}.
+'''
+def get_many_seeders(file_names, log=print):
+    infos, pending, single = {}, list(dict.fromkeys(file_names)), []
+    limit = Protocol.BATCH_BYTES - Protocol.HEADER.size - Protocol.COUNT.size
+    leecherSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    leecherSocket.settimeout(TRACKER_TIMEOUT)
+    try:
+        for _ in range(MAX_ROUNDS if TRACKER_PROTOCOL == "binary" else 0):
+            if not pending:
+                break
+            batches = {random.getrandbits(32): batch for batch in Protocol.batch_entries(pending, limit)}
+            log(f"Request lists of seeders for {len(pending)} files in {len(batches)} requests")
+            for transaction, batch in batches.items():
+                leecherSocket.sendto(Protocol.pack_lookup_many(transaction, batch, MAX_PEERS), (ip_address, port_number))
+            while batches:
+                try:
+                    response, _ = leecherSocket.recvfrom(65535)
+                    action, transaction, body = Protocol.unpack_header(response)
+                except (socket.timeout, struct.error, ValueError):
+                    break  # The tracker is gone, answered in text or speaks another version
+                if batches.pop(transaction, None) is None or action != Protocol.PEERS_MANY:
+                    continue
+                for file_name, page in Protocol.unpack_peers_many(body).items():
+                    if page is None:
+                        infos[file_name] = FileInfo(file_name, [], 0, Protocol.LEGACY_CHUNK_SIZE, None, None, None)
+                    elif len(page["peers"]) < min(page["total"], MAX_PEERS):
+                        single.append(file_name)
+                    else:
+                        infos[file_name] = page_info(file_name, page, page["peers"])
+            left = [file_name for file_name in pending if file_name not in infos and file_name not in single]
+            if len(left) == len(pending):
+                break  # No progress this round
+            pending = left
+    finally:
+        leecherSocket.close()
+
+    log(f"Lists of seeders received for {len(infos)} files")
+    for file_name in single + pending:
+        infos[file_name] = get_seeders_and_chunks(file_name, log)
+    return infos
+
+# Wait for the tracker's answer to transaction, skipping late answers to earlier ones; the action is None for a text answer
+def read_tracker_reply(leecherSocket, transaction):
+    while True:
+        response, _ = leecherSocket.recvfrom(65535)
+        if not Protocol.is_binary(response):
+            return None, response
+        action, reply_transaction, body = Protocol.unpack_header(response)
+        if reply_transaction == transaction:
+            return action, body
+
+''' 
+Function to tell the tracker which pieces of a file this leecher already holds, so other leechers can see how
+available every piece is. bitfield is None once the download is complete, which takes the leecher off the list.
+peer_id is picked at random for every download, so the tracker tells the reports of different leechers apart even
+though they all come from a new socket and carry the same configured address.
+The report is fire-and-forget: a lost report only makes the tracker's counts a little stale.
+'''
+def report_pieces(info, bitfield, peer_id):
+    pieces = "DONE" if bitfield is None else base64.b64encode(bitfield).decode()
+    message = f"HAVE {leecherIP} {leecherPortNum} {info.file_name} {info.piece_size} {pieces} peer={peer_id}"
+    try:
+        leecherSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        leecherSocket.sendto(message.encode(), (ip_address, port_number))
+        leecherSocket.close()
+    except OSError:
+        pass
+
+''' 
+Function to order the chunks of a download rarest first: pieces held by the fewest peers are requested first, and
+pieces that are equally available are shuffled, so leechers that start together do not all ask for the same chunks.
+'''
+def rarest_first(chunk_ids, availability=None):
+    chunk_ids = list(chunk_ids)
+    random.shuffle(chunk_ids)
+    if availability is not None:
+        chunk_ids.sort(key=lambda chunk_id: availability[chunk_id] if chunk_id < len(availability) else 0)
+    return chunk_ids
+
+''' 
+Function to fetch the piece manifest of a file from one of its seeders.
+The manifest is only trusted if it hashes to the root the seeders published through the tracker.
+Returns the list of piece digests, or None if no seeder sent a manifest matching the root.
+'''
+def get_manifest(info, log=print):
+    for seeder in info.seeders:
+        seeder_ip, seeder_port = seeder.split(',')
+        try:
+            session = SeederSession(seeder_ip, int(seeder_port))
+        except OSError:
+            continue
+        try:
+            manifest = session.fetch_manifest(info.file_name, info.piece_size)
+        except (OSError, ValueError, IndexError):
+            manifest = None
+        finally:
+            session.close()
+
+        if manifest is not None and Protocol.manifest_root(manifest) == info.root:
+            return [manifest[offset:offset + 32] for offset in range(0, len(manifest), 32)]
+        log(f"Seeder {seeder} did not send a valid manifest for {info.file_name}")
+    return None
+
+''' 
+Class for the file a download is written into.
+The file is created at its full size before the first chunk arrives and every chunk is written straight to its offset,
+so the finished file exists without a reassembly pass and concurrent downloads never share temporary chunk files.
+'''
+class OutputFile:
+    def __init__(self, path, total_chunks, chunk_size=Protocol.LEGACY_CHUNK_SIZE, file_size=None, resume=False):
+        self.path = path
+        self.total_chunks = total_chunks
+        self.chunk_size = chunk_size
+        self.final_size = file_size  # Unless given, known once the last (usually shorter) chunk has arrived
+        self.lock = threading.Lock()  # Only needed where os.pwrite is missing and writes must seek
+        # A resumed download keeps the chunks an earlier run already wrote
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0) | (0 if resume else os.O_TRUNC)
+        self.fd = os.open(path, flags, 0o644)
+
+        # Reserve the disk space up front where the OS can, otherwise create a sparse file of the full size
+        size = total_chunks * chunk_size
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(self.fd, size)
+
+    def write_chunk(self, chunk_id, data):
+        offset = chunk_id * self.chunk_size
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                os.write(self.fd, data)
+        if chunk_id == self.total_chunks - 1:
+            self.final_size = chunk_id * self.chunk_size + len(data)
+
+    # Make sure every chunk written so far is on disk
+    def sync(self):
+        os.fsync(self.fd)
+
+    # Trim the space reserved for the last chunk down to its real length and close the file
+    def close(self):
+        if self.final_size is not None:
+            os.ftruncate(self.fd, self.final_size)
+        os.close(self.fd)
+
+''' 
+Class for the resume file kept next to a partial download (New_<file_name>.resume).
+It records which chunks are already in the output file as a bitfield, one bit per chunk, together with the piece
+manifest the chunks were verified against, so a restarted download only fetches the missing chunks.
+Completed chunks are recorded in memory and the resume file is rewritten only every RESUME_FLUSH_CHUNKS chunks or
+RESUME_FLUSH_INTERVAL seconds, after the output file has been synced, so a chunk is never marked done before its data
+is on disk. Chunks lost to a crash between two flushes are simply downloaded again. Every flush also hands the
+bitfield to on_flush, which the download uses to report its pieces to the tracker.
+
+File layout: "RESUME file_name file_size piece_size total_chunks root\n", then the manifest (32 bytes per chunk,
+absent when the seeders published no manifest), then the bitfield. Unknown sizes and roots are written as "-".
+'''
+class ResumeState:
+    def __init__(self, output_path, info, hashes=None, bitfield=None, file_size=None):
+        self.path = output_path + ".resume"
+        self.file_name = info.file_name
+        self.piece_size = info.piece_size
+        self.total_chunks = info.total_chunks
+        self.root = info.root
+        self.hashes = hashes
+        self.file_size = info.file_size if info.file_size is not None else file_size
+        self.bitfield = bitfield if bitfield is not None else bytearray((info.total_chunks + 7) // 8)
+        self.output = None  # The OutputFile synced before every flush
+        self.on_flush = None  # Called with the bitfield after every flush
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # Keeps two flushes from writing the resume file at the same time
+
+    def has(self, chunk_id):
+        return self.bitfield[chunk_id >> 3] & (0x80 >> (chunk_id & 7)) != 0
+
+    def missing(self):
+        return [chunk_id for chunk_id in range(self.total_chunks) if not self.has(chunk_id)]
+
+    def completed(self):
+        return self.total_chunks - len(self.missing())
+
+    # Record a chunk that has been written to the output file, flushing the resume file once a batch is due
+    def mark(self, chunk_id, length):
+        with self.lock:
+            self.bitfield[chunk_id >> 3] |= 0x80 >> (chunk_id & 7)
+            if chunk_id == self.total_chunks - 1:
+                self.file_size = chunk_id * self.piece_size + length
+            self.unflushed += 1
+            due = (self.unflushed >= RESUME_FLUSH_CHUNKS
+                   or time.monotonic() - self.last_flush >= RESUME_FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                bitfield = bytes(self.bitfield)
+                file_size = self.file_size
+                self.unflushed = 0
+                self.last_flush = time.monotonic()
+            if self.output is not None:
+                self.output.sync()
+
+            header = (f"RESUME {self.file_name} {'-' if file_size is None else file_size} {self.piece_size} "
+                      f"{self.total_chunks} {self.root or '-'}\n")
+            # Write a new copy and swap it in, so a crash mid-flush leaves the previous bitfield intact
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(header.encode(format))
+                if self.hashes is not None:
+                    file.write(b"".join(self.hashes))
+                file.write(bitfield)
+            os.replace(temp_path, self.path)
+            if self.on_flush:
+                self.on_flush(bitfield)
+
+    # The download finished; the resume file is no longer needed
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+''' 
+Function to load the resume file of an earlier, unfinished download of the same file.
+Returns None when there is nothing to resume: no partial output or resume file, a damaged resume file, or one written
+for a different version of the file (another size, piece size or manifest root than the tracker reports now).
+'''
+def load_resume_state(output_path, info):
+    path = output_path + ".resume"
+    if not (os.path.exists(output_path) and os.path.exists(path)):
+        return None
+    try:
+        with open(path, 'rb') as file:
+            header = file.readline().decode(format).split()
+            body = file.read()
+        _, file_name, file_size, piece_size, total_chunks, root = header
+        file_size = None if file_size == '-' else int(file_size)
+        root = None if root == '-' else root
+        if (file_name != info.file_name or int(piece_size) != info.piece_size
+                or int(total_chunks) != info.total_chunks or root != info.root
+                or (info.file_size is not None and file_size is not None and file_size != info.file_size)):
+            return None
+
+        hashes = None
+        if root is not None:
+            manifest = body[:32 * info.total_chunks]
+            if Protocol.manifest_root(manifest) != root:
+                return None
+            hashes = [manifest[offset:offset + 32] for offset in range(0, len(manifest), 32)]
+            body = body[len(manifest):]
+        if len(body) != (info.total_chunks + 7) // 8:
+            return None
+    except (OSError, ValueError, UnicodeDecodeError):
+        return None
+    return ResumeState(output_path, info, hashes, bytearray(body), file_size)
 
 ''' 
 Function to download a specific chunk from a seeder.
 Each chunk creates its own TCP connection with the seeder to download the data.
+This single-shot request is kept for seeders that do not support sessions.
 '''
-def download_chunk(seeder_ip, seeder_port, file_name, chunk_id):
+def fetch_chunk(seeder_ip, seeder_port, file_name, chunk_id, piece_size=Protocol.LEGACY_CHUNK_SIZE):
     try:
         seederSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
+        seederSocket.settimeout(SESSION_TIMEOUT)
         seederSocket.connect((seeder_ip, seeder_port))
         
-        message = f"REQUEST {file_name} {chunk_id}"  
+        message = request_line(file_name, chunk_id, piece_size)
         seederSocket.send(message.encode(format)) 
         
-        # Receive the chunk of data and write it on a chunk file and all downloaded files are added on chunk storage
+        # Receive the chunk of data
         data = seederSocket.recv(5048)
-        if data:
-            chunk_filename = f"chunk_{chunk_id}"  
-            with open(chunk_filename, 'wb') as chunk_file:  
-                chunk_file.write(data)
-            chunk_storage[chunk_id] = chunk_filename
-            
-        
         seederSocket.close()  
+        return data
 
     except Exception as e:
         print(f"Failed to connect to {seeder_ip}:{seeder_port}")
+        return b""
 
 ''' 
-Function to download the full file by fetching its chunks from different seeders.
-This function uses the download_chunk method to retrieve the chunks concurrently.
+Function to download a piece from a seeder that predates piece sizes and only serves legacy 1 KiB chunks.
+The piece is put together from the legacy chunks it covers, one connection per chunk.
 '''
-def download_file(file_name):
-    seeders, total_chunks = get_seeders_and_chunks(file_name)  
-    if not seeders:
-        print("No seeders available")
-        return
-    
-    threads = []  # List to hold the threads for downloading chunks
+def fetch_piece_legacy(seeder_ip, seeder_port, file_name, piece_id, piece_size):
+    per_piece = piece_size // Protocol.LEGACY_CHUNK_SIZE
+    data = b""
+    for chunk_id in range(piece_id * per_piece, (piece_id + 1) * per_piece):
+        chunk = fetch_chunk(seeder_ip, seeder_port, file_name, chunk_id)
+        data += chunk
+        if len(chunk) < Protocol.LEGACY_CHUNK_SIZE:
+            break  # End of the file, or the seeder failed
+    return data
 
-    # Create a dictionary to store chunks for each seeder
-    seeder_chunks = {seeder: [] for seeder in seeders} 
-    print(f"Assigning chunks to available seeders")
-    
-    # Distribute the chunks to seeders available using round-robin manner
-    for chunk_id in range(total_chunks):
-        assigned_seeder = seeders[chunk_id % len(seeders)]  
-        seeder_chunks[assigned_seeder].append(chunk_id)
+# Request line for one chunk; the piece size is left out for legacy chunks so older seeders understand it
+def request_line(file_name, chunk_id, piece_size=Protocol.LEGACY_CHUNK_SIZE):
+    if piece_size == Protocol.LEGACY_CHUNK_SIZE:
+        return f"REQUEST {file_name} {chunk_id}"
+    return f"REQUEST {file_name} {chunk_id} {piece_size}"
+
+# Raised when a seeder answers the session handshake like an old single-shot seeder
+class SessionUnsupportedError(ConnectionError):
+    pass
+
+''' 
+Class for a persistent connection to one seeder.
+The leecher opens the session with a SESSION line, then pipelines many REQUEST lines on the same
+TCP connection and reads the answers back in order, so there is one handshake per seeder instead of one per chunk.
+'''
+class SeederSession:
+    def __init__(self, seeder_ip, seeder_port, timeout=SESSION_TIMEOUT):
+        self.address = (seeder_ip, seeder_port)
+        self.sock = socket.create_connection(self.address, timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        self.send_lock = threading.Lock()  # Other threads send CANCEL lines on this session
+        try:
+            self.sock.sendall(Seeder.SESSION_HELLO)
+            reply = self.reader.readline()
+        except OSError:
+            reply = b""
+        # Seeders without session support close the connection instead of answering
+        if not reply.startswith(b"SESSION OK"):
+            self.close()
+            raise SessionUnsupportedError(f"Seeder {seeder_ip}:{seeder_port} does not support sessions")
+        self.can_cancel = b"CANCEL" in reply.split()  # Seeders that understand CANCEL say so in their greeting
+        self.outstanding = deque()  # Chunk ids requested but not answered yet, in request order
+
+    def request(self, file_name, chunk_id, piece_size=Protocol.LEGACY_CHUNK_SIZE):
+        self.outstanding.append(chunk_id)
+        with self.send_lock:
+            self.sock.sendall((request_line(file_name, chunk_id, piece_size) + "\n").encode(format))
+
+    # Withdraw a request that is no longer needed. The seeder answers it with "CANCELLED chunk_id" if it had not
+    # started sending the chunk yet, and sends the chunk as usual otherwise. Returns whether a CANCEL was sent
+    def cancel(self, file_name, chunk_id, piece_size=Protocol.LEGACY_CHUNK_SIZE):
+        if not self.can_cancel or chunk_id not in self.outstanding:
+            return False
+        try:
+            with self.send_lock:
+                self.sock.sendall(f"CANCEL {file_name} {chunk_id} {piece_size}\n".encode(format))
+        except OSError:
+            return False
+        return True
+
+    # Read the next answer, which belongs to the oldest outstanding request.
+    # Returns (chunk_id, data), with data None if the seeder reported an error or cancelled the request
+    def read_chunk(self):
+        header = self.reader.readline().decode(format).split()
+        if not header:
+            raise ConnectionError(f"Seeder {self.address[0]}:{self.address[1]} closed the session")
+        chunk_id = self.outstanding[0]
+        data = None
+        if header[0] == "CHUNK":
+            length = int(header[2])
+            data = self.reader.read(length)
+            if len(data) != length:
+                raise ConnectionError(f"Seeder {self.address[0]}:{self.address[1]} closed the session mid-chunk")
+        self.outstanding.popleft()
+        return chunk_id, data
+
+    # Ask for the piece manifest of a file. Only valid while no chunk requests are outstanding.
+    # Returns the concatenated piece digests, or None if the seeder reported an error
+    def fetch_manifest(self, file_name, piece_size):
+        self.sock.sendall(f"MANIFEST {file_name} {piece_size}\n".encode(format))
+        header = self.reader.readline().decode(format).split()
+        if not header or header[0] != "MANIFEST":
+            return None
+        length = int(header[1])
+        manifest = self.reader.read(length)
+        if len(manifest) != length:
+            raise ConnectionError(f"Seeder {self.address[0]}:{self.address[1]} closed the session mid-manifest")
+        return manifest
+
+    # Fetch chunks, keeping up to `depth` requests in flight, and yield (chunk_id, data) in request order.
+    # chunk_ids may be any iterable; it is only advanced when there is room in the pipeline
+    def fetch(self, file_name, chunk_ids, depth=PIPELINE_DEPTH, piece_size=Protocol.LEGACY_CHUNK_SIZE):
+        pending = iter(chunk_ids)
+        exhausted = False
+        while True:
+            while not exhausted and len(self.outstanding) < depth:
+                chunk_id = next(pending, None)
+                if chunk_id is None:
+                    exhausted = True
+                else:
+                    self.request(file_name, chunk_id, piece_size)
+            if not self.outstanding:
+                return
+            yield self.read_chunk()
+
+    # Shut the connection from another thread, failing the read the session's worker is blocked in
+    def abort(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            with self.send_lock:
+                self.sock.sendall(b"BYE\n")
+        except OSError:
+            pass
+        self.reader.close()
+        self.sock.close()
+
+''' 
+Class that tracks the health of one seeder during a download.
+Every failure (a refused connection, a broken session, an error answer or a chunk that fails its hash) pushes the next
+connection attempt back with exponential backoff. After BREAKER_THRESHOLD failures in a row the breaker trips: the
+seeder gets no requests for BREAKER_COOLDOWN seconds, doubled on every trip, and after that a single failure trips
+it again until it delivers a chunk. A seeder that trips more than BREAKER_MAX_TRIPS times is dropped from the download.
+'''
+class CircuitBreaker:
+    def __init__(self):
+        self.failures = 0  # Failures since the seeder last delivered a chunk
+        self.trips = 0
+        self.retry_at = 0.0  # No new connection before this time
+
+    def is_open(self, now):
+        return self.failures >= BREAKER_THRESHOLD - 1 and self.trips and now < self.retry_at
+
+    def dropped(self):
+        return self.trips > BREAKER_MAX_TRIPS
+
+    def success(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+    # Record a failure; returns whether it tripped the breaker
+    def failure(self, now):
+        if self.is_open(now):
+            return False  # Already tripped by another connection to the same seeder
+        self.failures += 1
+        if self.failures < BREAKER_THRESHOLD:
+            self.retry_at = now + backoff_delay(self.failures - 1)
+            return False
+        self.trips += 1
+        self.failures = BREAKER_THRESHOLD - 1  # After the cooldown, one more failure trips it again
+        self.retry_at = now + BREAKER_COOLDOWN * 2 ** (self.trips - 1)
+        return True
+
+# Exponential backoff: RETRY_BASE_DELAY doubled for every earlier attempt, capped at RETRY_MAX_DELAY
+def backoff_delay(attempt):
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+
+''' 
+Download engine with a bounded pool of worker threads.
+Chunk jobs are kept in one queue per seeder by a scheduler from Scheduler.py, which also sets how many requests every
+session keeps in flight. Every worker owns one connection to one seeder and keeps pulling jobs from that seeder's
+queue, so a download never has more than max_per_seeder sockets open to a seeder or max_workers sockets open
+overall, however many chunks the file has. run() supervises the workers: it starts them, restarts them once their
+seeder's backoff or breaker cooldown has passed, and asks refresh() (the tracker) for more seeders when none are left.
+When piece hashes are given, every chunk is checked as it arrives. A chunk that fails the check, that a seeder cannot
+send, or that was in flight on a broken connection fails over to another seeder straight away. Once every usable
+seeder has failed it, it is retried on all of them again after an exponential backoff, up to MAX_CHUNK_ATTEMPTS
+failed deliveries.
+Once every chunk has been requested and at most `endgame` chunks are left, idle workers enter the endgame: they also
+request the chunks still in flight on other seeders, the first copy to arrive is kept, and the other requests are
+cancelled, so one slow seeder no longer decides when the download finishes.
+run() returns a ChunkResult for every chunk id it was given; endgame_stats() reports what the endgame did.
+'''
+class DownloadEngine:
+    def __init__(self, file_name, seeders, piece_size=Protocol.LEGACY_CHUNK_SIZE, hashes=None, max_workers=MAX_WORKERS,
+                 max_per_seeder=MAX_PER_SEEDER, depth=PIPELINE_DEPTH, on_chunk=None, log=print, scheduler=SCHEDULER,
+                 endgame=ENDGAME_CHUNKS, refresh=None):
+        self.file_name = file_name
+        self.piece_size = piece_size
+        self.hashes = hashes  # SHA-256 digest of every piece from the manifest, or None to skip verification
+        self.seeders = list(seeders)
+        self.max_workers = max(1, max_workers)
+        self.max_per_seeder = max(1, max_per_seeder)
+        self.scheduler = Scheduler.SCHEDULERS[scheduler](self.seeders, depth)
+        self.endgame = endgame  # Chunks left when duplicate requests start; 0 turns the endgame off
+        self.on_chunk = on_chunk  # Called with (chunk_id, data) for every chunk that arrives and passes verification
+        self.refresh = refresh  # Returns a fresh seeder list from the tracker, or None to never ask again
+        self.log = log
+        self.running = {seeder: 0 for seeder in self.seeders}  # Worker threads per seeder
+        self.workers = {seeder: 0 for seeder in self.seeders}  # Workers connected to each seeder
+        self.breakers = {seeder: CircuitBreaker() for seeder in self.seeders}
+        self.threads = []
+        self.tried = {}  # Chunk id -> seeders that failed it in the current round of retries
+        self.attempts = {}  # Chunk id -> failed deliveries so far
+        self.rounds = {}  # Chunk id -> rounds of retries over every usable seeder so far
+        self.delayed = []  # Heap of (time, chunk id) for chunks waiting out their backoff
+        self.parked = set()  # Chunks waiting for any seeder to become usable again
+        self.inflight = {}  # Chunk id -> [seeder, session, time requested] for every request waiting for an answer
+        self.sessions = set()  # Open sessions, so the ones still busy with lost races can be shut when the download ends
+        self.unsettled = set()
+        self.claimed = set()  # Chunks whose first good copy is being written
+        self.results = {}
+        self.refreshes = 0
+        self.last_refresh = 0.0
+        self.lock = threading.Condition()
+
+        # Endgame metrics
+        self.raced = {}  # Chunk id -> (seeder, time requested) of its first request, for chunks that got duplicates
+        self.duplicates = 0  # Duplicate requests sent
+        self.duplicate_wins = 0  # Raced chunks delivered first by a duplicate request
+        self.cancelled = 0  # Losing requests cancelled at the seeder
+        self.wasted_bytes = 0  # Bytes of losing copies that arrived anyway
+        self.original_done = {}  # Raced chunk won by a duplicate -> when its first request answered, or would have
+        self.interval = {}  # Moving average of seconds between chunks per seeder, to estimate requests that lost
+        self.finished = None
+
+    def run(self, chunk_ids):
+        chunk_ids = list(chunk_ids)
+        if not self.seeders:
+            return {chunk_id: ChunkResult(chunk_id, None, False, 0, "no seeders") for chunk_id in chunk_ids}
+        self.unsettled = set(chunk_ids)
+        self.scheduler.assign(chunk_ids)
+
+        with self.lock:
+            while self.unsettled:
+                now = time.monotonic()
+                self.release_delayed(now)
+                self.spawn_workers(now)
+                if not any(self.running.values()):
+                    # No seeder is being worked on: wait out a cooldown, or ask the tracker for more seeders
+                    if self.refresh is not None and self.refreshes < MAX_TRACKER_REFRESHES \
+                            and now - self.last_refresh >= TRACKER_REFRESH_INTERVAL:
+                        self.refresh_seeders()
+                        continue
+                    if all(breaker.dropped() for breaker in self.breakers.values()) and (
+                            self.refresh is None or self.refreshes >= MAX_TRACKER_REFRESHES):
+                        for chunk_id in list(self.unsettled):
+                            self.settle(chunk_id, None, None, "no seeders left")
+                        break
+                self.lock.wait(self.next_wakeup(now))
+
+            # The download is done once every chunk is settled; sessions still waiting on a lost race are shut down
+            # rather than waited for
+            self.finished = time.monotonic()
+            self.lock.notify_all()
+            busy = [session for session in self.sessions if session.outstanding]
+        for session in busy:
+            session.abort()
+        for thread in self.threads:
+            thread.join()
+        return self.results
+
+    # Start workers for every seeder whose backoff or cooldown has passed, one per seeder before any seeder gets
+    # another, up to the overall limit. Chunks still queued for a seeder left without a worker would never be
+    # requested, so they go to the seeders that have one. The caller holds the lock
+    def spawn_workers(self, now):
+        for level in range(self.max_per_seeder):
+            for seeder in self.seeders:
+                breaker = self.breakers[seeder]
+                if sum(self.running.values()) >= self.max_workers:
+                    break
+                if self.running[seeder] <= level and not breaker.dropped() and now >= breaker.retry_at:
+                    self.running[seeder] += 1
+                    thread = threading.Thread(target=self.work, args=(seeder,), daemon=True)
+                    self.threads.append(thread)
+                    thread.start()
+        for seeder in self.seeders:
+            if not self.running[seeder]:
+                for chunk_id in self.scheduler.release(seeder):
+                    self.place(chunk_id)
+
+    # How long the supervisor may sleep before a delayed chunk, a backoff or a cooldown is due
+    def next_wakeup(self, now):
+        due = [breaker.retry_at for breaker in self.breakers.values() if not breaker.dropped() and breaker.retry_at > now]
+        if self.delayed:
+            due.append(self.delayed[0][0])
+        return min(1.0, max(0.01, min(due, default=now + 1.0) - now))
+
+    # Ask the tracker for the seeders of the file again and add the ones this download does not know yet.
+    # Seeders that were dropped get another chance if the tracker still lists them. The caller holds the lock
+    def refresh_seeders(self):
+        self.refreshes += 1
+        self.last_refresh = time.monotonic()
+        self.log(f"No seeders left to download from, asking the tracker again ({self.refreshes}/{MAX_TRACKER_REFRESHES})")
+        self.lock.release()
+        try:
+            fresh = self.refresh() or []
+        except OSError as e:
+            self.log(f"Tracker refresh failed: {e}")
+            fresh = []
+        finally:
+            self.lock.acquire()
+        for seeder in fresh:
+            if seeder not in self.breakers:
+                self.seeders.append(seeder)
+                self.scheduler.add(seeder)
+                self.running[seeder] = 0
+                self.workers[seeder] = 0
+                self.breakers[seeder] = CircuitBreaker()
+                self.log(f"New seeder {seeder} joined the download")
+            elif self.breakers[seeder].dropped() and not self.running[seeder]:
+                self.breakers[seeder] = CircuitBreaker()
+
+    # A seeder that can take requests right now; the caller holds the lock
+    def usable(self, seeder, now):
+        return self.workers[seeder] > 0 and not self.breakers[seeder].is_open(now)
+
+    # Next job for a seeder's worker. With wait set, block until a job arrives or every chunk is settled;
+    # returns None when there is nothing to do or the seeder's breaker has tripped
+    def next_job(self, seeder, wait, session=None):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.breakers[seeder].is_open(now) or self.finished is not None:
+                    return None
+                self.release_delayed(now)
+                chunk_id = self.scheduler.next_job(seeder)
+                if chunk_id is None:
+                    chunk_id = self.endgame_job(seeder)
+                if chunk_id is not None:
+                    self.inflight.setdefault(chunk_id, []).append([seeder, session, now])
+                    if self.endgame and len(self.unsettled) <= self.endgame and not self.scheduler.pending():
+                        self.lock.notify_all()  # The last queued chunk is out; idle workers can start racing
+                    return chunk_id
+                if not wait or not self.unsettled:
+                    return None
+                self.lock.wait(self.next_wakeup(now))
+
+    # In the endgame, a chunk in flight on other seeders only, preferring the one with the fewest and oldest requests;
+    # the caller holds the lock
+    def endgame_job(self, seeder):
+        if (not self.endgame or len(self.unsettled) > self.endgame or self.scheduler.pending() or self.delayed
+                or self.parked):
+            return None
+        best = None
+        for chunk_id in self.unsettled:
+            requests = self.inflight.get(chunk_id)
+            if (not requests or chunk_id in self.claimed or seeder in self.tried.get(chunk_id, ())
+                    or any(request[0] == seeder for request in requests)):
+                continue
+            rank = (len(requests), requests[0][2])
+            if best is None or rank < best[0]:
+                best = (rank, chunk_id)
+        if best is None:
+            return None
+        chunk_id = best[1]
+        first = self.inflight[chunk_id][0]
+        self.raced.setdefault(chunk_id, (first[0], first[2]))
+        self.duplicates += 1
+        return chunk_id
+
+    # Forget the request of a chunk that was answered or lost; returns when it was sent, or None if it was not
+    # in flight. The caller holds the lock
+    def landed(self, chunk_id, seeder, session):
+        requests = self.inflight.get(chunk_id, [])
+        for request in requests:
+            if request[0] == seeder and request[1] is session:
+                requests.remove(request)
+                if not requests:
+                    del self.inflight[chunk_id]
+                return request[2]
+        return None
+
+    # Record the final outcome of a chunk; the caller holds the lock
+    def settle(self, chunk_id, seeder, data, error=None):
+        self.unsettled.discard(chunk_id)
+        self.results[chunk_id] = ChunkResult(chunk_id, seeder, data is not None, len(data) if data else 0, error)
+        if len(self.unsettled) <= self.endgame or error:
+            self.lock.notify_all()  # Idle workers may join the endgame, or stop once nothing is left
+
+    # Pipeline depth the scheduler currently allows a seeder's session
+    def depth(self, seeder):
+        with self.lock:
+            return self.scheduler.depth(seeder)
+
+    def measure(self, seeder, size, latency, interval):
+        with self.lock:
+            self.scheduler.record(seeder, size, latency, interval)
+            self.interval[seeder] = Scheduler.average(self.interval.get(seeder), interval)
+
+    def complete(self, chunk_id, seeder, data, session=None):
+        arrived = time.monotonic()
+        with self.lock:
+            sent = self.landed(chunk_id, seeder, session)
+            if chunk_id not in self.unsettled or chunk_id in self.claimed:
+                # The losing copy of a raced chunk: its arrival shows how long the race saved
+                if data:
+                    self.wasted_bytes += len(data)
+                    if chunk_id in self.original_done and (seeder, sent) == self.raced[chunk_id]:
+                        self.original_done[chunk_id] = arrived
+                return
+        if not data:
+            self.seeder_error(seeder, "could not send a chunk")
+            self.retry(chunk_id, seeder, "seeder reported an error")
+            return
+        if self.hashes is not None and hashlib.sha256(data).digest() != self.hashes[chunk_id]:
+            self.log(f"Chunk {chunk_id} from {seeder} does not match the manifest")
+            self.seeder_error(seeder, "sent a corrupt chunk")
+            self.retry(chunk_id, seeder, "hash mismatch")
+            return
+        with self.lock:
+            self.breakers[seeder].success()
+            if chunk_id not in self.unsettled or chunk_id in self.claimed:
+                return
+            self.claimed.add(chunk_id)
+        if self.on_chunk:
+            self.on_chunk(chunk_id, data)
+
+        with self.lock:
+            self.claimed.discard(chunk_id)
+            self.settle(chunk_id, seeder, data)
+            losers = self.inflight.pop(chunk_id, [])
+            if chunk_id in self.raced and (seeder, sent) != self.raced[chunk_id]:
+                self.duplicate_wins += 1
+                # Until the first request answers, estimate it from the requests queued ahead of it on its
+                # session and that seeder's usual time between chunks
+                for loser, loser_session, loser_sent in losers:
+                    if (loser, loser_sent) == self.raced[chunk_id]:
+                        try:
+                            ahead = loser_session.outstanding.index(chunk_id) if loser_session else 0
+                        except ValueError:
+                            ahead = 0
+                        self.original_done[chunk_id] = arrived + (ahead + 1) * self.interval.get(loser, 0)
+        for loser, loser_session, _ in losers:
+            if loser_session is not None and loser_session.cancel(self.file_name, chunk_id, self.piece_size):
+                self.cancelled += 1
+
+    # Count a failure against a seeder's breaker
+    def seeder_error(self, seeder, reason):
+        with self.lock:
+            if self.breakers[seeder].failure(time.monotonic()):
+                self.log(f"Seeder {seeder} {reason} too often, leaving it alone for a while")
+                self.lock.notify_all()
+
+    # A chunk failed on a seeder: fail it over to a usable seeder that has not failed it yet, or once every usable
+    # seeder has, retry it on all of them after a backoff. Gives up after MAX_CHUNK_ATTEMPTS failed deliveries
+    def retry(self, chunk_id, seeder, error, session=None):
+        with self.lock:
+            self.landed(chunk_id, seeder, session)
+            if chunk_id not in self.unsettled:
+                return
+            self.attempts[chunk_id] = self.attempts.get(chunk_id, 0) + 1
+            self.tried.setdefault(chunk_id, set()).add(seeder)
+            if chunk_id in self.inflight:
+                return  # An endgame duplicate is still on its way
+            if self.attempts[chunk_id] >= MAX_CHUNK_ATTEMPTS:
+                self.log(f"Giving up on chunk {chunk_id} after {self.attempts[chunk_id]} attempts: {error}")
+                self.settle(chunk_id, seeder, None, error)
+                return
+            self.place(chunk_id)
+
+    # Queue a chunk on a usable seeder that has not failed it in this round, or start a new round after a backoff.
+    # While no seeder is usable at all the chunk is parked until one connects; the caller holds the lock
+    def place(self, chunk_id):
+        now = time.monotonic()
+        usable = [seeder for seeder in self.seeders if self.usable(seeder, now)]
+        if not usable:
+            self.parked.add(chunk_id)
+            return
+        tried = self.tried.get(chunk_id, ())
+        candidates = [seeder for seeder in usable if seeder not in tried]
+        if candidates:
+            self.scheduler.requeue(chunk_id, candidates)
+        else:
+            self.tried.pop(chunk_id, None)
+            rounds = self.rounds.get(chunk_id, 0)
+            self.rounds[chunk_id] = rounds + 1
+            heapq.heappush(self.delayed, (now + backoff_delay(rounds), chunk_id))
+        self.lock.notify_all()
+
+    # A worker connected: queue the chunks that were waiting for a usable seeder; the caller holds the lock
+    def connected(self, seeder):
+        self.workers[seeder] += 1
+        parked, self.parked = self.parked, set()
+        for chunk_id in parked:
+            if chunk_id in self.unsettled:
+                self.place(chunk_id)
+
+    # Queue the chunks whose backoff has passed; the caller holds the lock
+    def release_delayed(self, now):
+        while self.delayed and self.delayed[0][0] <= now:
+            _, chunk_id = heapq.heappop(self.delayed)
+            if chunk_id in self.unsettled:
+                self.place(chunk_id)
+
+    # A worker stopped. If its connection failed, the failure counts against the seeder and its in-flight chunks are
+    # retried; once no worker is connected to the seeder its queued chunks go to other seeders
+    def worker_stopped(self, seeder, connected, outstanding=(), error=None, session=None):
+        with self.lock:
+            if connected:
+                self.workers[seeder] -= 1
+            orphaned = self.scheduler.release(seeder) if not self.workers[seeder] else []
+            for chunk_id in orphaned:
+                self.place(chunk_id)
+        if error is not None:
+            self.seeder_error(seeder, "failed")
+            for chunk_id in list(outstanding):
+                self.retry(chunk_id, seeder, error, session)
+
+    # What the endgame did. tail_saved is how much later the download would have finished had every raced chunk
+    # waited for its first request: measured when the first request answered anyway, estimated when it was cancelled
+    def endgame_stats(self):
+        with self.lock:
+            latest = max(self.original_done.values(), default=None)
+            saved = max(0.0, latest - self.finished) if latest is not None and self.finished else 0.0
+            return {"raced": len(self.raced), "duplicates": self.duplicates, "duplicate_wins": self.duplicate_wins,
+                    "cancelled": self.cancelled, "wasted_bytes": self.wasted_bytes, "tail_saved": saved}
+
+    def work(self, seeder):
+        try:
+            self.serve_seeder(seeder)
+        finally:
+            with self.lock:
+                self.running[seeder] -= 1
+                self.lock.notify_all()
+
+    # Download from one seeder until there is nothing left for it, reconnecting after a backoff while its breaker
+    # stays closed
+    def serve_seeder(self, seeder):
+        seeder_ip, seeder_port = seeder.split(',')
+        seeder_port = int(seeder_port)
+        while True:
+            with self.lock:
+                while True:
+                    now = time.monotonic()
+                    breaker = self.breakers[seeder]
+                    if self.finished is not None or not self.unsettled or breaker.is_open(now) or breaker.dropped():
+                        return
+                    if now >= breaker.retry_at:
+                        break
+                    self.lock.wait(breaker.retry_at - now)
+
+            try:
+                session = SeederSession(seeder_ip, seeder_port)
+            except SessionUnsupportedError:
+                self.serve_legacy(seeder, seeder_ip, seeder_port)
+                return
+            except OSError as e:
+                self.log(f"Failed to connect to {seeder_ip}:{seeder_port}: {e}")
+                self.worker_stopped(seeder, False, error=f"could not connect: {e}")
+                continue
+
+            with self.lock:
+                self.connected(seeder)
+                self.sessions.add(session)
+            requested = {}  # Chunk id -> when it was requested, to measure the seeder
+            last_arrival = 0
+            try:
+                while True:
+                    # Keep the pipeline full; only block for new jobs when nothing is in flight on this session
+                    while len(session.outstanding) < self.depth(seeder):
+                        chunk_id = self.next_job(seeder, wait=not session.outstanding, session=session)
+                        if chunk_id is None:
+                            break
+                        requested[chunk_id] = time.monotonic()
+                        session.request(self.file_name, chunk_id, self.piece_size)
+                    if not session.outstanding:
+                        break
+                    chunk_id, data = session.read_chunk()
+                    arrived = time.monotonic()
+                    sent = requested.pop(chunk_id)
+                    if data:
+                        self.measure(seeder, len(data), arrived - sent, arrived - max(sent, last_arrival))
+                    last_arrival = arrived
+                    self.complete(chunk_id, seeder, data, session)
+            except (OSError, ValueError, IndexError) as e:
+                if self.finished is None:
+                    self.log(f"Session with {seeder_ip}:{seeder_port} failed: {e}")
+                    self.worker_stopped(seeder, True, session.outstanding, str(e), session)
+                else:
+                    self.worker_stopped(seeder, True)
+                continue
+            else:
+                self.worker_stopped(seeder, True)
+                return
+            finally:
+                with self.lock:
+                    self.sessions.discard(session)
+                session.close()
+
+    # The seeder only understands single-shot legacy requests, so fetch one connection at a time
+    def serve_legacy(self, seeder, seeder_ip, seeder_port):
+        with self.lock:
+            self.connected(seeder)
+        while (chunk_id := self.next_job(seeder, wait=True)) is not None:
+            started = time.monotonic()
+            data = fetch_piece_legacy(seeder_ip, seeder_port, self.file_name, chunk_id, self.piece_size)
+            if data:
+                elapsed = time.monotonic() - started
+                self.measure(seeder, len(data), elapsed, elapsed)
+            self.complete(chunk_id, seeder, data)
+        self.worker_stopped(seeder, True)
+
+''' 
+Function to download a file into New_<file_name>.
+It asks the tracker for the seeders, fetches the piece manifest and downloads every chunk with the download engine,
+which checks each chunk against the manifest as it arrives.
+Returns the path of the downloaded file (None if nothing was downloaded) and whether every chunk arrived and matched.
+'''
+def fetch_file(file_name, log=print, info=None):
+    info = info or get_seeders_and_chunks(file_name, log)  
+    if not info.seeders:
+        log("No seeders available")
+        return None, False
+
+    # Pick up where an earlier download of the same file stopped, reusing the manifest it verified against
+    new_file = "New_" + file_name 
+    if os.path.dirname(new_file):
+        os.makedirs(os.path.dirname(new_file), exist_ok=True)  # Files of a seeder's library are named by their path in it
+    state = load_resume_state(new_file, info)
+    if state is not None:
+        log(f"Resuming download: {state.completed()} of {info.total_chunks} chunks are already downloaded")
+    else:
+        hashes = None
+        if info.root:
+            hashes = get_manifest(info, log)
+            if hashes is None or len(hashes) != info.total_chunks:
+                log("No seeder sent a piece manifest matching the tracker's root")
+                return None, False
+        else:
+            log("The seeders published no piece manifest, chunks cannot be verified")
+        state = ResumeState(new_file, info, hashes)
     
     ''' 
-    Loop through seeders and start threads for downloading their assigned chunks.
-    Each thread will call the download_chunk method for the specific chunk.
+    The download engine assigns the missing chunks to the available seeders and fetches them with a bounded pool of workers,
+    each keeping a single session open with its seeder and pipelining the chunk requests on it.
     '''
-    for seeder, chunks in seeder_chunks.items():
-        seeder_ip, seeder_port = seeder.split(',')  
-        seeder_port = int(seeder_port)  
-    
-        ''' 
-        Start threads for downloading chunks.
-        Each chunk will be downloaded by a separate thread to speed up the process.
-        '''    
-        for chunk_id in chunks:
-            thread = threading.Thread(target=download_chunk, args=(seeder_ip, seeder_port, file_name, chunk_id))
-            thread.start()  
-            threads.append(thread) 
-
-    # Wait for all threads to finish
-    for thread in threads:
-        thread.join()
-    
-    # Combine all downloaded chunks into the final file
-    new_file = "New_" + file_name 
-    with open(f"{new_file}", 'wb') as final_file:
-        for chunk_id in range(total_chunks):
-            chunk_filename = f"chunk_{chunk_id}"
-            if os.path.exists(chunk_filename):
-                with open(chunk_filename, 'rb') as chunk_file:
-                    final_file.write(chunk_file.read())
-    # Clean up the downloaded chunk files 
-    for chunk_id in range(total_chunks):
-        chunk_filename = f"chunk_{chunk_id}"
-        if os.path.exists(chunk_filename):
-            os.remove(chunk_filename)   
-    print(f"All chunks are downloaded")
-    
-    # Compare the hashes of the original and downloaded files to verify integrity
-    original_file_hash = get_file_hash(file_name)
-    downloaded_file_hash = get_file_hash(new_file)
+    # Every chunk is written straight into the final file as it arrives, then recorded in the resume file
+    # The missing chunks are requested rarest first, by the availability the tracker reported
+    missing = rarest_first(state.missing(), info.availability)
+    output = OutputFile(new_file, info.total_chunks, info.piece_size, state.file_size, resume=len(missing) < info.total_chunks)
+    state.output = output
+    peer_id = os.urandom(8).hex()  # Identifies this download's piece reports to the tracker
+    state.on_flush = lambda bitfield: report_pieces(info, bitfield, peer_id)
+    state.flush()  # Replaces any resume file left over from a download that cannot be resumed
+
+    def store(chunk_id, data):
+        output.write_chunk(chunk_id, data)
+        state.mark(chunk_id, len(data))
+
+    log(f"Assigning chunks to available seeders")
+    # If every seeder fails mid-download, the engine asks the tracker for the seeders of the same file again
+    def refresh():
+        fresh = get_seeders_and_chunks(file_name, log)
+        if (fresh.root, fresh.piece_size, fresh.total_chunks) != (info.root, info.piece_size, info.total_chunks):
+            return []
+        return fresh.seeders
+
+    engine = DownloadEngine(file_name, info.seeders, info.piece_size, state.hashes, on_chunk=store, log=log,
+                            refresh=refresh)
+    try:
+        results = engine.run(missing)
+        state.flush()
+    finally:
+        output.close()
+    endgame = engine.endgame_stats()
+    if endgame["raced"]:
+        log(f"Endgame: raced {endgame['raced']} chunks with {endgame['duplicates']} duplicate requests, "
+            f"{endgame['duplicate_wins']} won by a duplicate, about {endgame['tail_saved']:.2f} s saved")
+    failed = sorted(chunk_id for chunk_id, result in results.items() if not result.ok)
+    if failed:
+        log(f"{len(failed)} of {info.total_chunks} chunks failed to download: {failed[:10]}")
+        log(f"The {info.total_chunks - len(failed)} downloaded chunks are kept, download the file again to resume")
+        return new_file, False
+    state.remove()
+    report_pieces(info, None, peer_id)
+    log(f"All chunks are downloaded")
+    return new_file, True
+
+''' 
+Function to download the full file by fetching its chunks from different seeders.
+This function uses fetch_file to retrieve and verify the chunks concurrently.
+Several comma-separated file names are looked up together and downloaded one after the other.
+'''
+def download_file(file_name):
+    file_names = [name.strip() for name in file_name.split(',') if name.strip()]
+    if len(file_names) > 1:
+        infos = get_many_seeders(file_names)
+        outcomes = [fetch_file(name, info=infos[name]) for name in file_names]
+        complete = all(done for _, done in outcomes)
+    else:
+        new_file, complete = fetch_file(file_name)
     
-    if original_file_hash == downloaded_file_hash:
-        print(f"File download and reconstruction successful. Hashes match.")
+    if complete:
+        print(f"File download and reconstruction successful.")
         print(f" Transitioning to a Seeder...")
         
         # Call the Seeder to transition Leecher to Seeder after downloading
         Seeder.main()  
        
     else:
-        print("Hashes do not match. File might be corrupted. Please re-download.")
+        print("The file could not be downloaded completely. Please re-download.")
 
 ''' 
 Main function to start the download process and prompt the user to enter the filename.
-The function repeatedly asks for the filename until a valid file is provided.
+The function repeatedly asks for the filename until one is entered; several can be entered separated by commas.
 '''
 def main():
     while True:
-        try:
-            file_name = input("Enter the filename: \n")
-            if not os.path.exists(file_name):
-                raise FileNotFoundError(f"The file '{file_name}' does not exist.")        
+        file_name = input("Enter the filename (or several, separated by commas): \n").strip()
+        if file_name:
             download_file(file_name)  
             break
-        except FileNotFoundError :
-                print(f"File not found.")        
+        print(f"Please enter a file name.")        
 
 if __name__ == "__main__":
     main()
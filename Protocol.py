@@ -0,0 +1,211 @@
+'''
+Protocol helpers shared by the Tracker, Seeder and Leecher.
+The piece size of a file is picked here from the file's size, so every peer splits a file the same way,
+and a file's piece manifest is hashed here, so every peer computes the same root for it.
+The binary form of the tracker's file lookup is packed and unpacked here too, along with the batching limits of
+multi-file lookups and bulk announces.
+'''
+
+import hashlib
+import socket
+import struct
+
+LEGACY_CHUNK_SIZE = 1024  # Piece size of peers that predate per-file piece sizes
+MIN_PIECE_SIZE = 16 * 1024  # Smallest piece size the policy picks
+MAX_PIECE_SIZE = 4 * 1024 * 1024  # Largest piece size the policy picks, and the largest a seeder will serve
+TARGET_PIECES = 1024  # The policy grows the piece size until a file has at most this many pieces
+
+
+'''
+Function to pick the piece size for a file: the smallest power of two between MIN_PIECE_SIZE and MAX_PIECE_SIZE
+that splits the file into at most TARGET_PIECES pieces. Files above MAX_PIECE_SIZE * TARGET_PIECES get more pieces.
+'''
+def piece_size_for(file_size):
+    piece_size = MIN_PIECE_SIZE
+    while piece_size < MAX_PIECE_SIZE and piece_size * TARGET_PIECES < file_size:
+        piece_size *= 2
+    return piece_size
+
+
+# Number of pieces a file of file_size bytes is split into
+def total_pieces(file_size, piece_size):
+    return -(-file_size // piece_size)
+
+
+# A piece size a seeder will honour: a power of two from the legacy chunk size up to MAX_PIECE_SIZE
+def valid_piece_size(piece_size):
+    return LEGACY_CHUNK_SIZE <= piece_size <= MAX_PIECE_SIZE and piece_size & (piece_size - 1) == 0
+
+
+'''
+Function to hash every piece of a file. The manifest of a file is the list of its piece digests (SHA-256, 32 bytes each)
+and its root is the hex SHA-256 of the concatenated digests, which is what seeders publish through the tracker.
+'''
+def piece_hashes(file_path, piece_size):
+    digests = []
+    with open(file_path, 'rb') as file:
+        while piece := file.read(piece_size):
+            digests.append(hashlib.sha256(piece).digest())
+    return digests
+
+
+# Root of a manifest given as the concatenated piece digests
+def manifest_root(manifest):
+    return hashlib.sha256(manifest).hexdigest()
+
+
+'''
+Binary tracker lookup. Every binary message starts with HEADER: the magic bytes (a NUL byte, which never starts a text
+message), the protocol version, the action and a transaction ID that the answer repeats.
+LOOKUP  - header, LOOKUP_FIELDS (index of the first peer wanted, most peers wanted), then the UTF-8 file name
+PEERS   - header, PEERS_FIELDS, one 6-byte PEER (IPv4 address, port) per peer in this page, then one availability byte
+          per piece if FLAG_AVAILABILITY is set. A large swarm is read in pages by asking again from the next index.
+FAILURE - header, then a UTF-8 reason
+LOOKUP_MANY - header, most peers wanted per file, then the UTF-8 file names separated by newlines
+PEERS_MANY  - header, number of entries, then per file an ENTRY (found, name length), the name and, if it was found,
+              the length and body of the first page of its swarm as a PEERS answer would carry it. Files that did not
+              fit in the datagram are left out and asked for again.
+'''
+TRACKER_MAGIC = b"\x00P"
+TRACKER_VERSION = 1
+LOOKUP, PEERS, FAILURE, LOOKUP_MANY, PEERS_MANY = 1, 2, 3, 4, 5
+HEADER = struct.Struct("!2sBBI")  # Magic, version, action, transaction ID
+LOOKUP_FIELDS = struct.Struct("!IH")  # Index of the first peer wanted, most peers wanted
+PEERS_FIELDS = struct.Struct("!IIQ32sIIHB")  # Pieces, piece size, file size, manifest root, peers in the swarm,
+                                             # index of the first peer in this page, peers in this page, flags
+PEER = struct.Struct("!4sH")
+COUNT = struct.Struct("!H")  # Most peers wanted per file in a LOOKUP_MANY, entries in a PEERS_MANY
+ENTRY = struct.Struct("!BH")  # Whether the file was found, length of its name
+LENGTH = struct.Struct("!I")  # Length of a page body in a PEERS_MANY
+FLAG_ROOT = 1  # The root field holds the file's manifest root
+FLAG_AVAILABILITY = 2  # Per-piece availability follows the peers
+MAX_DATAGRAM = 65507  # Largest UDP payload over IPv4
+BATCH_BYTES = 1400  # Largest batch request or bulk announce datagram, so it fits an Ethernet frame without fragmenting
+
+
+# Whether a tracker message uses the binary protocol
+def is_binary(message):
+    return message[:2] == TRACKER_MAGIC
+
+
+def pack_lookup(transaction, file_name, first=0, numwant=0xFFFF):
+    return HEADER.pack(TRACKER_MAGIC, TRACKER_VERSION, LOOKUP, transaction) + LOOKUP_FIELDS.pack(first, numwant) + file_name.encode()
+
+
+# (action, transaction ID, rest of the message); raises ValueError for a message of another protocol version
+def unpack_header(message):
+    magic, version, action, transaction = HEADER.unpack_from(message)
+    if magic != TRACKER_MAGIC or version != TRACKER_VERSION:
+        raise ValueError(f"unsupported tracker protocol version {version}")
+    return action, transaction, message[HEADER.size:]
+
+
+# (first, numwant, file name) of a lookup's body
+def unpack_lookup(body):
+    first, numwant = LOOKUP_FIELDS.unpack_from(body)
+    return first, numwant, body[LOOKUP_FIELDS.size:].decode()
+
+
+# The 6-byte entry of a peer at an IPv4 address
+def pack_peer(ip, port):
+    return PEER.pack(socket.inet_aton(ip), int(port))
+
+
+'''
+Function to pack one page of a lookup answer. peers is the page as pack_peer() entries, first is the index of its first
+peer in the swarm of total peers. root is the hex manifest root or None, availability the per-piece counts or None.
+'''
+def pack_peers(transaction, total_chunks, piece_size, file_size, root, total, first, peers, availability=None):
+    flags = (FLAG_ROOT if root else 0) | (FLAG_AVAILABILITY if availability else 0)
+    fields = PEERS_FIELDS.pack(total_chunks, piece_size, file_size, bytes.fromhex(root) if root else bytes(32),
+                               total, first, len(peers), flags)
+    return (HEADER.pack(TRACKER_MAGIC, TRACKER_VERSION, PEERS, transaction) + fields + b"".join(peers)
+            + (availability or b""))
+
+
+# Most peers a page can carry next to the fixed fields and availability_size bytes of availability
+def page_capacity(availability_size):
+    return (MAX_DATAGRAM - HEADER.size - PEERS_FIELDS.size - availability_size) // PEER.size
+
+
+# A page's fields as a dictionary, with its peers as "ip,port" strings like the text protocol's
+def unpack_peers(body):
+    total_chunks, piece_size, file_size, root, total, first, count, flags = PEERS_FIELDS.unpack_from(body)
+    offset = PEERS_FIELDS.size
+    peers = []
+    for _ in range(count):
+        ip, port = PEER.unpack_from(body, offset)
+        peers.append(f"{socket.inet_ntoa(ip)},{port}")
+        offset += PEER.size
+    return {"chunks": total_chunks, "piece": piece_size, "size": file_size,
+            "root": root.hex() if flags & FLAG_ROOT else None, "total": total, "first": first, "peers": peers,
+            "avail": list(body[offset:offset + total_chunks]) if flags & FLAG_AVAILABILITY else None}
+
+
+def pack_lookup_many(transaction, file_names, numwant=0xFFFF):
+    return (HEADER.pack(TRACKER_MAGIC, TRACKER_VERSION, LOOKUP_MANY, transaction) + COUNT.pack(numwant)
+            + "\n".join(file_names).encode())
+
+
+# (numwant, file names) of a multi-file lookup's body
+def unpack_lookup_many(body):
+    numwant, = COUNT.unpack_from(body)
+    return numwant, body[COUNT.size:].decode().split("\n")
+
+
+# One PEERS_MANY entry: the file name and the body of its first page, or None if the tracker does not know the file
+def pack_entry(file_name, page):
+    name = file_name.encode()
+    if page is None:
+        return ENTRY.pack(0, len(name)) + name
+    return ENTRY.pack(1, len(name)) + name + LENGTH.pack(len(page)) + page
+
+
+def pack_peers_many(transaction, entries):
+    return HEADER.pack(TRACKER_MAGIC, TRACKER_VERSION, PEERS_MANY, transaction) + COUNT.pack(len(entries)) + b"".join(entries)
+
+
+# {file name: unpack_peers() page, or None if the tracker does not know the file} of a multi-file answer's body
+def unpack_peers_many(body):
+    count, = COUNT.unpack_from(body)
+    offset = COUNT.size
+    pages = {}
+    for _ in range(count):
+        found, name_length = ENTRY.unpack_from(body, offset)
+        offset += ENTRY.size
+        file_name = body[offset:offset + name_length].decode()
+        offset += name_length
+        pages[file_name] = None
+        if found:
+            page_length, = LENGTH.unpack_from(body, offset)
+            offset += LENGTH.size
+            pages[file_name] = unpack_peers(body[offset:offset + page_length])
+            offset += page_length
+    return pages
+
+
+'''
+Function to split entries (strings) into batches whose entries, joined by a one-byte separator, encode to at most limit
+bytes, for requests and announces that would not fit in one datagram. An entry longer than the limit gets a batch of its own.
+'''
+def batch_entries(entries, limit=BATCH_BYTES):
+    batches, batch, size = [], [], 0
+    for entry in entries:
+        length = len(entry.encode())
+        if batch and size + 1 + length > limit:
+            batches.append(batch)
+            batch, size = [], 0
+        size += length + (1 if batch else 0)
+        batch.append(entry)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# A packed answer with its transaction ID replaced, so one encoded answer can be sent to many requests
+def with_transaction(message, transaction):
+    return HEADER.pack(TRACKER_MAGIC, TRACKER_VERSION, message[3], transaction) + message[HEADER.size:]
+
+
+def pack_failure(transaction, reason):
+    return HEADER.pack(TRACKER_MAGIC, TRACKER_VERSION, FAILURE, transaction) + reason.encode()
@@ -0,0 +1,152 @@
+'''
+Chunk schedulers for the Leecher download engine.
+A scheduler decides which seeder every chunk is requested from and how many requests each seeder session keeps in flight.
+The engine calls every method while holding its own lock, so schedulers keep no locks of their own.
+
+roundrobin - chunk i goes to seeders[i % len(seeders)] up front and every session keeps the same pipeline depth
+adaptive   - starts like roundrobin, then measures each seeder's throughput and latency, gives faster seeders deeper
+             pipelines and lets a seeder that runs out of chunks steal queued chunks from the seeder that will take
+             longest to finish its queue
+'''
+
+from collections import deque
+
+MIN_DEPTH = 2  # Shallowest pipeline the adaptive scheduler gives a slow seeder
+MAX_DEPTH = 64  # Deepest pipeline the adaptive scheduler gives a fast seeder
+SMOOTHING = 0.3  # Weight of the newest sample in the moving averages of throughput and latency
+
+
+class RoundRobinScheduler:
+    def __init__(self, seeders, depth):
+        self.seeders = list(seeders)
+        self.base_depth = depth
+        self.jobs = {seeder: deque() for seeder in self.seeders}  # Chunks waiting to be requested, per seeder
+        self.stolen = 0
+
+    # A seeder that joined the download after it started
+    def add(self, seeder):
+        self.seeders.append(seeder)
+        self.jobs[seeder] = deque()
+
+    # Distribute the chunks to the seeders before the download starts
+    def assign(self, chunk_ids):
+        for index, chunk_id in enumerate(chunk_ids):
+            self.jobs[self.seeders[index % len(self.seeders)]].append(chunk_id)
+
+    # Next chunk a seeder's session should request, or None if it has nothing to do right now
+    def next_job(self, seeder):
+        if self.jobs[seeder]:
+            return self.jobs[seeder].popleft()
+        return None
+
+    # Put a chunk that failed elsewhere in front of the other jobs of the least loaded candidate seeder
+    def requeue(self, chunk_id, candidates):
+        target = min(candidates, key=lambda seeder: len(self.jobs[seeder]))
+        self.jobs[target].appendleft(chunk_id)
+
+    # Number of chunks still waiting to be requested
+    def pending(self):
+        return sum(len(queue) for queue in self.jobs.values())
+
+    # The seeder lost its last connection; hand back the chunks still queued for it
+    def release(self, seeder):
+        orphaned = list(self.jobs[seeder])
+        self.jobs[seeder].clear()
+        return orphaned
+
+    # A chunk of size bytes arrived latency seconds after it was requested, interval seconds after the session's
+    # previous chunk (or after the request, if the session was idle)
+    def record(self, seeder, size, latency, interval):
+        pass
+
+    def depth(self, seeder):
+        return self.base_depth
+
+    # Per-seeder measurements, for logs and benchmarks
+    def stats(self):
+        return {}
+
+
+class AdaptiveScheduler(RoundRobinScheduler):
+    def __init__(self, seeders, depth):
+        super().__init__(seeders, depth)
+        self.rate = {seeder: None for seeder in self.seeders}  # Moving average of bytes per second
+        self.latency = {seeder: None for seeder in self.seeders}  # Moving average of seconds from request to chunk
+        self.chunk_size = 1  # Moving average of the chunk size, to turn queue lengths into bytes
+        self.allowed = {}  # Requeued chunk id -> the seeders that may still be asked for it
+
+    def add(self, seeder):
+        super().add(seeder)
+        self.rate[seeder] = None
+        self.latency[seeder] = None
+
+    def next_job(self, seeder):
+        if not self.jobs[seeder]:
+            self.steal(seeder)
+        chunk_id = super().next_job(seeder)
+        self.allowed.pop(chunk_id, None)
+        return chunk_id
+
+    def requeue(self, chunk_id, candidates):
+        target = min(candidates, key=lambda seeder: self.backlog(seeder))
+        self.jobs[target].appendleft(chunk_id)
+        self.allowed[chunk_id] = set(candidates)
+
+    # Take chunks from the back of the queue that will take longest to drain. The thief takes the share of that queue
+    # it would finish in the time the owner needs for the rest, so neither of them ends up holding up the download.
+    # Chunks the thief has already failed to deliver stay where they are
+    def steal(self, thief):
+        victims = [seeder for seeder in self.seeders if seeder != thief and self.jobs[seeder]]
+        for victim in sorted(victims, key=self.backlog, reverse=True):
+            queue = self.jobs[victim]
+            share = self.speed(thief) / (self.speed(thief) + self.speed(victim))
+            wanted = max(1, int(len(queue) * share))
+            taken, kept = [], deque()
+            while queue and len(taken) < wanted:
+                chunk_id = queue.pop()
+                if thief in self.allowed.get(chunk_id, (thief,)):
+                    taken.append(chunk_id)
+                else:
+                    kept.appendleft(chunk_id)
+            queue.extend(kept)
+            for chunk_id in taken:
+                self.jobs[thief].appendleft(chunk_id)
+            self.stolen += len(taken)
+            if taken:
+                return
+
+    def record(self, seeder, size, latency, interval):
+        self.rate[seeder] = average(self.rate[seeder], size / max(interval, 1e-6))
+        self.latency[seeder] = average(self.latency[seeder], latency)
+        self.chunk_size = average(self.chunk_size, size)
+
+    # Measured throughput, or the mean of the measured seeders until this one has delivered a chunk
+    def speed(self, seeder):
+        if self.rate[seeder] is not None:
+            return self.rate[seeder]
+        measured = [rate for rate in self.rate.values() if rate is not None]
+        return sum(measured) / len(measured) if measured else 1.0
+
+    # Seconds the seeder needs to work through the chunks queued for it
+    def backlog(self, seeder):
+        return len(self.jobs[seeder]) * self.chunk_size / self.speed(seeder)
+
+    # Scale the pipeline depth with the seeder's throughput relative to the average seeder
+    def depth(self, seeder):
+        measured = [rate for rate in self.rate.values() if rate is not None]
+        if self.rate[seeder] is None or not measured:
+            return self.base_depth
+        relative = self.rate[seeder] * len(measured) / sum(measured)
+        return min(MAX_DEPTH, max(MIN_DEPTH, round(self.base_depth * relative)))
+
+    def stats(self):
+        return {seeder: {"rate": self.rate[seeder], "latency": self.latency[seeder], "depth": self.depth(seeder)}
+                for seeder in self.seeders}
+
+
+# Exponential moving average; the first sample starts the average
+def average(current, sample):
+    return sample if current is None else current + SMOOTHING * (sample - current)
+
+
+SCHEDULERS = {"roundrobin": RoundRobinScheduler, "adaptive": AdaptiveScheduler}
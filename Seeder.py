@@ -1,7 +1,22 @@
 import socket
+import selectors
+import errno
+import mmap
+from collections import OrderedDict, deque
 import threading
+import queue
 import os
+import sys
+import json
 import time
+import math
+import string
+import Protocol
+
+try:
+    import fcntl    #not available on Windows, where the peer ID file is not locked
+except ImportError:
+    fcntl = None
 
 
 #Tracker details and the format used
@@ -9,44 +24,1115 @@ trackerIP = "127.0.0.1"
 trackerPortNum = 6000
 format = 'utf-8'
 
-def handlingClient(connectionSock, addr):
+SESSION_HELLO = b"SESSION\n"   #first line sent by leechers that want a persistent connection
+SESSION_WELCOME = b"SESSION OK CANCEL\n"   #the seeder's answer, listing the optional requests it understands
+
+SERVER_MODE = "eventloop"   #"eventloop" serves every leecher from one thread, "threaded" starts a thread per connection
+LISTEN_BACKLOG = 1024   #pending connections the event loop server lets the OS queue
+MAX_PENDING_OUTPUT = 256 * 1024   #bytes queued for one leecher before the event loop stops reading its requests
+MAX_REQUEST_LINE = 4096   #longest request line accepted before the connection is dropped
+USE_SENDFILE = hasattr(os, "sendfile")   #send chunks straight from the page cache where the OS supports it
+SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS}   #sendfile errors that mean this file or socket cannot use it, so the connection sends from the mapping instead
+FILE_CACHE_SIZE = 64    #shared files kept open and mapped at the same time
+FILE_CACHE_REVALIDATE = 1.0     #seconds a cached file's size and mtime are trusted before being checked again
+MANIFEST_CACHE_BYTES = 8 * 1024 * 1024   #piece digests kept in memory; the least recently used manifests are dropped first
+MANIFEST_WORKERS = 2    #threads that hash manifests for the event loop server, so a large file never holds up the loop
+ANNOUNCE_TIMEOUT = 5   #seconds to wait for the tracker to acknowledge one announce datagram
+ANNOUNCE_RETRIES = 3   #times an unacknowledged announce datagram is sent again before registration fails
+LIBRARY_CACHE = ".seeder_library.json"   #stat and hash cache of a published library, kept in the library's folder
+LIBRARY_DIGESTS = ".seeder_library.digests"   #piece digests of a published library's files, next to its cache
+PEER_ID_FILE = ".seeder_peer_id"   #the seeder's peer ID, kept in the library's folder or the folder the seeder runs in
+LIBRARY_POLL_INTERVAL = 10   #seconds between scans of a published library for changes
+LIBRARY_SETTLE = 2   #seconds a file must go unmodified before it is published, so a file being copied in is not hashed half-written
+UPLOAD_RATE_LIMIT = 0   #bytes per second that may be sent to all leechers together, 0 for no limit; setUploadLimit changes it while serving
+UPLOAD_BURST = 256 * 1024   #bytes that may go out at once after the upload has been idle
+DRR_QUANTUM = 64 * 1024   #bytes added on every turn of a leecher in the event loop to what it may be sent
+
+peerId = None   #identifies this seeder to the tracker, even after a restart from another address; see identify()
+peerIdFile = None   #the peer ID file, held open and locked for as long as the seeder runs
+announced = {}   #file name -> entry of every file the tracker was told about, to announce again on a resync
+announceVersion = 0   #number of the last change to the file list sent to the tracker
+trackerLock = threading.RLock()   #heartbeats and changes share the tracker socket, so one exchange at a time
+uploaded = {}   #(leecher IP, port) -> bytes sent on that connection, while it is open
+uploadedTotal = 0   #bytes sent to every leecher since the seeder started, closed connections included
+uploadLock = threading.Lock()   #the threaded server's threads count their uploads at the same time
+
+
+def loadPeerId(folder):
+    """
+    returns the peer ID kept in a folder's PEER_ID_FILE, writing a new one there on the first run:
+     -the file stays locked while the seeder runs, so a second seeder started in the same folder picks an ID of its own
+      instead of being taken for the first one
+     -if the file cannot be used the ID only lasts this run
+    """
+    global peerIdFile
+    try:
+        idFile = open(os.path.join(folder, PEER_ID_FILE), "a+", encoding=format)
+    except OSError:
+        return os.urandom(8).hex()
+    try:
+        if fcntl:
+            fcntl.flock(idFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        idFile.seek(0)
+        saved = idFile.read().strip()
+        if len(saved) == 16 and all(char in string.hexdigits for char in saved):
+            peerIdFile = idFile
+            return saved
+        newId = os.urandom(8).hex()
+        idFile.seek(0)
+        idFile.truncate()
+        idFile.write(newId + "\n")
+        idFile.flush()
+        os.fsync(idFile.fileno())
+        peerIdFile = idFile
+        return newId
+    except OSError:
+        idFile.close()  #locked by another seeder, or not writable
+        return os.urandom(8).hex()
+
+
+def identify(folder="."):
+    """
+    picks this seeder's peer ID from a folder the first time it is needed, and returns it
+    """
+    global peerId
+    if peerId is None:
+        peerId = loadPeerId(folder)
+    return peerId
+
+
+class OpenFile:
+    """
+    a shared file held open with a read-only mapping of its contents
+    """
+    __slots__ = ("file_name", "file", "mapping", "size", "mtime", "checked")
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, "rb")
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        #an empty file cannot be mapped, and has no chunks to serve anyway
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.checked = time.monotonic()
+
+    def slice(self, offset, length):
+        return memoryview(self.mapping)[offset:offset + length]
+
+
+class FileCache:
+    """
+    keeps recently requested shared files open and mapped, so serving a chunk does not open, seek and close the file:
+     -at most `capacity` files are kept, the least recently used one is evicted first
+     -a file whose size or modification time has changed is reopened, checked at most every `revalidate` seconds
+     -an evicted file is closed once the last request still sending from it lets go of it
+    """
+
+    def __init__(self, capacity=FILE_CACHE_SIZE, revalidate=FILE_CACHE_REVALIDATE):
+        self.capacity = capacity
+        self.revalidate = revalidate
+        self.files = OrderedDict()   #file name -> OpenFile, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_name):
+        """
+        returns the OpenFile for a shared file, raises OSError if it cannot be opened
+        """
+        with self.lock:
+            entry = self.files.get(file_name)
+            now = time.monotonic()
+            if entry and now - entry.checked >= self.revalidate:
+                try:
+                    stat = os.stat(pathOf(file_name))
+                except OSError:
+                    stat = None
+                if stat and stat.st_size == entry.size and stat.st_mtime_ns == entry.mtime:
+                    entry.checked = now
+                else:
+                    del self.files[file_name]   #the file changed or disappeared
+                    entry = None
+
+            if entry:
+                self.files.move_to_end(file_name)
+                self.hits += 1
+                return entry
+
+            self.misses += 1
+            entry = OpenFile(pathOf(file_name))
+            self.files[file_name] = entry
+            while len(self.files) > max(1, self.capacity):
+                self.files.popitem(last=False)
+                self.evictions += 1
+            return entry
+
+    def invalidate(self, file_name=None):
+        """
+        forgets one cached file, or all of them
+        """
+        with self.lock:
+            if file_name is None:
+                self.files.clear()
+            else:
+                self.files.pop(file_name, None)
+
+
+fileCache = FileCache()     #shared by every connection this seeder serves
+
+sharedPaths = {}    #shared name -> path, for the files of a library, which are shared under their path in the library
+libraryOf = {}  #shared name -> the Library whose digest file holds the file's manifest
+
+
+def pathOf(file_name):
+    """
+    the path a shared file is read from: its library path, or the name itself for files shared by name
+    """
+    return sharedPaths.get(file_name, file_name)
+
+class ManifestCache:
+    """
+    keeps the piece manifests of recently used shared files in memory:
+     -a file has one manifest, for the piece size Protocol.piece_size_for picks for it
+     -at most `capacity` bytes of digests are kept, the least recently used manifest is dropped first;
+      the newest one is kept even if it is larger, so the event loop finds the manifest a worker just hashed
+     -a manifest is only used while the file has the size and modification time it was hashed with
+    """
+
+    def __init__(self, capacity=MANIFEST_CACHE_BYTES):
+        self.capacity = capacity
+        self.manifests = OrderedDict()   #file name -> (size, mtime, concatenated piece digests), least recently used first
+        self.size = 0   #bytes of digests held
+        self.lock = threading.Lock()
+
+    def get(self, file_name, stat):
+        """
+        returns the digests of a file with the given stat, or None if they are not in memory
+        """
+        with self.lock:
+            cached = self.manifests.get(file_name)
+            if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                self.manifests.move_to_end(file_name)
+                return cached[2]
+            return None
+
+    def put(self, file_name, stat, digests):
+        with self.lock:
+            old = self.manifests.pop(file_name, None)
+            if old:
+                self.size -= len(old[2])
+            self.manifests[file_name] = (stat.st_size, stat.st_mtime_ns, digests)
+            self.size += len(digests)
+            while self.size > self.capacity and len(self.manifests) > 1:
+                self.size -= len(self.manifests.popitem(last=False)[1][2])
+
+
+manifestCache = ManifestCache()     #shared by every connection this seeder serves
+
+
+def manifestFor(file_name):
+    """
+    returns the piece manifest of a shared file as the concatenated SHA-256 digest of every piece,
+    for the piece size the file is published with
+    the file is hashed unless its manifest is still in memory, so call it off the event loop
+    """
+    stat = os.stat(pathOf(file_name))
+    digests = manifestCache.get(file_name, stat)
+    if digests is None:
+        library = libraryOf.get(file_name)
+        digests = library.readDigests(file_name, stat) if library else None    #a library keeps them on disk
+    if digests is None:
+        digests = b"".join(Protocol.piece_hashes(pathOf(file_name), Protocol.piece_size_for(stat.st_size)))
+    manifestCache.put(file_name, stat, digests)
+    return digests
+
+
+def manifestReply(parts, compute=True):
+    """
+    answers "MANIFEST file piece_size" with "MANIFEST length" and the piece digests, or an ERROR line
+    -only the piece size the file is published with is served, any other is refused
+    -without compute, returns None instead of hashing a file whose manifest is not in memory
+    """
+    if len(parts) < 3 or not parts[2].isdigit():
+        return b"ERROR - invalid request\n"
+    try:
+        stat = os.stat(pathOf(parts[1]))
+        piece_size = Protocol.piece_size_for(stat.st_size)
+        if int(parts[2]) != piece_size:
+            return f"ERROR - {parts[1]} is shared in pieces of {piece_size} bytes\n".encode(format)
+        digests = manifestCache.get(parts[1], stat)
+        if digests is None:
+            if not compute:
+                return None
+            digests = manifestFor(parts[1])
+    except OSError as e:
+        return f"ERROR - {e.strerror}\n".encode(format)
+    return f"MANIFEST {len(digests)}\n".encode(format) + digests
+
+
+def describeFile(file_name):
+    """
+    formats a shared file for registration as name:size:root, where root is the hash of its piece manifest
+    """
+    fileSize = os.path.getsize(pathOf(file_name))
+    digests = manifestFor(file_name)
+    return f"{file_name}:{fileSize}:{Protocol.manifest_root(digests)}"
+
+
+class Library:
+    """
+    a folder published as a whole, for seeders with far more files than anyone would type in:
+     -every file below the folder is shared under its path in the folder, with / separators
+      (files whose names the tracker messages cannot carry, with spaces, commas or colons, are skipped)
+     -each file's size, modification time and registration entry are kept in a cache file in the folder,
+      so after a restart only new or changed files are hashed again
+     -the piece digests of every file are appended to a digest file next to the cache, and read back when a leecher
+      asks for a manifest that is not in memory, so a restart does not move the hashing to the first download either
+     -a scan only stats the files, and hashes the ones whose size or modification time changed
+     -a file modified in the last LIBRARY_SETTLE seconds is left for a later scan
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.prefix = os.path.join(self.root, "")   #the folder's path with a trailing separator
+        self.cachePath = os.path.join(self.root, LIBRARY_CACHE)
+        self.digestsPath = os.path.join(self.root, LIBRARY_DIGESTS)
+        self.files = {}     #shared name -> [size, mtime, entry, offset of its digests] of every published file
+        self.hashed = 0     #files hashed by the last scan
+        self.lock = threading.Lock()    #manifests are read from the digest file by other threads while a scan appends
+        self.digests = open(self.digestsPath, "a+b")
+        try:
+            with open(self.cachePath, encoding=format) as cacheFile:
+                self.cached = json.load(cacheFile)  #what the last run published, used by the first scan
+        except (OSError, ValueError):
+            self.cached = {}
+
+    def walk(self):
+        """
+        yields (shared name, path, stat) for every regular file below the folder, except the seeder's own files
+        """
+        folders = [self.root]
+        while folders:
+            try:
+                with os.scandir(folders.pop()) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                folders.append(entry.path)
+                            elif entry.is_file() and not entry.name.startswith((LIBRARY_CACHE, LIBRARY_DIGESTS, PEER_ID_FILE)):
+                                name = entry.path[len(self.prefix):]
+                                yield name.replace(os.sep, "/") if os.sep != "/" else name, entry.path, entry.stat()
+                        except OSError:
+                            continue    #removed during the scan
+            except OSError:
+                continue
+
+    def scan(self):
+        """
+        brings the published list up to date with the folder
+        returns the entries of new or changed files and the names of files that are gone
+        """
+        now = time.time()
+        published, changed = {}, []
+        self.hashed = 0
+        for name, path, stat in self.walk():
+            if any(char in name for char in " ,:"):
+                continue
+            known = self.files.get(name) or self.cached.get(name)
+            #caches written before the digests were kept hold no digest offset, so their files are hashed once more
+            if known and len(known) == 4 and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                published[name] = known
+                sharedPaths[name] = path
+                libraryOf[name] = self
+                if name not in self.files:
+                    changed.append(known[2])
+                continue
+            if now - stat.st_mtime < LIBRARY_SETTLE:
+                continue    #still being written; a changed file is unpublished until it settles
+            try:
+                digests = b"".join(Protocol.piece_hashes(path, Protocol.piece_size_for(stat.st_size)))
+                offset = self.appendDigests(digests)
+            except OSError:
+                continue
+            sharedPaths[name] = path
+            libraryOf[name] = self
+            manifestCache.put(name, stat, digests)
+            published[name] = [stat.st_size, stat.st_mtime_ns, f"{name}:{stat.st_size}:{Protocol.manifest_root(digests)}", offset]
+            self.hashed += 1
+            changed.append(published[name][2])
+
+        removed = [name for name in self.files if name not in published]
+        for name in removed:
+            sharedPaths.pop(name, None)
+            libraryOf.pop(name, None)
+        self.files, self.cached = published, {}
+        if changed or removed:
+            self.save()
+        return changed, removed
+
+    def close(self):
+        """
+        closes the digest file once the library is no longer published or another Library replaces it
+        the library's files are no longer shared from it, and their manifests are hashed again if asked for
+        """
+        with self.lock:
+            for name in self.files:
+                if libraryOf.get(name) is self:
+                    del libraryOf[name]
+                    sharedPaths.pop(name, None)
+            self.digests.close()
+
+    def appendDigests(self, digests):
+        """
+        adds a file's digests to the end of the digest file and returns where they start
+        """
+        with self.lock:
+            offset = self.digests.seek(0, os.SEEK_END)
+            self.digests.write(digests)
+            self.digests.flush()
+            return offset
+
+    def readDigests(self, name, stat):
+        """
+        reads a published file's digests back from the digest file
+        returns None if the file has changed since it was hashed, or the digests read do not hash to its root,
+        as after a crash between writing the digest file and the cache
+        """
+        details = self.files.get(name)
+        if not details or details[0] != stat.st_size or details[1] != stat.st_mtime_ns:
+            return None
+        length = Protocol.total_pieces(stat.st_size, Protocol.piece_size_for(stat.st_size)) * 32
+        with self.lock:
+            if self.digests.closed:
+                return None
+            self.digests.seek(details[3])
+            digests = self.digests.read(length)
+        if len(digests) != length or f"{name}:{stat.st_size}:{Protocol.manifest_root(digests)}" != details[2]:
+            return None
+        return digests
+
+    def entries(self):
+        return [details[2] for details in self.files.values()]
+
+    def save(self):
+        """
+        writes the cache; when most of the digest file belongs to files that changed or are gone, it is rewritten first
+        """
+        with self.lock:
+            live = sum(Protocol.total_pieces(details[0], Protocol.piece_size_for(details[0])) * 32
+                       for details in self.files.values())
+            if self.digests.seek(0, os.SEEK_END) > 2 * live + 1024 * 1024:
+                self.compact()
+        temporary = self.cachePath + ".tmp"
+        with open(temporary, "w", encoding=format) as cacheFile:
+            json.dump(self.files, cacheFile)
+        os.replace(temporary, self.cachePath)
+
+    def compact(self):
+        temporary = self.digestsPath + ".tmp"
+        offsets = {}
+        with open(temporary, "wb") as compacted:
+            for name, details in self.files.items():
+                length = Protocol.total_pieces(details[0], Protocol.piece_size_for(details[0])) * 32
+                self.digests.seek(details[3])
+                offsets[name] = compacted.tell()
+                compacted.write(self.digests.read(length))
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        self.digests.close()
+        os.replace(temporary, self.digestsPath)
+        self.digests = open(self.digestsPath, "a+b")
+        for name, offset in offsets.items():
+            self.files[name][3] = offset
+
+
+class TokenBucket:
+    """
+    limits how fast bytes are sent:
+     -tokens build up at rate bytes per second, up to burst, and every byte sent takes one
+     -a rate of 0 means no limit
+    the threaded server's threads and the event loop take from the same bucket, so it is locked
+    """
+
+    def __init__(self, rate=0, burst=UPLOAD_BURST):
+        self.lock = threading.Lock()
+        self.rate = max(0, rate)
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def setRate(self, rate, burst=None):
+        with self.lock:
+            self.refill()
+            self.rate = max(0, rate)
+            if burst:
+                self.burst = burst
+            self.tokens = min(self.tokens, self.burst)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        else:
+            self.tokens = self.burst    #so a new limit starts from a full bucket
+        self.stamp = now
+
+    def available(self):
+        """
+        bytes that may be sent right now, infinite without a limit
+        """
+        if not self.rate:
+            return math.inf
+        with self.lock:
+            self.refill()
+            return int(self.tokens)
+
+    def consume(self, count):
+        with self.lock:
+            self.tokens -= count
+
+    def delay(self, count):
+        """
+        seconds until count bytes, or a full bucket if that is less, may be sent
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill()
+            return max(0.0, (min(count, self.burst) - self.tokens) / self.rate)
+
+    def take(self, count):
+        """
+        waits until count bytes may be sent and takes them, for senders on blocking sockets
+        count must not be more than the burst
+        """
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                self.refill()
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait = (count - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+uploadLimit = TokenBucket(UPLOAD_RATE_LIMIT)     #shared by every connection this seeder serves
+
+
+def setUploadLimit(rate, burst=None):
+    """
+    changes the upload limit while the seeder is serving, in bytes per second; 0 removes it
+    """
+    uploadLimit.setRate(rate, burst)
+
+
+def countUpload(addr, count):
+    global uploadedTotal
+    with uploadLock:
+        uploaded[addr] = uploaded.get(addr, 0) + count
+        uploadedTotal += count
+
+
+def forgetUpload(addr):
+    """
+    drops a connection from the upload counts once it is closed; its bytes stay in the total
+    """
+    with uploadLock:
+        uploaded.pop(addr, None)
+
+
+def uploadReport():
+    """
+    the upload limit, the bytes sent so far and the bytes sent on every open connection, the most served one first
+    -leechers behind the same address, or one leecher with several connections, are listed apart by their port
+    """
+    with uploadLock:
+        counts = sorted(uploaded.items(), key=lambda item: item[1], reverse=True)
+        total = uploadedTotal
+    limit = f"{uploadLimit.rate} bytes/s" if uploadLimit.rate else "none"
+    return "\n".join([f"[UPLOADS] limit {limit}, {total} bytes sent"] +
+                     [f"  {ip}:{port}: {count} bytes" for (ip, port), count in counts])
+
+
+class ChunkRange:
+    """
+    the part of a shared file that answers one chunk request
+    """
+    __slots__ = ("source", "offset", "length")
+
+    def __init__(self, source, offset, length):
+        self.source = source    #the OpenFile the chunk is served from
+        self.offset = offset
+        self.length = length
+
+
+def parseChunkRequest(parts):
+    """
+    reads "REQUEST file chunk_id [piece_size]" into (file_name, chunk_id, piece_size)
+    a request without a piece size comes from an older leecher and uses the legacy 1 KiB chunks
+    returns None for anything else, including piece sizes this seeder will not serve
+    """
+    if len(parts) < 3 or parts[0] != "REQUEST" or not parts[2].isdigit():
+        return None
+    piece_size = Protocol.LEGACY_CHUNK_SIZE
+    if len(parts) >= 4:
+        if not parts[3].isdigit() or not Protocol.valid_piece_size(int(parts[3])):
+            return None
+        piece_size = int(parts[3])
+    return parts[1], int(parts[2]), piece_size
+
+
+def locateChunk(file_name, chunk_id, chunk_size=Protocol.LEGACY_CHUNK_SIZE):
+    """
+    works out where a chunk lies in a shared file, using the open file cache
+    raises OSError if the file cannot be opened
+    """
+    source = fileCache.get(file_name)
+    offset = chunk_id * chunk_size   #the requested chunk position
+    return ChunkRange(source, offset, max(0, min(chunk_size, source.size - offset)))
+
+
+def sendChunk(connectionSock, chunk, useSendfile=USE_SENDFILE):
+    """
+    sends a chunk on a blocking socket:
+     -with sendfile the data goes from the page cache to the socket without being copied into Python
+     -without it the chunk is sent with sendall as a slice of the file's mapping
+     -if sendfile turns out not to work for this file or socket, the rest goes out with sendall
+    either way the whole chunk is sent, a short write is never mistaken for the end of the chunk
+    under an upload limit the chunk goes out in slices of at most DRR_QUANTUM bytes, each waiting for its tokens
+    returns whether sendfile can still be used on this connection
+    """
+    while chunk.length:
+        count = chunk.length
+        if uploadLimit.rate:
+            count = min(count, DRR_QUANTUM, uploadLimit.burst)
+            uploadLimit.take(count)
+        sent = None
+        if useSendfile:
+            try:
+                sent = os.sendfile(connectionSock.fileno(), chunk.source.file.fileno(), chunk.offset, count)
+            except OSError as e:
+                if e.errno not in SENDFILE_UNSUPPORTED:
+                    raise
+                useSendfile = False
+            if sent == 0:
+                raise ConnectionError(f"{chunk.source.file_name} shrank while chunk data was being sent")
+        if sent is None:
+            connectionSock.sendall(chunk.source.slice(chunk.offset, count))
+            sent = count
+        if sent < count and uploadLimit.rate:
+            uploadLimit.consume(sent - count)   #give back the tokens of a short write
+        chunk.offset += sent
+        chunk.length -= sent
+    return useSendfile
+
+
+def handlingClient(connectionSock, addr, log=print):
     """
     handles requests from leechers:
      -receives file request
      -fetches the requested file chunk
      -sends the requested chunk back to the leecher
+    a connection that starts with SESSION is kept open and served by serveSession instead
     """
     try:
-        print(f"[CONNECTED] {addr} is connected! :)")
+        log(f"[CONNECTED] {addr} is connected! :)")
+
+        #peek at the first byte so a session handshake is not consumed as a single-shot request
+        if connectionSock.recv(1, socket.MSG_PEEK) == SESSION_HELLO[:1]:
+            serveSession(connectionSock, addr, log)
+            return
 
         #receive file request from the leecher
         fileRequest = connectionSock.recv(3000).decode(format)
 
-        if fileRequest.startswith("REQUEST"):
-            data = fileRequest.split(" ")   #parse request details
-            print(f"Leecher {addr} requested the file {data[1]}")
-            file_name = data[1]
-            chunk_id = int(data[2])  #the chunk/part being requested
+        request = parseChunkRequest(fileRequest.split())   #parse request details
+        if request:
+            file_name, chunk_id, piece_size = request   #chunk_id is the chunk/part being requested
+            log(f"Leecher {addr} requested the file {file_name}")
 
-            #now open the file and read the requested chunk
-            with open(file_name, "rb") as f:
-                chunk_size = 1024   #each chunk == 1024 bytes
-                f.seek(chunk_id * chunk_size)   #move to the requested chunk position
-                chunk_data = f.read(chunk_size)
-
-            #send the chunk to the requesting leecher
-            connectionSock.send(chunk_data)
-            print(connectionSock.recv(1024).decode(format))
-            print(f"{data[1]} is sent to {addr}")
+            #now find the requested chunk and send it to the requesting leecher
+            chunk = locateChunk(file_name, chunk_id, piece_size)
+            size = chunk.length
+            sendChunk(connectionSock, chunk)
+            countUpload(addr, size)
+            log(connectionSock.recv(1024).decode(format))
+            log(f"{file_name} is sent to {addr}")
 
     except Exception as e:
-        print(f"Error {e}")
+        log(f"Error {e}")
 
     finally:
         connectionSock.close()  #close the connection with leecher
+        forgetUpload(addr)
+
+
+def sessionReply(parts):
+    """
+    builds the answer to one request line of a session
+    returns the header line and the ChunkRange to send after it:
+    "CHUNK chunk_id length" with the chunk, or an ERROR line with None
+    "MANIFEST file piece_size" is answered by manifestReply, hashing the file here if it has to
+    """
+    if parts[0] == "MANIFEST":
+        return manifestReply(parts), None
+
+    request = parseChunkRequest(parts)
+    if request:
+        file_name, chunk_id, piece_size = request
+        try:
+            chunk = locateChunk(file_name, chunk_id, piece_size)
+        except OSError as e:
+            return f"ERROR {chunk_id} {e.strerror}\n".encode(format), None
+        return f"CHUNK {chunk_id} {chunk.length}\n".encode(format), chunk
+    return b"ERROR - invalid request\n", None
+
+
+def serveSession(connectionSock, addr, log=print):
+    """
+    serves a long-lived connection from a leecher:
+     -the leecher opens with a SESSION line and the seeder answers SESSION OK CANCEL
+     -every following "REQUEST file chunk_id [piece_size]" line is answered, in order, with
+      "CHUNK chunk_id length" and the chunk bytes, or "ERROR chunk_id reason"
+     -"CANCEL file chunk_id [piece_size]" needs no answer here: this server has already answered
+      every request it has read
+     -the session ends when the leecher sends BYE or closes the connection
+    """
+    reader = connectionSock.makefile("rb")
+    try:
+        reader.readline()   #the SESSION handshake line
+        connectionSock.sendall(SESSION_WELCOME)
+        log(f"[SESSION] {addr} opened a session")
+
+        served = sent = 0
+        useSendfile = USE_SENDFILE
+        for line in reader:
+            parts = line.decode(format).split()
+            if not parts:
+                continue
+            if parts[0] == "BYE":
+                break
+            if parts[0] == "CANCEL":
+                continue
+
+            header, chunk = sessionReply(parts)
+            size = len(header) + (chunk.length if chunk else 0)
+            connectionSock.sendall(header)
+            if chunk:
+                useSendfile = sendChunk(connectionSock, chunk, useSendfile)
+                served += 1
+            sent += size
+            countUpload(addr, size)
+
+        log(f"[SESSION] {addr} closed its session after {served} chunks, {sent} bytes")
+
+    finally:
+        reader.close()
+
+
+class LeecherConnection:
+    """
+    state the event loop keeps for one connected leecher
+    """
+    __slots__ = ("sock", "addr", "inbuf", "outbuf", "queued", "session", "closing", "served", "sent", "deficit",
+                 "active", "blocked", "useSendfile")
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()    #received bytes not parsed yet
+        self.outbuf = deque()   #answers not sent yet: header bytes and ChunkRanges, in order
+        self.queued = 0     #bytes waiting in outbuf
+        self.session = None     #None until the first bytes tell a session from a single-shot request
+        self.closing = False    #close once outbuf is flushed
+        self.served = 0
+        self.sent = 0   #bytes sent on this connection
+        self.deficit = 0    #bytes the leecher may still be sent before its turn ends
+        self.active = False     #waiting for its turn in the event loop's round
+        self.blocked = False    #its socket buffer is full, so it waits for the selector to report it writable
+        self.useSendfile = USE_SENDFILE     #cleared if sendfile fails on this connection with an unsupported error
+
+
+class PendingReply:
+    """
+    a place in a leecher's queued answers kept for a manifest that a worker thread is still hashing
+    """
+    __slots__ = ("file_name", "parts")
+
+    def __init__(self, parts):
+        self.file_name = parts[1]
+        self.parts = parts
+
+
+class EventLoopServer:
+    """
+    serves every leecher from a single thread with a selectors event loop:
+     -sockets are non-blocking and a connection costs a small buffer object instead of a thread
+     -both single-shot requests and pipelined sessions are understood
+     -a leecher whose unsent answers exceed MAX_PENDING_OUTPUT is not read from until it catches up,
+      so memory stays bounded however many requests are pipelined
+     -chunk data is sent with os.sendfile from the shared open file cache, never copied into Python
+     -with an upload limit, leechers with answers waiting take turns, DRR_QUANTUM bytes each, and all of them together
+      are held to the limit, so one leecher pipelining many requests cannot take the whole uplink
+     -a manifest that is not in memory is hashed by one of MANIFEST_WORKERS threads; the leecher's later answers wait
+      behind it, other leechers are served meanwhile
+    """
+
+    def __init__(self, seederIP, seederPort, log=print):
+        self.selector = selectors.DefaultSelector()
+        self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listenSock.bind((seederIP, seederPort))
+        self.listenSock.listen(LISTEN_BACKLOG)
+        self.listenSock.setblocking(False)
+        self.selector.register(self.listenSock, selectors.EVENT_READ, None)
+        self.log = log
+        self.running = False
+        self.connections = 0    #currently open leecher connections
+        self.chunksServed = 0
+        self.active = deque()   #leechers with answers to send and room in their socket buffer, in turn order
+        self.midTurn = False    #the first leecher in self.active ran out of tokens in the middle of its turn
+        self.hashing = {}   #file name -> [(conn, PendingReply)] waiting for a worker to hash its manifest
+        self.jobs = queue.Queue()   #file names for the manifest workers
+        self.finished = deque()     #file names the manifest workers are done with, for the loop to answer
+        self.wakeReader, self.wakeWriter = socket.socketpair()  #a worker writes a byte to wake the loop up
+        self.wakeReader.setblocking(False)
+        self.selector.register(self.wakeReader, selectors.EVENT_READ, None)
+        for _ in range(MANIFEST_WORKERS):
+            threading.Thread(target=self.hashManifests, daemon=True).start()
+
+    def serveForever(self):
+        self.running = True
+        self.log(f"[LISTENING] the Seeder event loop is listening on {self.listenSock.getsockname()[1]}")
+        while self.running:
+            #with leechers waiting for their turn, only wait for the upload limit to allow the next one
+            timeout = uploadLimit.delay(DRR_QUANTUM) if self.active else 1
+            for key, events in self.selector.select(timeout=timeout):
+                if key.fileobj is self.wakeReader:
+                    self.finishManifests()
+                    continue
+                if key.data is None:
+                    self.accept()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_READ:
+                    self.readFrom(conn)
+                if events & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                    conn.blocked = False
+                    self.activate(conn)
+                    self.updateInterest(conn)
+            self.sendRound()
+
+    def stop(self):
+        self.running = False
+
+    def accept(self):
+        while True:
+            try:
+                connectionSock, addr = self.listenSock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            connectionSock.setblocking(False)
+            self.selector.register(connectionSock, selectors.EVENT_READ, LeecherConnection(connectionSock, addr))
+            self.connections += 1
+
+    def close(self, conn):
+        if conn.sock in self.selector.get_map():
+            self.selector.unregister(conn.sock)
+        conn.sock.close()
+        self.connections -= 1
+        forgetUpload(conn.addr)
+        if conn.session:
+            self.log(f"[SESSION] {conn.addr} closed its session after {conn.served} chunks, {conn.sent} bytes")
+
+    def readFrom(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(conn)
+            return
+        conn.inbuf += data
+        self.handleInput(conn)
+
+    def handleInput(self, conn):
+        if conn.session is None:
+            conn.session = conn.inbuf.startswith(SESSION_HELLO[:1])
+            if not conn.session:
+                #a single-shot request arrives in one piece, just like the threaded server reads it
+                request = parseChunkRequest(conn.inbuf.decode(format, "replace").split())
+                conn.inbuf.clear()
+                if request:
+                    try:
+                        self.queue(conn, locateChunk(*request))
+                        conn.served += 1
+                    except OSError as e:
+                        self.log(f"Error {e}")
+                conn.closing = True
+                self.updateInterest(conn)
+                return
+
+        #answer complete lines while the leecher is keeping up with what was already queued
+        while conn.queued < MAX_PENDING_OUTPUT and not conn.closing:
+            end = conn.inbuf.find(b"\n")
+            if end < 0:
+                if len(conn.inbuf) > MAX_REQUEST_LINE:
+                    conn.closing = True
+                break
+            parts = conn.inbuf[:end].decode(format, "replace").split()
+            del conn.inbuf[:end + 1]
+            if not parts:
+                continue
+            if parts[0] == "SESSION":
+                self.queue(conn, SESSION_WELCOME)
+                self.log(f"[SESSION] {conn.addr} opened a session")
+            elif parts[0] == "BYE":
+                conn.closing = True
+            elif parts[0] == "CANCEL":
+                request = parseChunkRequest(["REQUEST"] + parts[1:])
+                if request:
+                    self.cancel(conn, request[1])
+            elif parts[0] == "MANIFEST":
+                self.queueManifest(conn, parts)
+            else:
+                header, chunk = sessionReply(parts)
+                self.queue(conn, header)
+                if chunk:
+                    self.queue(conn, chunk)
+                    conn.served += 1
+                    self.chunksServed += 1
+        self.updateInterest(conn)
+
+    def queueManifest(self, conn, parts):
+        """
+        queues the answer to a MANIFEST request, or keeps its place while a worker hashes the file
+        """
+        reply = manifestReply(parts, compute=False)
+        if reply is not None:
+            self.queue(conn, reply)
+            return
+        pending = PendingReply(parts)
+        self.queue(conn, pending)
+        self.queueHashing(conn, pending)
+
+    def queueHashing(self, conn, pending):
+        """
+        keeps a place for a manifest until a worker has hashed the file
+        """
+        waiting = self.hashing.setdefault(pending.file_name, [])
+        waiting.append((conn, pending))
+        if len(waiting) == 1:
+            self.jobs.put(pending.file_name)    #leechers asking for a file that is being hashed wait for the same job
+
+    def hashManifests(self):
+        while True:
+            file_name = self.jobs.get()
+            try:
+                manifestFor(file_name)
+            except OSError:
+                pass    #manifestReply reports the error when the loop answers
+            self.finished.append(file_name)
+            self.wakeWriter.send(b"\0")
+
+    def finishManifests(self):
+        """
+        puts the manifests the workers finished in the places kept for them
+        """
+        try:
+            while self.wakeReader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.finished:
+            for conn, pending in self.hashing.pop(self.finished.popleft(), []):
+                if conn.sock.fileno() == -1:
+                    continue
+                reply = manifestReply(pending.parts, compute=False)
+                if reply is None:
+                    #the file changed again, or its digests left the cache, since the worker hashed it
+                    self.queueHashing(conn, pending)
+                    continue
+                conn.outbuf[conn.outbuf.index(pending)] = reply
+                conn.queued += len(reply)
+                self.activate(conn)
+                self.updateInterest(conn)
+
+    def cancel(self, conn, chunk_id):
+        """
+        withdraws a queued answer the leecher no longer needs: its header becomes "CANCELLED chunk_id"
+        and the chunk data is dropped. an answer that has started going out is left alone
+        """
+        header = f"CHUNK {chunk_id} ".encode(format)
+        for index in range(1, len(conn.outbuf)):
+            item = conn.outbuf[index]
+            if isinstance(item, bytes) and item.startswith(header):
+                conn.outbuf[index] = f"CANCELLED {chunk_id}\n".encode(format)
+                conn.queued += len(conn.outbuf[index]) - len(item)
+                following = conn.outbuf[index + 1] if index + 1 < len(conn.outbuf) else None
+                if isinstance(following, ChunkRange):
+                    conn.queued -= following.length
+                    del conn.outbuf[index + 1]
+                return
+
+    def queue(self, conn, item):
+        if isinstance(item, ChunkRange):
+            if item.length == 0:
+                return
+            conn.queued += item.length
+        elif not isinstance(item, PendingReply):
+            conn.queued += len(item)
+        conn.outbuf.append(item)
+        self.activate(conn)
+
+    def activate(self, conn):
+        if not conn.active and not conn.blocked:
+            conn.active = True
+            self.active.append(conn)
+
+    def sendRound(self):
+        """
+        gives every leecher with answers waiting one turn
+        without an upload limit a turn sends whatever the leecher's socket buffer takes, so the socket buffers share the
+        uplink between leechers and a large chunk needs no extra turns; with a limit, turns are deficit round robin:
+         -every turn adds DRR_QUANTUM bytes to the leecher's deficit, whether it pipelined one request or hundreds
+         -the leecher is sent as much of the answers at the front of its queue as its deficit covers, a chunk larger
+          than the quantum going out a part every turn
+         -a leecher whose socket buffer fills up leaves the round and keeps what is left of its deficit, up to one
+          quantum, for when it is writable again
+         -a leecher whose queue runs dry, or whose next answer is a manifest still being hashed, leaves the round and
+          starts again from nothing
+         -when the upload limit runs out in the middle of a turn the round stops there,
+          and the same leecher finishes its turn once there are tokens again
+        """
+        budget = uploadLimit.available()
+        for _ in range(len(self.active)):
+            if budget <= 0:
+                break
+            conn = self.active[0]
+            resuming, self.midTurn = self.midTurn, False
+            if conn.sock.fileno() != -1:
+                if uploadLimit.rate and not resuming:
+                    conn.deficit = min(conn.deficit, DRR_QUANTUM) + DRR_QUANTUM
+                allowance = self.allowance(conn)
+                sent = self.writeTo(conn, min(allowance, budget)) if allowance else 0
+                conn.deficit = max(0, conn.deficit - sent)
+                budget -= sent
+                if conn.outbuf and conn.sock.fileno() != -1 and not isinstance(conn.outbuf[0], PendingReply):
+                    if conn.blocked:
+                        self.active.popleft()   #back in the round once the selector reports it writable
+                        conn.active = False
+                        continue
+                    if sent < allowance:
+                        self.midTurn = True     #out of tokens, so the turn carries on in the next round
+                        break
+                    self.active.rotate(-1)  #turn over, to the back of the round
+                    continue
+            self.active.popleft()
+            conn.active = False
+            conn.deficit = 0
+
+    def allowance(self, conn):
+        """
+        bytes at the front of the leecher's queue it may be sent in this turn: all of them without an upload limit,
+        otherwise no more than its deficit
+        """
+        total = 0
+        for item in conn.outbuf:
+            if isinstance(item, PendingReply):
+                break   #nothing behind a manifest still being hashed can go out yet
+            total += item.length if isinstance(item, ChunkRange) else len(item)
+        return min(total, conn.deficit) if uploadLimit.rate else total
+
+    def writeTo(self, conn, limit):
+        """
+        sends up to limit bytes of the leecher's waiting answers and returns how many were sent
+        a full socket buffer marks the leecher blocked until the selector reports it writable again
+        """
+        sent = 0
+        try:
+            while conn.outbuf and sent < limit and not isinstance(conn.outbuf[0], PendingReply):
+                item = conn.outbuf[0]
+                if isinstance(item, ChunkRange):
+                    wanted = min(item.length, limit - sent)
+                    count = self.sendRange(conn, item, wanted)
+                    done = item.length == 0
+                else:
+                    wanted = min(len(item), limit - sent)
+                    count = conn.sock.send(memoryview(item)[:wanted])
+                    done = count == len(item)
+                    if not done:
+                        conn.outbuf[0] = memoryview(item)[count:]
+                sent += count
+                conn.queued -= count
+                if done:
+                    conn.outbuf.popleft()
+                elif count < wanted:
+                    conn.blocked = True     #the socket buffer is full
+                    break
+        except (BlockingIOError, InterruptedError):
+            conn.blocked = True
+        except OSError as e:
+            self.log(f"Error {e}")
+            self.close(conn)
+        if sent:
+            conn.sent += sent
+            countUpload(conn.addr, sent)
+            if uploadLimit.rate:
+                uploadLimit.consume(sent)
+        if conn.sock.fileno() == -1:
+            return sent
+        if conn.queued < MAX_PENDING_OUTPUT and conn.inbuf:
+            self.handleInput(conn)     #requests held back while the output was full
+        else:
+            self.updateInterest(conn)
+        return sent
+
+    def sendRange(self, conn, chunk, count):
+        sent = None
+        if conn.useSendfile:
+            try:
+                sent = os.sendfile(conn.sock.fileno(), chunk.source.file.fileno(), chunk.offset, count)
+            except OSError as e:
+                if e.errno not in SENDFILE_UNSUPPORTED:
+                    raise
+                self.log(f"[SENDFILE] {conn.addr}: {e.strerror}, sending from memory instead")
+                conn.useSendfile = False
+        if sent is None:
+            sent = conn.sock.send(chunk.source.slice(chunk.offset, count))
+        if sent == 0:
+            raise ConnectionError(f"{chunk.source.file_name} shrank while chunk data was being sent")
+        chunk.offset += sent
+        chunk.length -= sent
+        return sent
+
+    def updateInterest(self, conn):
+        if conn.closing and not conn.outbuf:
+            self.close(conn)
+            return
+        events = 0
+        if conn.queued < MAX_PENDING_OUTPUT and not conn.closing:
+            events |= selectors.EVENT_READ
+        if conn.outbuf and conn.blocked:
+            events |= selectors.EVENT_WRITE
+        registered = self.selector.get_map().get(conn.sock)
+        #a leecher waiting for its turn may have no events to wait for, and the selector takes no empty event mask
+        if registered is None:
+            if events:
+                self.selector.register(conn.sock, events, conn)
+        elif not events:
+            self.selector.unregister(conn.sock)
+        elif registered.events != events:
+            self.selector.modify(conn.sock, events, conn)
 
 
-def start(seederIP, seederPort):
+def start(seederIP, seederPort, log=print):
     """
     starts the seeder, allowing incoming connections from leechers
     """
@@ -55,31 +1141,41 @@ def start(seederIP, seederPort):
     #print(seederPort)
 
     seederSock.listen(10)   #allows up to 10 simultaneous connections
-    print(f"[LISTENING] the Seeder is listening on {seederPort}")
+    log(f"[LISTENING] the Seeder is listening on {seederPort}")
 
     while True:
         connectionSock, addr = seederSock.accept()
-        thread = threading.Thread(target=handlingClient, args=(connectionSock, addr))
+        thread = threading.Thread(target=handlingClient, args=(connectionSock, addr, log))
         thread.start()      #each leecher==thread requesting is handled in a separate thread
 
+
+def startEventLoop(seederIP, seederPort, log=print):
+    """
+    starts the seeder with the single-threaded event loop server
+    """
+    EventLoopServer(seederIP, seederPort, log).serveForever()
+
+
+def serve(seederIP, seederPort, mode=SERVER_MODE, log=print):
+    """
+    starts the seeder in the configured serving mode
+    """
+    if mode == "threaded":
+        start(seederIP, seederPort, log)
+    else:
+        startEventLoop(seederIP, seederPort, log)
+
 def register(trackerSock, trackerAddr, seederIP, seederPort):
     """
     seeder registers with the tracker, and informs it of available files
     """
     try:
-        fileStr = fileAvailable()
-        if not fileStr:
+        fileArray = fileAvailable()
+        if not fileArray:
             return False    #no files available, so won't register
 
         print(f"Sending Register message to Tracker at {trackerAddr} : {trackerIP}")
-
-        message = f"REGISTER_FILES {seederIP} {seederPort} {fileStr}"
-        trackerSock.sendto(message.encode(format), trackerAddr)
-
-        #registration confirmation from the tracker
-        data, addr = trackerSock.recvfrom(1024)
-        print(f"[TRACKER RESPONSE]: {data.decode(format)}")
-        return True
+        return announce(trackerSock, trackerAddr, seederIP, seederPort, fileArray)
 
     except ConnectionResetError:
         print("Error: The tracker is not responding. Make sure it's running.")
@@ -93,7 +1189,7 @@ def register(trackerSock, trackerAddr, seederIP, seederPort):
 def fileAvailable():
     """
     prompt the user for files to register and checks their availability
-    return a formatted string containing file names and their sizes
+    return a list of formatted entries containing file names, their sizes and manifest roots
     """
     fileToReg = input("[ENTER] file(s) you want to register(separated by a comma):\n")
     fileToReg = fileToReg.split(",")
@@ -103,28 +1199,188 @@ def fileAvailable():
     for file in fileToReg:
         # Verify if the file exists
         if os.path.exists(file):
-            fileSize = os.path.getsize(file)
-            fileArray.append(f"{file}:{fileSize}")  #stores file name and size
+            fileArray.append(describeFile(file))  #stores file name, size and manifest root
         else:
             print(f"[WARNING]: File {file} does not exist and will not be registered")
 
     if not fileArray:
         print("[ERROR]: No files available to share!")
-        return ""
+        return []
+
+    print((",").join(fileArray))
+    return fileArray
+
+def exchange(trackerSock, trackerAddr, message):
+    """
+    sends one message to the tracker and waits for its answer, sending it again if none arrives
+    -late answers to earlier messages are dropped first, so they are not taken for this one's
+    returns the answer, or None if the tracker did not answer
+    """
+    trackerSock.setblocking(False)
+    try:
+        while True:
+            trackerSock.recvfrom(1024)
+    except (BlockingIOError, ConnectionResetError):
+        pass
+
+    trackerSock.settimeout(ANNOUNCE_TIMEOUT)
+    try:
+        for attempt in range(ANNOUNCE_RETRIES):
+            trackerSock.sendto(message.encode(format), trackerAddr)
+            try:
+                data, addr = trackerSock.recvfrom(1024)
+                return data.decode(format)
+            except socket.timeout:
+                continue
+        return None
+
+    finally:
+        trackerSock.settimeout(None)
+
+def announce(trackerSock, trackerAddr, seederIP, seederPort, fileArray, log=print):
+    """
+    registers a list of file entries with the tracker in as many datagrams as it takes
+    -entries are batched so every datagram fits in Protocol.BATCH_BYTES
+    -the first batch is sent as REGISTER_FILES with the version of the file list and this seeder's peer ID,
+     and replaces whatever this seeder registered before
+    -the rest are sent as REGISTER_MORE, which adds to it
+    -each batch waits for the tracker's acknowledgement and is sent again if none arrives,
+     which is safe since the tracker replaces a file registered twice under the same name
+    returns True once every batch is acknowledged
+    """
+    global announced
+    identity = f" version={announceVersion} peer={identify()}"
+    header = f"REGISTER_FILES {seederIP} {seederPort} "
+    batches = Protocol.batch_entries(fileArray, Protocol.BATCH_BYTES - len(header.encode(format)) - len(identity))
+    if not batches:
+        return False
+
+    with trackerLock:
+        for index, batch in enumerate(batches):
+            if index == 0:
+                message = f"REGISTER_FILES {seederIP} {seederPort} {','.join(batch)}{identity}"
+            else:
+                message = f"REGISTER_MORE {seederIP} {seederPort} {','.join(batch)}"
+            data = exchange(trackerSock, trackerAddr, message)
+            if data is None:
+                log("Error: The tracker is not responding. Make sure it's running.")
+                return False
+
+            if not data.startswith("REGISTERED"):
+                log(f"[TRACKER RESPONSE]: {data}")
+                return False
+
+        announced = {entry.split(':')[0]: entry for entry in fileArray}
+        log(f"[TRACKER RESPONSE]: {data} ({len(fileArray)} files in {len(batches)} messages)")
+        return True
+
+def updateFiles(trackerSock, trackerAddr, seederIP, seederPort, added=(), removed=(), log=print):
+    """
+    tells the tracker about files added to or removed from this seeder, without registering again
+    -added are entries made by describeFile(), removed are file names
+    -every datagram is one numbered change (ADD or REMOVE) that only touches the files it names
+    -if the tracker missed a change it asks for a resync, and the whole list is announced again
+    returns True once the tracker has the new list
+    """
+    global announceVersion
+    with trackerLock:
+        #the list is changed here first, so a resync announces every change
+        for name in removed:
+            announced.pop(name, None)
+        for entry in added:
+            announced[entry.split(':')[0]] = entry
+
+        for command, entries in (("REMOVE", list(removed)), ("ADD", list(added))):
+            header = f"{command} {seederIP} {seederPort} {announceVersion + len(entries)} "
+            for batch in Protocol.batch_entries(entries, Protocol.BATCH_BYTES - len(header.encode(format))):
+                announceVersion += 1
+                data = exchange(trackerSock, trackerAddr, f"{command} {seederIP} {seederPort} {announceVersion} {','.join(batch)}")
+                if data is None:
+                    #the next heartbeat carries the new version, so the tracker asks for a resync once it is back
+                    log("Error: The tracker is not responding. Make sure it's running.")
+                    return False
+
+                if data.startswith("RESYNC"):
+                    log(f"[TRACKER RESPONSE]: {data}, announcing every file again")
+                    return announce(trackerSock, trackerAddr, seederIP, seederPort, list(announced.values()), log)
+
+        log(f"[TRACKER RESPONSE]: {data if added or removed else 'nothing to update'}")
+        return True
+
+def heartbeat(trackerSock, trackerAddr, seederIP, seederPort, log=print):
+    """
+    sends one heartbeat carrying the version of the file list
+    -if the tracker missed a change, or lost this seeder, it asks for a resync and the whole list is announced again
+    returns the tracker's answer, or None if it did not answer
+    """
+    with trackerLock:
+        data = exchange(trackerSock, trackerAddr, f"HEARTBEAT {seederIP} {seederPort} {announceVersion}")
+        if data and data.startswith("RESYNC") and announced:
+            log(f"[TRACKER RESPONSE]: {data}, announcing every file again")
+            announce(trackerSock, trackerAddr, seederIP, seederPort, list(announced.values()), log)
+        return data
+
+def publishLibrary(trackerSock, trackerAddr, seederIP, seederPort, library, log=print):
+    """
+    registers every file of a library with the tracker and starts a thread that keeps the tracker in step with the folder
+    the seeder's peer ID is kept in the library's folder, so the tracker knows it again after a restart
+    returns False if the library has no files or the tracker did not take the registration
+    """
+    identify(library.root)
+    started = time.monotonic()
+    library.scan()
+    log(f"[LIBRARY]: {len(library.files)} files in {library.root}, {library.hashed} of them hashed, "
+        f"in {time.monotonic() - started:.1f}s")
+    if not announce(trackerSock, trackerAddr, seederIP, seederPort, library.entries(), log):
+        library.close()
+        return False
+
+    watcher = threading.Thread(target=watchLibrary, args=(trackerSock, trackerAddr, seederIP, seederPort, library, log), daemon=True)
+    watcher.start()
+    return True
 
-    fileStr = (",").join(fileArray)
-    print(fileStr)
-    return fileStr
+def watchLibrary(trackerSock, trackerAddr, seederIP, seederPort, library, log=print):
+    """
+    scans a published library every LIBRARY_POLL_INTERVAL seconds and sends the tracker only what changed
+    """
+    while True:
+        time.sleep(LIBRARY_POLL_INTERVAL)
+        try:
+            changed, removed = library.scan()
+        except Exception as e:
+            log(f"An error occurred {e}")
+            continue
+        if changed or removed:
+            log(f"[LIBRARY]: {len(changed)} files added or changed, {len(removed)} removed")
+            updateFiles(trackerSock, trackerAddr, seederIP, seederPort, added=changed, removed=removed, log=log)
+
+def readCommands(log=print):
+    """
+    reads commands typed into the seeder's terminal while it is serving:
+     -"limit bytes_per_second [burst]" changes the upload limit, 0 removes it
+     -"uploads" prints the bytes sent to every leecher
+    """
+    for line in sys.stdin:
+        parts = line.split()
+        if parts and parts[0] == "limit" and len(parts) in (2, 3) and all(part.isdigit() for part in parts[1:]):
+            setUploadLimit(int(parts[1]), int(parts[2]) if len(parts) == 3 else None)
+            log(f"[LIMIT] upload limit {parts[1]} bytes/s" if int(parts[1]) else "[LIMIT] no upload limit")
+        elif parts == ["uploads"]:
+            log(uploadReport())
+        elif parts:
+            log("Commands: limit <bytes per second> [burst], uploads")
 
 def discoverable(trackerSock, trackerAddr, seederIP, seederPort):
     """
     sends periodic heartbeats to the tracker to indicate that the seeder is online
+    -the bytes sent to every leecher so far are printed along with them
     """
     try:
         while True:
-            trackerSock.sendto(f"HEARTBEAT {seederIP} {seederPort}".encode(), trackerAddr)
-            data, addr = trackerSock.recvfrom(1024)
-            print("[TRACKER RESPONSE]: ", data.decode(format))
+            data = heartbeat(trackerSock, trackerAddr, seederIP, seederPort)
+            print("[TRACKER RESPONSE]: ", data if data is not None else "no answer")
+            if uploadedTotal:
+                print(uploadReport())
             time.sleep(30)      #waits for 30sec before sending another hearthbeat
 
     except Exception as e:
@@ -133,9 +1389,10 @@ def discoverable(trackerSock, trackerAddr, seederIP, seederPort):
     finally:
         trackerSock.close()  #close socket when stopping heartbeats
 
-def main():
+def main(folder=None):
     """
     initialises the seeder, registers it with the tracker, and starts listening for requests.
+    with a folder, every file in it is published and changes to the folder are followed; otherwise the user is asked for files
     """
     #creates a TCP socket for seeder, to get the IP address and port number
     seederSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -150,18 +1407,24 @@ def main():
     trackerAddr = (trackerIP, trackerPortNum)
 
     #attempts to register with the tracker
-    if register(trackerSock, trackerAddr, seederIP, seederPort):
+    if folder:
+        registered = publishLibrary(trackerSock, trackerAddr, seederIP, seederPort, Library(folder))
+    else:
+        registered = register(trackerSock, trackerAddr, seederIP, seederPort)
+    if registered:
         # Start heartbeat thread
         time.sleep(5)
         heartBeatThread = threading.Thread(target=discoverable, args=(trackerSock, trackerAddr, seederIP, seederPort), daemon=True)
         heartBeatThread.start()
+        threading.Thread(target=readCommands, daemon=True).start()   #the upload limit can be changed while serving
 
         print("[STARTING] the Seeder is starting....")
-        start(seederIP, seederPort)
+        serve(seederIP, seederPort)
 
     else:
         print("[REGISTRATION FAILED]: Seeder will not start.")
         trackerSock.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    #python Seeder.py [folder]
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
\ No newline at end of file
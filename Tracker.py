@@ -1,27 +1,63 @@
 # This is the code for the Tracker. The Tracker will use a Client/Server socket interaction with the Seeder and Leecher via UDP.
 import socket
+import os
+import gc
+import selectors
+import multiprocessing
+import pickle
+import struct
+import heapq
+import itertools
 import time
 import threading
+import base64
+from collections import OrderedDict
+import Protocol
 
 # Define the Trackers' IP and Ports
 tracker_IP = "127.0.0.1"  # Use actual IP, not "127.0.0.1" if running on different laptops
 tracker_port = 6000  # Port for Tracker
 
-# Create separate UDP sockets for leechers and seeders
-tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# The tracker socket is created in main(), so the message handlers can be imported without binding the port
+tracker_socket = None
 
-# Bind sockets to respective ports
-tracker_socket.bind((tracker_IP, tracker_port))
+# Where tracker messages are reported; the GUI replaces this to show them in its tab
+log = print
 
-# Set sockets to non-blocking mode
-tracker_socket.setblocking(False)
+# Registered seeders: seeder ID -> SeederRecord
+seeders = {}
 
-print("The server is ready to receive and is listening on " + tracker_IP)
+# Indexes over the seeders dictionary, kept in step with it by index_seeder() and remove_seeder():
+# file name -> {seeder ID -> that seeder's FileRecord}, (IP, Port) -> seeder ID, and the peer ID a seeder chose for
+# itself -> seeder ID
+files_index = {}
+address_index = {}
+peer_index = {}
 
-seeders = {}
+# Held while a message is handled or inactive seeders are removed, so the dictionaries and indexes change together
+state_lock = threading.Lock()
+
+# Dictionary to store Leecher information: (IP, Port) -> LeecherRecord, from the least to the most recently active
+leechers = OrderedDict()
+
+# Pieces held by leechers that are partway through a download, per file name:
+# {"PieceSize": bytes, "Counts": partial holders per piece, "Holders": {peer ID or "ip,port": HolderRecord}}
+partial_holders = {}
+
+# Encoded answers to file requests, per file name: {form of the answer: bytes}, least recently used first.
+# A file's answers are dropped whenever its seeders or piece availability change; see invalidate()
+response_cache = OrderedDict()
+cache_stats = {"hits": 0, "misses": 0, "bytes": 0}
 
-# Dictionary to store Leecher information
-leechers = {}
+# Seeders and partial holders waiting to expire, as a heap of (due time, timer number, seeder ID or (file name, peer)).
+# A seeder or holder keeps the number of its current timer; entries whose number no longer matches are stale
+expiry_heap = []
+
+# Journal of registrations and expiries since the last snapshot (a text file open for appending), or None when the
+# tracker does not keep its state; see restore()
+journal = None
+journal_records = 0
+snapshot_generation = 0
 
 # Counters for generating IDs
 next_seeder_id = 1
@@ -30,54 +66,301 @@ next_leecher_id = 1
 
 # Define a timeout (how long to wait before removing inactive seeders)
 SEEDER_TIMEOUT = 45  # 45 seconds
+EXPIRY_INTERVAL = 1  # Seconds between checks of the expiry heap
+WORKERS = 1  # Tracker processes sharing the port; more than one needs SO_REUSEPORT (Linux, BSD)
+BATCH_INTERVAL = 0.05  # Most seconds a worker's copy of the state lags behind the owner's
+BATCH_BYTES = 64 * 1024  # The owner sends a batch of state changes early once it holds about this many bytes
+OWNER_BUFFER = 256 * 1024  # Largest datagram between a worker and the owner
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024  # Past this many bytes of cached answers, the least recently asked files are dropped
+LEGACY_REPLY_SIZE = 1024  # Bytes older leechers read of the answer to a text REQUEST
+LEECHER_TTL = 600  # Seconds a leecher is remembered after its last request
+MAX_LEECHERS = 10000  # Past this many, the least recently active leechers are forgotten
+PERSIST_STATE = True  # Keep registrations across restarts in a snapshot and a journal
+SNAPSHOT_PATH = "tracker_state.snapshot"
+JOURNAL_PATH = "tracker_state.journal"
+SNAPSHOT_INTERVAL = 300  # Seconds between snapshots, after each of which the journal starts empty
+
+# Timers run by the tracker loop, as a heap of (due time, sequence number, callback)
+timers = []
+timer_sequence = itertools.count()
+
+
+# Records are classes with __slots__ rather than dictionaries, so each seeder, file and leecher the tracker holds
+# costs a few fixed fields instead of a hash table of its own
+
+# A registered seeder: its address (also as a binary peer entry, None if it is not IPv4), its files as
+# {file ID: FileRecord} and when it was last heard from. Seeders that announce changes to their file list
+# number every change; version is the last one applied (0 for seeders that do not) and peer_id the ID the seeder
+# chose for itself, which stays the same if its address changes (None for seeders that send none)
+class SeederRecord:
+    __slots__ = ("ip", "port", "peer", "files", "last_seen", "timer", "version", "peer_id")
+
+    def __init__(self, ip, port, last_seen, version=0, peer_id=None):
+        self.ip = ip
+        self.port = port
+        try:
+            self.peer = Protocol.pack_peer(ip, port)
+        except (OSError, ValueError, struct.error):
+            self.peer = None
+        self.files = {}
+        self.last_seen = last_seen
+        self.timer = None
+        self.version = version
+        self.peer_id = peer_id
+
+
+# A file published by a seeder, split into pieces of the size the policy picks for it.
+# root is the hex SHA-256 of the file's piece manifest, or None for seeders that publish no manifest
+class FileRecord:
+    __slots__ = ("file_id", "file_name", "file_size", "piece_size", "total_chunks", "root")
+
+    def __init__(self, file_id, file_name, file_size, root):
+        self.file_id = file_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.piece_size = Protocol.piece_size_for(file_size)
+        self.total_chunks = Protocol.total_pieces(file_size, self.piece_size)
+        self.root = root
+
+
+# A leecher that requested a file, remembered by the address it sent the request from
+class LeecherRecord:
+    __slots__ = ("leecher_id", "requested_file", "last_seen")
+
+    def __init__(self, leecher_id, requested_file, last_seen):
+        self.leecher_id = leecher_id
+        self.requested_file = requested_file
+        self.last_seen = last_seen
+
+
+# The pieces a leecher partway through a download last reported, one bit per piece
+class HolderRecord:
+    __slots__ = ("bitfield", "last_seen", "timer")
+
+    def __init__(self, bitfield, last_seen):
+        self.bitfield = bitfield
+        self.last_seen = last_seen
+        self.timer = None
 
 
 def leecher_msg(message, clientAddress):
-    global next_leecher_id
     # Decode the message
     IP_address, Port = clientAddress  # Extract IP and Port
     message_str = message.decode()  # Decode from bytes to string
 
-    # Expected format: REQUEST filename
+    # Expected format: REQUEST filename, or REQUEST filename V2 from leechers that understand per-file piece sizes
     parts = message_str.split()  # Split into two parts
-    if len(parts) >= 2 and parts[0] == "REQUEST":
-        file_name = parts[1]  # Extract the filename
+    if len(parts) < 2 or parts[0] != "REQUEST":
+        log(f"Unknown message type received: {message_str}")
+        return "ERROR: Invalid message format.".encode()
+    file_name = parts[1]  # Extract the filename
+    versioned = len(parts) >= 3 and parts[2] == "V2"
+    leecher_id = remember_leecher(clientAddress, file_name)
 
-        # Only generate a new leecher_id if the request is valid
-        leecher_id = f"L{next_leecher_id}"
-        next_leecher_id += 1  # Increment only when a valid request is received
+    # Log the update
+    log(f"Leecher {leecher_id} at {clientAddress} requested file: {file_name}")
 
-    if leecher_id not in leechers:
-        # Add the leecher to the dictionary
-        leechers[leecher_id] = {
-            "Leecher_IP": clientAddress[0],  # Leecher's IP Address
-            "Leecher_Port": clientAddress[1],  # Leecher's Port
-            "RequestedFile": file_name  # The file the leecher wants to download
-        }
-    else:
-        # Update the existing leecher information
-        leechers[leecher_id]["RequestedFile"] = file_name
+    form = "V2" if versioned else "legacy"
+    response = cached_response(file_name, form)
+    if response is None:
+        response = text_reply(file_name, versioned)
+        if response is None:
+            return f"No Seeders with the specified file {file_name}.".encode()
+        cache_response(file_name, form, response)
+    return response
 
+
+# Build the text answer to a REQUEST, or None if no seeder has the file
+def text_reply(file_name, versioned):
     # Find seeders who have the requested file
-    available_seeders = []
-    total_chunks = None  # Store total chunks separately
-    for seeder_id, seeder_info in seeders.items():  # Iterating over seeders
-        for file_id, file_info in seeder_info["Files"].items():  # Iterating over the seeder's files
-            if file_info["FileName"] == file_name:  # Match filename
-                total_chunks = file_info["TotalChunks"]
-                available_seeders.append(f"{seeder_info['IP']},{seeder_info['Port']}")
+    requested_file, root, holders = find_seeders(file_name)
+    if requested_file is None:
+        return None
+    available_seeders = [f"{seeder_info.ip},{seeder_info.port}" for seeder_info in holders]
 
-    if total_chunks is not None:
-        available_seeders.append(str(total_chunks))  # Append total chunks at the end
+    file_size = requested_file.file_size
+    if versioned:
+        # Return response in the format: PEERS chunks=N piece=BYTES size=BYTES [root=HEX] [avail=BASE64] ip,port ip,port
+        details = f"chunks={requested_file.total_chunks} piece={requested_file.piece_size} size={file_size}"
+        if root:
+            details += f" root={root}"
+        counts = availability(file_name, requested_file.piece_size, requested_file.total_chunks, len(available_seeders))
+        if counts:
+            details += f" avail={base64.b64encode(counts).decode()}"
+        header = f"PEERS {details}"
+        return f"{header} {' '.join(fit_peers(available_seeders, Protocol.MAX_DATAGRAM - len(header)))}".encode()
+
+    # Older leechers get the format: ip,port ip,port total_chunks, counted in legacy 1 KiB chunks
+    total_chunks = str(Protocol.total_pieces(file_size, Protocol.LEGACY_CHUNK_SIZE))
+    available_seeders = fit_peers(available_seeders, LEGACY_REPLY_SIZE - len(total_chunks))
+    available_seeders.append(total_chunks)
+    return f"{' '.join(available_seeders)}".encode()
+
+
+# The leading seeders of a text answer that fit in space bytes, so the answer is never cut off in the middle;
+# larger swarms are only fully listed by the binary protocol
+def fit_peers(available_seeders, space):
+    for count, seeder in enumerate(available_seeders):
+        space -= len(seeder) + 1
+        if space < 0:
+            return available_seeders[:count]
+    return available_seeders
 
-    # Log the update
-    print(f"Leecher {leecher_id} at {clientAddress} requested file: {file_name}")
 
-    # Return response in the format: PEERS seeder1,ip,port seeder2,ip,port
-    if available_seeders:
-        return f"{' '.join(available_seeders)}".encode()
+# Remember the leecher at clientAddress and the file it asked for, and return its leecher ID
+def remember_leecher(clientAddress, file_name):
+    global next_leecher_id
+
+    # A leecher asking again from the same address keeps its ID; only a new address gets a new leecher_id
+    current_time = int(time.time())  # Unix timestamp
+    leecher = leechers.get(clientAddress)
+    if leecher is None:
+        # Add the leecher to the dictionary
+        leecher = leechers[clientAddress] = LeecherRecord(f"L{next_leecher_id}", file_name, current_time)
+        next_leecher_id += 1
+        # Forget the least recently active leechers once there are too many
+        while len(leechers) > MAX_LEECHERS:
+            leechers.popitem(last=False)
     else:
-        return f"No Seeders with the specified file {file_name}.".encode()
+        # Update the existing leecher information and move it to the most recently active end
+        leecher.requested_file = file_name
+        leecher.last_seen = current_time
+        leechers.move_to_end(clientAddress)
+    return leecher.leecher_id
+
+
+'''
+Function to find the seeders of a file. Returns the FileRecord whose details are reported, its manifest root and the
+SeederRecords of the seeders holding that content, or (None, None, []) if no seeder has the file.
+The first published manifest root decides the file's content; seeders that published a different root
+have a different file under the same name and are left out. Seeders that published no root are kept.
+'''
+def find_seeders(file_name):
+    matches = [(seeders[seeder_id], file_info) for seeder_id, file_info in files_index.get(file_name, {}).items()]
+    if not matches:
+        return None, None, []
+    requested_file = next((file_info for _, file_info in matches if file_info.root), matches[0][1])
+    root = requested_file.root
+    return requested_file, root, [seeder_info for seeder_info, file_info in matches if file_info.root in (None, root)]
+
+
+'''
+Method to answer a binary lookup (see Protocol.py) with one page of the file's seeders. The page holds at most
+numwant seeders and never more than fit in one datagram; the per-piece availability only comes with the first page.
+'''
+def binary_msg(message, clientAddress):
+    try:
+        action, transaction, body = Protocol.unpack_header(message)
+        if action == Protocol.LOOKUP_MANY:
+            return many_msg(transaction, *Protocol.unpack_lookup_many(body), clientAddress)
+        if action != Protocol.LOOKUP:
+            return Protocol.pack_failure(transaction, f"Unknown action {action}")
+        first, numwant, file_name = Protocol.unpack_lookup(body)
+    except (struct.error, ValueError) as e:
+        log(f"Invalid binary message from {clientAddress}: {e}")
+        return Protocol.pack_failure(0, "Invalid message format")
+
+    leecher_id = remember_leecher(clientAddress, file_name)
+    log(f"Leecher {leecher_id} at {clientAddress} requested file: {file_name} (peers from {first})")
+
+    response = lookup_response(file_name, first, numwant)
+    if response is None:
+        return Protocol.pack_failure(transaction, f"No Seeders with the specified file {file_name}.")
+    return Protocol.with_transaction(response, transaction)
+
+
+'''
+Function to answer a multi-file lookup with the first page of every file's swarm, in the order asked. Entries are added
+until the next one would not fit in a datagram; the leecher asks again for the files that were left out.
+'''
+def many_msg(transaction, numwant, file_names, clientAddress):
+    leecher_id = remember_leecher(clientAddress, file_names[-1])
+    log(f"Leecher {leecher_id} at {clientAddress} requested {len(file_names)} files: {file_names[0]} ... {file_names[-1]}")
+
+    entries = []
+    space = Protocol.MAX_DATAGRAM - Protocol.HEADER.size - Protocol.COUNT.size
+    for file_name in file_names:
+        response = lookup_response(file_name, 0, numwant)
+        entry = Protocol.pack_entry(file_name, response[Protocol.HEADER.size:] if response else None)
+        if len(entry) > space:
+            break
+        entries.append(entry)
+        space -= len(entry)
+    return Protocol.pack_peers_many(transaction, entries)
+
+
+# The cached or freshly built binary answer to a lookup, with transaction ID 0, or None if no seeder has the file
+def lookup_response(file_name, first, numwant):
+    form = ("binary", first, numwant)
+    response = cached_response(file_name, form)
+    if response is None:
+        response = binary_reply(file_name, first, numwant)
+        if response is not None:
+            cache_response(file_name, form, response)
+    return response
+
+
+# Build the binary answer to a lookup, with transaction ID 0, or None if no seeder has the file
+def binary_reply(file_name, first, numwant):
+    requested_file, root, holders = find_seeders(file_name)
+    holders = [seeder_info for seeder_info in holders if seeder_info.peer]
+    if requested_file is None:
+        return None
+    counts = None
+    if first == 0:
+        counts = availability(file_name, requested_file.piece_size, requested_file.total_chunks, len(holders))
+        if counts and Protocol.page_capacity(len(counts)) < 1:
+            counts = None  # Too many pieces to send their availability in a datagram
+    page = holders[first:first + min(numwant, Protocol.page_capacity(len(counts or b"")))]
+    return Protocol.pack_peers(0, requested_file.total_chunks, requested_file.piece_size,
+                               requested_file.file_size, root, len(holders), first,
+                               [seeder_info.peer for seeder_info in page], counts)
+
+
+# The cached answer of the given form to a request for file_name, or None
+def cached_response(file_name, form):
+    answers = response_cache.get(file_name)
+    response = answers.get(form) if answers else None
+    if response is None:
+        cache_stats["misses"] += 1
+        return None
+    cache_stats["hits"] += 1
+    response_cache.move_to_end(file_name)
+    return response
+
+
+def cache_response(file_name, form, response):
+    answers = response_cache.setdefault(file_name, {})
+    response_cache.move_to_end(file_name)
+    cache_stats["bytes"] += len(response) - len(answers.get(form, b""))
+    answers[form] = response
+    while cache_stats["bytes"] > RESPONSE_CACHE_BYTES:
+        _, dropped = response_cache.popitem(last=False)
+        cache_stats["bytes"] -= sum(len(answer) for answer in dropped.values())
+
+
+# Drop the cached answers for a file whose seeders or piece availability changed
+def invalidate(file_name):
+    answers = response_cache.pop(file_name, None)
+    if answers:
+        cache_stats["bytes"] -= sum(len(answer) for answer in answers.values())
+
+
+# Method to answer STATS with the size of the tracker's state and how well its answer cache is doing
+def stats_msg():
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    details = {
+        "seeders": len(seeders),
+        "files": len(files_index),
+        "leechers": len(leechers),
+        "partial_files": len(partial_holders),
+        "cache_files": len(response_cache),
+        "cache_bytes": cache_stats["bytes"],
+        "cache_hits": cache_stats["hits"],
+        "cache_misses": cache_stats["misses"],
+        "hit_rate": f"{cache_stats['hits'] / lookups:.3f}" if lookups else "0",
+    }
+    return ("STATS " + " ".join(f"{name}={value}" for name, value in details.items())).encode()
 
 
 # Method to handle the seeder message
@@ -90,151 +373,692 @@ def seeder_msg(message, clientAddress):
     parts = message_str.split()
     IP_address = parts[1]
     Port = parts[2]
-    # Expected format: REGISTER_FILES IP Port filename:filesize,filename:filesize
+    # Expected format: REGISTER_FILES IP Port filename:filesize[:root],filename:filesize[:root] [version=N peer=ID]
     #                  REGISTER_FILEs 127.0.0.1 6000 dataFile.txt:2049,Bfile.txt:906,Afile.txt:1303
+    # root is the hex SHA-256 of the file's piece manifest; older seeders leave it out, along with the version of
+    # their file list and their peer ID
     if len(parts) >= 4 and parts[0] == "REGISTER_FILES":
+        details = dict(item.split('=', 1) for item in parts[4:] if '=' in item)
         available_files_size = parts[3].split(',')
 
-        # Separate filenames and sizes into two lists
+        # Separate filenames, sizes and manifest roots into three lists
         available_files = []
         available_sizes = []
+        available_roots = []
 
         for item in available_files_size:
-            filename, filesize = item.split(':')  # Split each pair by ':'
-            available_files.append(filename)
-            available_sizes.append(filesize)
+            fields = item.split(':')  # Split each entry by ':'
+            available_files.append(fields[0])
+            available_sizes.append(fields[1])
+            available_roots.append(fields[2] if len(fields) > 2 else None)
 
-        seeder_id = f"S{next_seeder_id}"
-        next_seeder_id += 1
+        # A seeder registering again with the same peer ID, or from the same address, keeps its ID and replaces
+        # its file list
+        peer_id = details.get("peer")
+        seeder_id = peer_index.get(peer_id) if peer_id else None
+        if seeder_id is None:
+            seeder_id = address_index.get((IP_address, Port))
+        if seeder_id is not None:
+            remove_seeder(seeder_id)
+        else:
+            seeder_id = f"S{next_seeder_id}"
+            next_seeder_id += 1
 
         # Register a file that does not exist in the seeders dictionary
+        current_time = int(time.time())  # Unix timestamp
         if seeder_id not in seeders:
-            seeders[seeder_id] = {
-                "IP": IP_address,
-                "Port": Port,
-                "Files": {}
-            }
-
-        chunk_size = 1024  # 1 chunk = 1024 bytes
+            seeders[seeder_id] = SeederRecord(IP_address, Port, current_time, int(details.get("version", 0)), peer_id)
 
-        for file_info, file_size in zip(available_files, available_sizes):
-            current_time = int(time.time())  # Unix timestamp
+        for file_info, file_size, root in zip(available_files, available_sizes, available_roots):
             file_id = f"F{next_file_id}"
             next_file_id += 1
+
             # Adding the file to seeder
-            
-            if int(file_size) < chunk_size:
-                seeders[seeder_id]["Files"][file_id] = {
-                    "FileName": file_info,
-                    "FileSize": file_size,
-                    "TotalChunks": 1,
-                    "LastSeen": current_time
-                }
-                
-            if int(file_size) % chunk_size == 0:
-                seeders[seeder_id]["Files"][file_id] = {
-                    "FileName": file_info,
-                    "FileSize": file_size,
-                    "TotalChunks": int(file_size) // chunk_size,
-                    "LastSeen": current_time
-                }
-            else:
-                seeders[seeder_id]["Files"][file_id] = {
-                    "FileName": file_info,
-                    "FileSize": file_size,
-                    "TotalChunks": int(file_size) // chunk_size + 1,
-                    "LastSeen": current_time
-                }
+            seeders[seeder_id].files[file_id] = FileRecord(file_id, file_info, int(file_size), root)
+        index_seeder(seeder_id)
+
+        # Skip the hardcoded seeder S1 if you want to keep it
+        if seeder_id != "S1":
+            schedule_expiry(seeders[seeder_id], seeder_id)
 
         # Log the update
-        print(f"Registered new seeder as {seeder_id} at {clientAddress}")
-        print(f"Files available from {seeder_id}: {available_files}")
+        log(f"Registered new seeder as {seeder_id} at {clientAddress}")
+        log(f"Files available from {seeder_id}: {available_files}")
+        write_journal(" ".join(parts))
 
         # Return the assigned seeder ID to the client
         return f"REGISTERED {seeder_id} : {clientAddress}".encode()
 
+    # The rest of a bulk announce, from a seeder with more files than fit in one datagram
+    # Expected format: REGISTER_MORE IP Port filename:filesize[:root],filename:filesize[:root]
+    # The files are added to the seeder's list; a file it already registered under the same name is replaced
+    elif len(parts) >= 4 and parts[0] == "REGISTER_MORE":
+        seeder_id = address_index.get((IP_address, Port))
+        if seeder_id is None:
+            log(f"More files received from unregistered seeder at {clientAddress}")
+            return "ERROR: Seeder not registered.".encode()
+
+        added = [add_file(seeder_id, item).file_name for item in parts[3].split(',')]
+        seeders[seeder_id].last_seen = int(time.time())
+
+        log(f"More files available from {seeder_id}: {added}")
+        write_journal(" ".join(parts))
+        return f"REGISTERED {seeder_id} : {clientAddress}".encode()
+
+    # A change to the file list of a seeder, numbered one past the last change the tracker applied
+    # Expected format: ADD IP Port version filename:filesize[:root],filename:filesize[:root]
+    #                  REMOVE IP Port version filename,filename
+    # Only the files named are touched. A change the tracker already applied is acknowledged again; after a gap,
+    # or from a seeder it does not know, the tracker asks for the whole list with RESYNC
+    elif len(parts) == 5 and parts[0] in ("ADD", "REMOVE") and parts[3].isdigit():
+        seeder_id = address_index.get((IP_address, Port))
+        seeder_info = seeders.get(seeder_id)
+        version = int(parts[3])
+        if seeder_info is None or version > seeder_info.version + 1:
+            log(f"Change {version} from {seeder_id or clientAddress} does not follow the last one applied, resyncing")
+            return f"RESYNC {seeder_id or '-'}".encode()
+
+        if version == seeder_info.version + 1:
+            if parts[0] == "ADD":
+                changed = [add_file(seeder_id, item).file_name for item in parts[4].split(',')]
+            else:
+                changed = [file_name for file_name in parts[4].split(',') if remove_file(seeder_id, file_name)]
+            seeder_info.version = version
+            log(f"Files {'added to' if parts[0] == 'ADD' else 'removed from'} {seeder_id}: {changed}")
+            write_journal(" ".join(parts))
+        seeder_info.last_seen = int(time.time())
+        return f"UPDATED {seeder_id} version={seeder_info.version}".encode()
+
     # Heartbeat message to update the LastSeen field periodically to track active seeders
-    # Expected format: HEARTBEAT IP Port
-    elif len(parts) == 3 and parts[0] == "HEARTBEAT":
-        seeder_id = None
-        for sid, data in seeders.items():
-            if data["IP"] == IP_address and data["Port"] == Port:
-                seeder_id = sid
-                break
+    # Expected format: HEARTBEAT IP Port [version]
+    # A seeder that sends the version of its file list is asked to RESYNC if the tracker missed a change
+    elif len(parts) in (3, 4) and parts[0] == "HEARTBEAT":
+        seeder_id = address_index.get((IP_address, Port))
 
         if seeder_id:
-            # Update the LastSeen timestamp
-            current_time = int(time.time())  # Unix timestamp
-            # Update LastSeen for all files of this seeder
-            for file_id in seeders[seeder_id]["Files"]:
-                seeders[seeder_id]["Files"][file_id]["LastSeen"] = current_time
+            # Update the LastSeen timestamp; the seeder's expiry timer picks it up when it comes due
+            seeders[seeder_id].last_seen = int(time.time())  # Unix timestamp
 
-            print(f"Heartbeat received from {seeder_id} at {clientAddress} and Processed!")
+            log(f"Heartbeat received from {seeder_id} at {clientAddress} and Processed!")
+            if len(parts) == 4 and parts[3] != str(seeders[seeder_id].version):
+                log(f"{seeder_id} is at version {parts[3]} but the tracker at {seeders[seeder_id].version}, resyncing")
+                return f"RESYNC {seeder_id}".encode()
             # Return acknowledgment message
             return f"HEARTBEAT RECEIVED {seeder_id} : {clientAddress}".encode()
         else:
-            print(f"Heartbeat received from unregistered seeder at {clientAddress}")
+            log(f"Heartbeat received from unregistered seeder at {clientAddress}")
+            if len(parts) == 4:
+                return "RESYNC -".encode()
             return "ERROR: Seeder not registered.".encode()
 
     # Handle unknown message types
     else:
-        print(f"Unknown message type received: {message_str}")
+        log(f"Unknown message type received: {message_str}")
         return "ERROR: Invalid message format.".encode()
 
 
-def remove_inactive_seeders():
+# Method to handle the piece reports of leechers that are partway through a download
+def partial_msg(message, clientAddress):
+    message_str = message.decode()
+
+    # Expected format: HAVE IP Port filename piece_size BITFIELD [peer=ID], where BITFIELD is the base64 of one bit per
+    #                  piece (the first piece is the high bit of the first byte), or DONE once the leecher has the whole file
+    # Leechers all report the same configured IP and Port, so a holder is known by its peer ID; older leechers send none
+    # and are known by their address
+    parts = message_str.split()
+    if len(parts) not in (6, 7):
+        log(f"Unknown message type received: {message_str}")
+        return "ERROR: Invalid message format.".encode()
+    if not parts[4].isdigit():
+        return "ERROR: Invalid piece size.".encode()
+    details = dict(item.split('=', 1) for item in parts[6:] if '=' in item)
+    peer = details.get("peer") or f"{parts[1]},{parts[2]}"
+    file_name = parts[3]
+    piece_size = int(parts[4])
+
+    if parts[5] == "DONE":
+        drop_partial_holder(file_name, peer)
+        return f"HAVE RECEIVED {file_name} : {clientAddress}".encode()
+
+    try:
+        bitfield = base64.b64decode(parts[5], validate=True)
+    except ValueError:
+        return "ERROR: Invalid bitfield.".encode()
+    entry = partial_holders.get(file_name)
+    if entry is None or entry["PieceSize"] != piece_size:
+        # Holders that split the file differently cannot be counted together; the newest piece size wins
+        entry = partial_holders[file_name] = {"PieceSize": piece_size, "Counts": [0] * (len(bitfield) * 8), "Holders": {}}
+        invalidate(file_name)
+    if len(bitfield) * 8 != len(entry["Counts"]):
+        return "ERROR: Bitfield does not match the file.".encode()
+
+    # Count only the pieces that changed since the holder's previous report
+    holder = entry["Holders"].get(peer)
+    previous = holder.bitfield if holder else bytes(len(bitfield))
+    counts = entry["Counts"]
+    for index, (old, new) in enumerate(zip(previous, bitfield)):
+        if old != new:
+            for bit in range(8):
+                mask = 0x80 >> bit
+                if (old ^ new) & mask:
+                    counts[index * 8 + bit] += 1 if new & mask else -1
+    if previous != bitfield:
+        invalidate(file_name)  # The availability in the file's answers changed
+    if holder is None:
+        holder = entry["Holders"][peer] = HolderRecord(bitfield, int(time.time()))
+        schedule_expiry(holder, (file_name, peer))
+    holder.bitfield = bitfield
+    holder.last_seen = int(time.time())
+
+    log(f"Leecher at {peer} holds {sum(bin(byte).count('1') for byte in bitfield)} pieces of {file_name}")
+    return f"HAVE RECEIVED {file_name} : {clientAddress}".encode()
+
+
+def drop_partial_holder(file_name, peer):
+    entry = partial_holders.get(file_name)
+    holder = entry and entry["Holders"].pop(peer, None)
+    if not holder:
+        return
+    counts = entry["Counts"]
+    for index, byte in enumerate(holder.bitfield):
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                counts[index * 8 + bit] -= 1
+    if not entry["Holders"]:
+        del partial_holders[file_name]
+    invalidate(file_name)
+
+
+# Per-piece availability of a file as one byte per piece (full seeders plus partial holders, capped at 255),
+# or None when no partial holder has reported pieces of the file with the same piece size
+def availability(file_name, piece_size, total_chunks, seeder_count):
+    entry = partial_holders.get(file_name)
+    if entry is None or entry["PieceSize"] != piece_size:
+        return None
+    return bytes(min(255, seeder_count + count) for count in entry["Counts"][:total_chunks])
+
+
+# Add a seeder's address and files to the indexes
+def index_seeder(seeder_id):
+    seeder_info = seeders[seeder_id]
+    address_index[(seeder_info.ip, seeder_info.port)] = seeder_id
+    if seeder_info.peer_id:
+        peer_index[seeder_info.peer_id] = seeder_id
+    for file_info in seeder_info.files.values():
+        files_index.setdefault(file_info.file_name, {})[seeder_id] = file_info
+        invalidate(file_info.file_name)
+
+
+# Remove a seeder from the seeders dictionary and from the indexes
+def remove_seeder(seeder_id):
+    seeder_info = seeders.pop(seeder_id)
+    if address_index.get((seeder_info.ip, seeder_info.port)) == seeder_id:
+        del address_index[(seeder_info.ip, seeder_info.port)]
+    if seeder_info.peer_id and peer_index.get(seeder_info.peer_id) == seeder_id:
+        del peer_index[seeder_info.peer_id]
+    for file_info in seeder_info.files.values():
+        holders = files_index.get(file_info.file_name, {})
+        holders.pop(seeder_id, None)
+        if not holders:
+            files_index.pop(file_info.file_name, None)
+        invalidate(file_info.file_name)
+
+
+# Add one filename:filesize[:root] entry to a registered seeder, replacing a file it has under the same name
+def add_file(seeder_id, item):
+    global next_file_id
+    fields = item.split(':')
+    remove_file(seeder_id, fields[0])
+    file_id = f"F{next_file_id}"
+    next_file_id += 1
+    file_info = seeders[seeder_id].files[file_id] = FileRecord(file_id, fields[0], int(fields[1]),
+                                                                fields[2] if len(fields) > 2 else None)
+    files_index.setdefault(file_info.file_name, {})[seeder_id] = file_info
+    invalidate(file_info.file_name)
+    return file_info
+
+
+# Remove a file from a registered seeder and from the file index; returns whether the seeder had it
+def remove_file(seeder_id, file_name):
+    holders = files_index.get(file_name)
+    file_info = holders and holders.pop(seeder_id, None)
+    if not file_info:
+        return False
+    if not holders:
+        del files_index[file_name]
+    del seeders[seeder_id].files[file_info.file_id]
+    invalidate(file_name)
+    return True
+
+
+# Timer that expires inactive seeders and schedules the next check
+def expiry_timer():
+    with state_lock:
+        expire_inactive()
+    call_later(EXPIRY_INTERVAL, expiry_timer)
+
+
+# Start the expiry timer of a seeder or partial holder, due SEEDER_TIMEOUT after it was last seen
+def schedule_expiry(record, key):
+    record.timer = number = next(timer_sequence)
+    heapq.heappush(expiry_heap, (record.last_seen + SEEDER_TIMEOUT, number, key))
+
+
+'''
+Function to remove seeders and partial holders that have not been heard from within SEEDER_TIMEOUT, and leechers
+that have not sent a request within LEECHER_TTL.
+Only the timers that have come due are looked at. A seeder or holder that was heard from since its timer was started
+gets a new timer for SEEDER_TIMEOUT after it was last seen, so heartbeats never touch the heap.
+'''
+def expire_inactive():
+    current_time = int(time.time())  # Get current Unix timestamp
+
+    while expiry_heap and expiry_heap[0][0] < current_time:
+        due, number, key = heapq.heappop(expiry_heap)
+        if isinstance(key, tuple):
+            entry = partial_holders.get(key[0])
+            record = entry and entry["Holders"].get(key[1])
+        else:
+            record = seeders.get(key)
+        if record is None or record.timer != number:
+            continue  # Removed, or registered again with a new timer, since this timer was started
+        if current_time - record.last_seen <= SEEDER_TIMEOUT:
+            schedule_expiry(record, key)
+        elif isinstance(key, tuple):
+            # Forget partial holders that stopped reporting, so their pieces no longer count
+            log(f"Removing inactive partial holder of {key[0]}: {key[1]}... ")
+            drop_partial_holder(*key)
+        else:
+            log(f"Removing inactive seeder: {key}... ")
+            remove_seeder(key)
+            write_journal(f"EXPIRE {key}")
+
+    # Leechers are kept in the order of their last request, so the ones past LEECHER_TTL are at the front
+    while leechers and current_time - next(iter(leechers.values())).last_seen > LEECHER_TTL:
+        leechers.popitem(last=False)
+
+
+'''
+Tracker state across restarts. Every SNAPSHOT_INTERVAL the seeders and their files are written to SNAPSHOT_PATH, and
+between snapshots every registration (REGISTER_FILES, REGISTER_MORE), change (ADD, REMOVE) and expiry is appended
+to JOURNAL_PATH as it happens. Heartbeats, leechers and partial holders are not kept: restored seeders get a full SEEDER_TIMEOUT to send
+their next heartbeat, and leechers report again within seconds.
+The journal is flushed after every record, so it survives the tracker process crashing but not the machine losing power.
+'''
+def write_journal(entry):
+    global journal_records
+    if journal is not None:
+        journal.write(entry + "\n")
+        journal.flush()
+        journal_records += 1
+
+
+'''
+Function to write a snapshot of every seeder and its files and start a new, empty journal. The snapshot goes to a
+temporary file that is renamed over the old one, so a crash leaves one whole snapshot or the other. Snapshot and journal
+carry a generation number; a journal older than the snapshot is already contained in it and is skipped by restore().
+'''
+def write_snapshot():
+    global journal, journal_records, snapshot_generation
+    snapshot_generation += 1
+    state = {
+        "generation": snapshot_generation,
+        "next_seeder_id": next_seeder_id,
+        "next_file_id": next_file_id,
+        "seeders": [(seeder_id, seeder_info.ip, seeder_info.port,
+                     [(file_id, file_info.file_name, file_info.file_size, file_info.root)
+                      for file_id, file_info in seeder_info.files.items()], seeder_info.version, seeder_info.peer_id)
+                    for seeder_id, seeder_info in seeders.items()],
+    }
+    temporary = SNAPSHOT_PATH + ".tmp"
+    with open(temporary, "wb") as file:
+        pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, SNAPSHOT_PATH)
+
+    if journal is not None:
+        journal.close()
+    journal = open(JOURNAL_PATH, "w", encoding="utf-8")
+    write_journal(f"GENERATION {snapshot_generation}")
+    journal_records = 0
+
+
+# Timer that writes a snapshot when anything was journaled since the last one
+def snapshot_timer():
+    if journal_records:
+        with state_lock:
+            write_snapshot()
+    call_later(SNAPSHOT_INTERVAL, snapshot_timer)
+
+
+'''
+Function to rebuild the tracker's state when it starts: load the last snapshot, rebuild the indexes from it and replay
+the journal written since, which stays open for appending until the next snapshot. A record that cannot be replayed,
+such as a line cut short by a crash, is skipped. Nothing is written until the state is rebuilt, so a crash while
+restoring loses nothing.
+'''
+def restore():
+    global log, journal, journal_records, next_seeder_id, next_file_id, snapshot_generation
+    started = time.perf_counter()
+    current_time = int(time.time())
+    try:
+        with open(SNAPSHOT_PATH, "rb") as file:
+            snapshot = file.read()
+    except FileNotFoundError:
+        snapshot = None
+    try:
+        with open(JOURNAL_PATH, encoding="utf-8") as file:
+            text = file.read()
+    except FileNotFoundError:
+        text = ""
+    entries = text.splitlines()
+    # Replayed records must not be journaled again, by a journal left open from an earlier restore()
+    if journal is not None:
+        journal.close()
+        journal = None
+
+    # Hundreds of thousands of records are created and none of them are garbage, so collecting would be wasted work
+    gc.disable()
+    reported, log = log, quiet
+    try:
+        state = pickle.loads(snapshot) if snapshot else {"generation": 0, "next_seeder_id": 1, "next_file_id": 1, "seeders": []}
+        snapshot_generation = state["generation"]
+        next_seeder_id = state["next_seeder_id"]
+        next_file_id = state["next_file_id"]
+        # The indexes are filled here rather than by index_seeder(), as there are no cached answers to drop yet
+        for seeder_id, ip, port, files, *identity in state["seeders"]:  # Older snapshots have no version or peer ID
+            seeder_info = seeders[seeder_id] = SeederRecord(ip, port, current_time, *identity)
+            address_index[(ip, port)] = seeder_id
+            if seeder_info.peer_id:
+                peer_index[seeder_info.peer_id] = seeder_id
+            for file_id, file_name, file_size, root in files:
+                file_info = seeder_info.files[file_id] = FileRecord(file_id, file_name, file_size, root)
+                files_index.setdefault(file_name, {})[seeder_id] = file_info
+            if seeder_id != "S1":
+                schedule_expiry(seeder_info, seeder_id)
+
+        header = f"GENERATION {snapshot_generation}"
+        if entries[:1] != [header]:
+            entries = []  # Left over from before the snapshot was written
+        replayed = 0
+        for entry in entries[1:]:
+            parts = entry.split()
+            try:
+                if parts[0] == "EXPIRE":
+                    if parts[1] in seeders:
+                        remove_seeder(parts[1])
+                else:
+                    seeder_msg(entry.encode(), ("journal", 0))
+                replayed += 1
+            except Exception:
+                continue
+    finally:
+        log = reported
+        gc.enable()
+
+    journal = open(JOURNAL_PATH, "a" if entries else "w", encoding="utf-8")
+    if not entries:
+        write_journal(header)
+    elif not text.endswith("\n"):
+        journal.write("\n")  # End the record cut short, so the next one starts on a line of its own
+    journal_records = replayed
+    log(f"Restored {len(seeders)} seeders with {len(files_index)} files from {SNAPSHOT_PATH} and "
+        f"{replayed} journal records in {time.perf_counter() - started:.3f} s")
+    return len(seeders)
+
+
+# Method to dispatch a message (could be from seeder or leecher) and build the response
+def handle_message(message, clientAddress):
+    with state_lock:
+        return dispatch(message, clientAddress)
+
+
+def dispatch(message, clientAddress):
+    if Protocol.is_binary(message):
+        log(f"Received binary request from leecher at {clientAddress}")
+        return binary_msg(message, clientAddress)
+
+    # Decode the message to determine its type
+    message_str = message.decode()
+    parts = message_str.split()
+
+    # Process based on message type
+    if parts and parts[0] == "REQUEST":
+        log(f"Received request from leecher at {clientAddress}")
+        return leecher_msg(message, clientAddress)
+    elif parts and parts[0] in ("REGISTER_FILES", "REGISTER_MORE", "ADD", "REMOVE", "HEARTBEAT"):
+        log(f"Received request from seeder at {clientAddress}")
+        return seeder_msg(message, clientAddress)
+    elif parts and parts[0] == "STATS":
+        return stats_msg()
+    elif parts and parts[0] == "HAVE":
+        log(f"Received piece report from leecher at {clientAddress}")
+        return partial_msg(message, clientAddress)
+    else:
+        log(f"Received unknown message type: {message_str}")
+        return "ERROR: Unknown message type".encode()
+
+
+# Run callback on the tracker loop after delay seconds
+def call_later(delay, callback):
+    heapq.heappush(timers, (time.monotonic() + delay, next(timer_sequence), callback))
+
+
+# Seconds until the next timer is due, or None to wait for a message however long it takes
+def next_timeout():
+    return max(0, timers[0][0] - time.monotonic()) if timers else None
+
+
+# Run the timers that are due
+def run_timers():
+    while timers and timers[0][0] <= time.monotonic():
+        callback = heapq.heappop(timers)[2]
+        try:
+            callback()
+        except Exception as e:
+            log(f"Error in timer: {e}")
+
+
+'''
+Function to run the tracker on a bound UDP socket. The loop sleeps in the selector until a datagram arrives or the next
+timer is due, so an idle tracker uses no CPU and a message is answered as soon as it arrives.
+on_reply(message, clientAddress, response) is called after every answer, for the GUI to show the traffic.
+In a worker process, owner is the worker's pipe to the owner process (see serve_workers()).
+'''
+def serve(sock, on_reply=None, owner=None):
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    if owner is not None:
+        selector.register(owner, selectors.EVENT_READ)
+    call_later(EXPIRY_INTERVAL, expiry_timer)
+    if journal is not None:
+        call_later(SNAPSHOT_INTERVAL, snapshot_timer)
+
     while True:
-        current_time = int(time.time())  # Get current Unix timestamp
-        inactive_seeders = []
+        for key, events in selector.select(next_timeout()):
+            if key.fileobj is owner:
+                receive_from_owner(sock, owner)
+            else:
+                receive_datagrams(sock, on_reply, owner)
+        run_timers()
 
-        # Identify inactive seeders
-        for seeder_id, seeder_info in list(seeders.items()):
-            # Skip the hardcoded seeder S1 if you want to keep it
-            if seeder_id == "S1":
+
+# Answer every datagram that is already queued before sleeping again
+def receive_datagrams(sock, on_reply, owner):
+    while True:
+        try:
+            message, clientAddress = sock.recvfrom(65535)
+        except BlockingIOError:
+            break
+        except OSError as e:  # e.g. ICMP port unreachable from an earlier reply, reported on Windows
+            log(f"Error in main loop: {e}")
+            continue
+        try:
+            # A worker answers file requests from its copy of the state and passes everything that changes the
+            # state to the owner, which answers it. If the owner is too far behind to take it, the message is
+            # dropped like a lost datagram and the peer sends it again.
+            if owner is not None and not read_only(message):
+                try:
+                    owner.send(pickle.dumps((message, clientAddress)), socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    pass
                 continue
+            response = handle_message(message, clientAddress)
+            sock.sendto(response, clientAddress)
+            if on_reply:
+                on_reply(message, clientAddress, response)
+        except Exception as e:
+            log(f"Error in main loop: {e}")
 
-            for file_id, file_info in list(seeder_info["Files"].items()):
-                if current_time - file_info["LastSeen"] > SEEDER_TIMEOUT:
-                    inactive_seeders.append(seeder_id)
-                    break  # No need to check more files, mark seeder for removal
 
-        # Remove inactive seeders
-        for seeder_id in inactive_seeders:
-            print(f"Removing inactive seeder: {seeder_id}... ")
-            del seeders[seeder_id]
+# File lookups, text or binary, and STATS only read the state; each worker reports its own cache in STATS
+def read_only(message):
+    return message.startswith((b"REQUEST", b"STATS")) or Protocol.is_binary(message)
 
-        time.sleep(10)  # Run check every 10 seconds
 
+'''
+Multi-process tracker. WORKERS processes bind the tracker port with SO_REUSEPORT, so the kernel spreads datagrams
+across them, and each answers file requests from its own copy of the state. Registrations, heartbeats and piece
+reports go through a single owner process, which handles them in arrival order and hands the answer back to the
+worker to send. Every BATCH_INTERVAL seconds, or sooner once BATCH_BYTES have built up, the owner sends the messages
+it handled to every worker, which replays them in the same order, so every copy follows the owner's state at most
+BATCH_INTERVAL behind. Every process expires seeders on its own timers, from the heartbeats it has applied.
+Workers and owner talk over Unix SOCK_SEQPACKET socket pairs. A worker never waits on the owner, and the owner only
+waits on workers, which always read promptly, so the processes cannot deadlock on each other. A worker exits when the
+owner does.
+'''
+def serve_workers(ip, port, workers):
+    connections = []
+    for _ in range(workers):
+        owner_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = multiprocessing.Process(target=run_worker, args=(ip, port, worker_end, connections + [owner_end]))
+        process.daemon = True
+        process.start()
+        worker_end.close()
+        connections.append(owner_end)
+    run_owner(connections)
 
-# Start the background thread for removing inactive seeders
-threading.Thread(target=remove_inactive_seeders, daemon=True).start()
 
-# Main loop to receive messages
-while True:
-    try:
-        # Receive a message (could be from seeder or leecher)
-        message, clientAddress = tracker_socket.recvfrom(2048)
-
-        # Decode the message to determine its type
-        message_str = message.decode()
-        parts = message_str.split()
-
-        # Process based on message type
-        if parts and parts[0] == "REQUEST":
-            print(f"Received request from leecher at {clientAddress}")
-            response = leecher_msg(message, clientAddress)
-        elif parts and (parts[0] == "REGISTER_FILES" or parts[0] == "HEARTBEAT"):
-            print(f"Received request from seeder at {clientAddress}")
-            response = seeder_msg(message, clientAddress)
-        else:
-            print(f"Received unknown message type: {message_str}")
-            response = "ERROR: Unknown message type".encode()
+# inherited are the owner's ends of the socket pairs; the worker closes its copies so it sees the owner exit.
+# Only the owner writes the journal and snapshots
+def run_worker(ip, port, owner, inherited):
+    global journal
+    for conn in inherited:
+        conn.close()
+    if journal is not None:
+        journal.close()
+        journal = None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((ip, port))
+    serve(sock, owner=owner)
+
+
+# Answers from the owner are sent to the client; batches of state changes are replayed on this worker's copy
+def receive_from_owner(sock, owner):
+    global log
+    while True:
+        try:
+            data = owner.recv(OWNER_BUFFER, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+        if not data:
+            raise SystemExit  # The owner has exited
+        kind, payload = pickle.loads(data)
+        if kind == "reply":
+            response, clientAddress = payload
+            sock.sendto(response, clientAddress)
+            continue
+        reported, log = log, quiet  # The owner has already logged these messages
+        try:
+            for message, clientAddress in payload:
+                handle_message(message, clientAddress)
+        finally:
+            log = reported
+
+
+def run_owner(connections):
+    selector = selectors.DefaultSelector()
+    for conn in connections:
+        selector.register(conn, selectors.EVENT_READ)
+    call_later(EXPIRY_INTERVAL, expiry_timer)
+    if journal is not None:
+        call_later(SNAPSHOT_INTERVAL, snapshot_timer)
+    batch, batch_bytes, flush_at = [], 0, None
+
+    while True:
+        timeout = next_timeout()
+        if flush_at is not None:
+            timeout = max(0, min(timeout if timeout is not None else BATCH_INTERVAL, flush_at - time.monotonic()))
+        for key, events in selector.select(timeout):
+            conn = key.fileobj
+            while True:
+                try:
+                    data = conn.recv(OWNER_BUFFER, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                if not data:
+                    log("A tracker worker process has exited")
+                    selector.unregister(conn)
+                    connections.remove(conn)
+                    break
+                message, clientAddress = pickle.loads(data)
+                try:
+                    response = handle_message(message, clientAddress)
+                except Exception as e:
+                    log(f"Error in main loop: {e}")
+                    continue
+                conn.send(pickle.dumps(("reply", (response, clientAddress))))
+                batch.append((message, clientAddress))
+                batch_bytes += len(message) + 64
+                if flush_at is None:
+                    flush_at = time.monotonic() + BATCH_INTERVAL
+                if batch_bytes >= BATCH_BYTES:
+                    send_batch(connections, batch)
+                    batch, batch_bytes, flush_at = [], 0, None
+
+        if batch and time.monotonic() >= flush_at:
+            send_batch(connections, batch)
+            batch, batch_bytes, flush_at = [], 0, None
+        run_timers()
+
+
+def send_batch(connections, batch):
+    data = pickle.dumps(("apply", batch))
+    for conn in connections:
+        conn.send(data)
+
+
+def quiet(message):
+    pass
+
+
+def main():
+    global tracker_socket
+
+    print("The server is ready to receive and is listening on " + tracker_IP)
+
+    # Workers are started from the restored state, so they hold it too
+    if PERSIST_STATE:
+        restore()
+
+    if WORKERS > 1:
+        if hasattr(socket, "SO_REUSEPORT"):
+            serve_workers(tracker_IP, tracker_port, WORKERS)
+            return
+        log("SO_REUSEPORT is not available here; running a single tracker process")
+
+    # Create the UDP socket shared by leechers and seeders
+    tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # Bind socket to the tracker port
+    tracker_socket.bind((tracker_IP, tracker_port))
+
+    # Main loop to receive messages and expire inactive seeders
+    serve(tracker_socket)
 
-        # Send the response
-        tracker_socket.sendto(response, clientAddress)
 
-    except BlockingIOError:
-        # No message available from any client
-        pass
-    except Exception as e:
-        print(f"Error in main loop: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+'''
+Tests for the Leecher's conversations with the tracker and for its download engine. The tracker's message handler is
+called in-process, and the leecher's datagrams are caught on a loopback socket standing in for the tracker. The engine
+downloads from stub seeders that answer every chunk request from a table, without any sockets.
+
+    python -m unittest test_leecher
+'''
+
+import base64
+import socket
+import threading
+import unittest
+
+import Leecher
+import Protocol
+import Tracker
+
+
+def reset_tracker():
+    for table in (Tracker.seeders, Tracker.files_index, Tracker.address_index, Tracker.peer_index, Tracker.leechers,
+                  Tracker.partial_holders, Tracker.response_cache, Tracker.expiry_heap):
+        table.clear()
+
+
+class FakeTracker:
+    # A UDP socket in place of the tracker, that hands what the leecher sends to the tracker's message handler
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(5)
+        self.saved = Leecher.ip_address, Leecher.port_number
+        Leecher.ip_address, Leecher.port_number = self.sock.getsockname()
+
+    def handle(self):
+        message, address = self.sock.recvfrom(65535)
+        return Tracker.handle_message(message, address)
+
+    # Answer the next binary lookup from another thread with the PEERS page answer(transaction) returns
+    def answer_lookup(self, answer):
+        def respond():
+            message, address = self.sock.recvfrom(65535)
+            _, transaction, _ = Protocol.unpack_header(message)
+            self.sock.sendto(answer(transaction), address)
+
+        thread = threading.Thread(target=respond, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        Leecher.ip_address, Leecher.port_number = self.saved
+        self.sock.close()
+
+
+class ReportPiecesTest(unittest.TestCase):
+    def setUp(self):
+        reset_tracker()
+        self.saved_log, Tracker.log = Tracker.log, Tracker.quiet
+        self.tracker = FakeTracker()
+        self.info = Leecher.FileInfo("shared.bin", [], 8, 16384, 8 * 16384, None, None)
+
+    def tearDown(self):
+        self.tracker.close()
+        Tracker.log = self.saved_log
+        reset_tracker()
+
+    def report(self, bitfield, peer_id):
+        Leecher.report_pieces(self.info, bitfield, peer_id)
+        return self.tracker.handle()
+
+    def test_two_leechers_are_counted_apart(self):
+        # Both leechers report the same configured address; only their peer IDs tell them apart
+        self.report(bytes([0b11110000]), "leecher-a")
+        self.report(bytes([0b00001111]), "leecher-b")
+        entry = Tracker.partial_holders["shared.bin"]
+        self.assertEqual(entry["Counts"], [1] * 8)
+        self.assertEqual(set(entry["Holders"]), {"leecher-a", "leecher-b"})
+
+    def test_a_report_replaces_only_its_own_leechers_pieces(self):
+        self.report(bytes([0b11110000]), "leecher-a")
+        self.report(bytes([0b00001111]), "leecher-b")
+        self.report(bytes([0b11111100]), "leecher-a")
+        self.assertEqual(Tracker.partial_holders["shared.bin"]["Counts"], [1, 1, 1, 1, 2, 2, 1, 1])
+
+    def test_a_finished_leecher_leaves_the_others_counted(self):
+        self.report(bytes([0b11110000]), "leecher-a")
+        self.report(bytes([0b00001111]), "leecher-b")
+        self.report(None, "leecher-a")
+        self.assertEqual(Tracker.partial_holders["shared.bin"]["Counts"], [0, 0, 0, 0, 1, 1, 1, 1])
+
+    def test_reports_without_a_peer_id_are_known_by_address(self):
+        bitfield = base64.b64encode(bytes([0b10000000])).decode()
+        Tracker.handle_message(f"HAVE 10.0.0.1 6010 shared.bin 16384 {bitfield}".encode(), ("10.0.0.1", 40000))
+        self.assertEqual(set(Tracker.partial_holders["shared.bin"]["Holders"]), {"10.0.0.1,6010"})
+
+
+class LookupBinaryTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = FakeTracker()
+
+    def tearDown(self):
+        self.tracker.close()
+
+    def lookup(self, total, peers):
+        answer = lambda transaction: Protocol.pack_peers(transaction, 4, 16384, 4 * 16384, None, total, 0, peers)
+        responder = self.tracker.answer_lookup(answer)
+        info = Leecher.lookup_binary("shared.bin", Tracker.quiet)
+        responder.join()
+        return info
+
+    def test_an_empty_swarm_gives_no_seeders(self):
+        info = self.lookup(0, [])
+        self.assertEqual(info.seeders, [])
+        self.assertEqual((info.total_chunks, info.piece_size, info.file_size), (4, 16384, 4 * 16384))
+
+    def test_a_first_page_without_peers_gives_no_seeders(self):
+        # The tracker counts a holder it could not put in the page, such as one without an IPv4 address
+        info = self.lookup(1, [])
+        self.assertEqual(info.seeders, [])
+
+    def test_a_first_page_with_peers_gives_them(self):
+        info = self.lookup(1, [Protocol.pack_peer("127.0.0.1", 7000)])
+        self.assertEqual(info.seeders, ["127.0.0.1,7000"])
+
+
+class StubSeeders:
+    # Stands in for the seeders of a download: every seeder answers single-shot requests with answer(seeder, chunk_id),
+    # which returns the chunk or None for an error answer, and the seeders in refusing turn every connection away
+    def __init__(self, answer, refusing=()):
+        self.answer = answer
+        self.refusing = set(refusing)
+        self.saved = Leecher.SeederSession, Leecher.fetch_piece_legacy
+        Leecher.SeederSession, Leecher.fetch_piece_legacy = self.session, self.fetch
+
+    def session(self, seeder_ip, seeder_port):
+        if f"{seeder_ip},{seeder_port}" in self.refusing:
+            raise ConnectionRefusedError("connection refused")
+        raise Leecher.SessionUnsupportedError("legacy seeder")
+
+    def fetch(self, seeder_ip, seeder_port, file_name, chunk_id, piece_size):
+        return self.answer(f"{seeder_ip},{seeder_port}", chunk_id)
+
+    def close(self):
+        Leecher.SeederSession, Leecher.fetch_piece_legacy = self.saved
+
+
+def seeder_list(count):
+    return [f"127.0.0.1,{7000 + index}" for index in range(count)]
+
+
+class DownloadEngineTest(unittest.TestCase):
+    # Backoffs and cooldowns short enough for the tests to wait them out
+    TIMINGS = {"RETRY_BASE_DELAY": 0.001, "RETRY_MAX_DELAY": 0.01, "BREAKER_COOLDOWN": 0.01,
+               "TRACKER_REFRESH_INTERVAL": 0.0}
+
+    def setUp(self):
+        self.saved = {name: getattr(Leecher, name) for name in self.TIMINGS}
+        for name, value in self.TIMINGS.items():
+            setattr(Leecher, name, value)
+        self.stubs = None
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(Leecher, name, value)
+        if self.stubs:
+            self.stubs.close()
+
+    def download(self, seeders, chunks, answer, refusing=(), **options):
+        self.stubs = StubSeeders(answer, refusing)
+        engine = Leecher.DownloadEngine("shared.bin", seeders, log=Tracker.quiet, **options)
+        results = {}
+        runner = threading.Thread(target=lambda: results.update(engine.run(range(chunks))), daemon=True)
+        runner.start()
+        runner.join(10)
+        self.assertFalse(runner.is_alive(), "the download did not finish")
+        self.assertEqual(sorted(results), list(range(chunks)))
+        return engine, results
+
+    def test_seeders_without_a_worker_hand_their_chunks_on(self):
+        # Round robin queues chunks on all ten seeders, but only eight of them get a worker
+        engine, results = self.download(seeder_list(10), 40, lambda seeder, chunk_id: b"data", max_workers=8,
+                                        max_per_seeder=1, scheduler="roundrobin")
+        self.assertTrue(all(result.ok for result in results.values()))
+
+    def test_a_seeder_that_keeps_failing_is_dropped(self):
+        [seeder] = seeder_list(1)
+        engine, results = self.download([seeder], 4, lambda seeder, chunk_id: b"data", refusing=[seeder])
+        self.assertTrue(engine.breakers[seeder].dropped())
+        self.assertEqual({result.error for result in results.values()}, {"no seeders left"})
+
+    def test_a_failed_chunk_moves_to_another_seeder(self):
+        flaky, steady = seeder_list(2)
+        answer = lambda seeder, chunk_id: None if seeder == flaky and chunk_id == 3 else b"data"
+        engine, results = self.download([flaky, steady], 8, answer)
+        self.assertTrue(all(result.ok for result in results.values()))
+        self.assertEqual(results[3].seeder, steady)
+
+    def test_a_chunk_no_seeder_can_send_is_given_up(self):
+        answer = lambda seeder, chunk_id: None if chunk_id == 0 else b"data"
+        engine, results = self.download(seeder_list(2), 4, answer)
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].error, "seeder reported an error")
+        self.assertEqual(engine.attempts[0], Leecher.MAX_CHUNK_ATTEMPTS)
+        self.assertTrue(all(results[chunk_id].ok for chunk_id in range(1, 4)))
+
+    def test_a_refresh_brings_in_a_new_seeder(self):
+        gone, fresh = seeder_list(2)
+        engine, results = self.download([gone], 4, lambda seeder, chunk_id: b"data", refusing=[gone],
+                                        refresh=lambda: [gone, fresh])
+        self.assertGreaterEqual(engine.refreshes, 1)
+        self.assertEqual({result.seeder for result in results.values()}, {fresh})
+        self.assertTrue(all(result.ok for result in results.values()))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_backoff_doubles_up_to_the_limit(self):
+        delays = [Leecher.backoff_delay(attempt) for attempt in range(8)]
+        self.assertEqual(delays[:3], [Leecher.RETRY_BASE_DELAY * factor for factor in (1, 2, 4)])
+        self.assertEqual(max(delays), Leecher.RETRY_MAX_DELAY)
+
+    def test_failures_in_a_row_trip_the_breaker(self):
+        breaker = Leecher.CircuitBreaker()
+        tripped = [breaker.failure(100.0) for _ in range(Leecher.BREAKER_THRESHOLD)]
+        self.assertEqual(tripped, [False] * (Leecher.BREAKER_THRESHOLD - 1) + [True])
+        self.assertTrue(breaker.is_open(100.0))
+        self.assertFalse(breaker.is_open(100.0 + Leecher.BREAKER_COOLDOWN))
+
+    def test_a_delivered_chunk_closes_the_breaker(self):
+        breaker = Leecher.CircuitBreaker()
+        for _ in range(Leecher.BREAKER_THRESHOLD - 1):
+            breaker.failure(100.0)
+        breaker.success()
+        self.assertFalse(breaker.failure(100.0))
+        self.assertEqual(breaker.trips, 0)
+
+    def test_a_breaker_that_trips_too_often_drops_the_seeder(self):
+        breaker = Leecher.CircuitBreaker()
+        now = 100.0
+        while not breaker.dropped():
+            breaker.failure(now)
+            now += Leecher.BREAKER_COOLDOWN * 2 ** breaker.trips
+        self.assertEqual(breaker.trips, Leecher.BREAKER_MAX_TRIPS + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
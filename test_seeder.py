@@ -0,0 +1,237 @@
+'''
+Tests for the Seeder's upload limit, the event loop server's turns between leechers and its manifest workers, and for
+published libraries. The server's methods are called directly on connections made of socket pairs, so no leecher and no
+serving thread is needed; libraries are scanned in a temporary folder.
+
+    python -m unittest test_seeder
+'''
+
+import math
+import os
+import selectors
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import Protocol
+import Seeder
+import Tracker
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_no_limit_never_waits(self):
+        bucket = Seeder.TokenBucket(0)
+        self.assertEqual(bucket.available(), math.inf)
+        self.assertEqual(bucket.delay(1 << 30), 0)
+        bucket.take(1 << 30)
+
+    def test_a_full_bucket_allows_a_burst_then_the_rate(self):
+        bucket = Seeder.TokenBucket(1000, burst=500)
+        self.assertEqual(bucket.available(), 500)
+        bucket.consume(500)
+        self.assertLess(bucket.available(), 50)
+        self.assertAlmostEqual(bucket.delay(100), 0.1, delta=0.05)
+        self.assertAlmostEqual(bucket.delay(1 << 20), 0.5, delta=0.05)  # Never more than a full bucket
+
+    def test_a_new_limit_starts_from_a_full_bucket(self):
+        bucket = Seeder.TokenBucket(1000, burst=500)
+        bucket.consume(500)
+        bucket.setRate(0)
+        bucket.setRate(1000)
+        self.assertEqual(bucket.available(), 500)
+
+
+class EventLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Seeder.EventLoopServer("127.0.0.1", 0, log=Tracker.quiet)
+        self.saved = Seeder.uploadLimit.rate, Seeder.uploadLimit.burst
+        Seeder.setUploadLimit(0)
+        self.sockets = []
+
+    def tearDown(self):
+        Seeder.setUploadLimit(*self.saved)
+        for sock in self.sockets:
+            sock.close()
+        self.server.selector.close()
+        for sock in (self.server.listenSock, self.server.wakeReader, self.server.wakeWriter):
+            sock.close()
+
+    # A leecher's connection as the event loop sees it, and the leecher's end of it
+    def connect(self, port, send_buffer=None):
+        ours, theirs = socket.socketpair()
+        if send_buffer:
+            ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+        ours.setblocking(False)
+        self.sockets += [ours, theirs]
+        return Seeder.LeecherConnection(ours, ("127.0.0.1", port)), theirs
+
+
+class EventLoopTurnsTest(EventLoopTest):
+    def test_allowance_stops_at_a_manifest_being_hashed(self):
+        conn, _ = self.connect(1)
+        for item in (b"a" * 10, Seeder.PendingReply(["MANIFEST", "f.bin", "16384"]), b"b" * 10):
+            self.server.queue(conn, item)
+        self.assertEqual(self.server.allowance(conn), 10)
+        Seeder.setUploadLimit(1000)
+        conn.deficit = 4
+        self.assertEqual(self.server.allowance(conn), 4)
+
+    def test_writeTo_sends_part_of_an_answer(self):
+        conn, leecher = self.connect(2)
+        self.server.queue(conn, b"x" * 100)
+        self.assertEqual(self.server.writeTo(conn, 30), 30)
+        self.assertEqual((bytes(conn.outbuf[0]), conn.queued, conn.sent), (b"x" * 70, 70, 30))
+        self.assertEqual(leecher.recv(100), b"x" * 30)
+        self.assertEqual(Seeder.uploaded[conn.addr], 30)
+
+    def test_writeTo_waits_for_a_full_socket_buffer(self):
+        conn, _ = self.connect(3, send_buffer=4096)
+        self.server.queue(conn, b"x" * (1 << 20))
+        sent = self.server.writeTo(conn, 1 << 20)
+        self.assertLess(sent, 1 << 20)
+        self.assertTrue(conn.blocked)
+        self.assertTrue(self.server.selector.get_key(conn.sock).events & selectors.EVENT_WRITE)
+
+    def test_without_a_limit_a_large_answer_goes_out_in_one_turn(self):
+        conn, _ = self.connect(4)
+        self.server.queue(conn, b"x" * (4 * Seeder.DRR_QUANTUM))
+        self.server.sendRound()
+        self.assertGreater(conn.sent, Seeder.DRR_QUANTUM)
+
+    def test_with_a_limit_every_leecher_gets_a_quantum_a_turn(self):
+        Seeder.setUploadLimit(1 << 30, 1 << 30)
+        greedy, _ = self.connect(5)
+        modest, _ = self.connect(6)
+        for _ in range(8):
+            self.server.queue(greedy, b"x" * Seeder.DRR_QUANTUM)
+        self.server.queue(modest, b"y" * (2 * Seeder.DRR_QUANTUM))  # One answer larger than the quantum
+        self.server.sendRound()
+        self.assertEqual((greedy.sent, modest.sent), (Seeder.DRR_QUANTUM, Seeder.DRR_QUANTUM))
+        self.assertEqual(list(self.server.active), [greedy, modest])
+
+    def test_a_blocked_leecher_keeps_its_deficit(self):
+        Seeder.setUploadLimit(1 << 30, 1 << 30)
+        conn, _ = self.connect(7, send_buffer=4096)
+        self.server.queue(conn, b"x" * (4 * Seeder.DRR_QUANTUM))
+        self.server.sendRound()
+        self.assertTrue(conn.blocked)
+        self.assertFalse(conn.active)
+        self.assertEqual(conn.deficit, Seeder.DRR_QUANTUM - conn.sent)
+
+
+class ManifestWorkersTest(EventLoopTest):
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()
+        path = os.path.join(self.folder.name, "shared.bin")
+        with open(path, "wb") as file:
+            file.write(os.urandom(1 << 20))
+        Seeder.sharedPaths["shared.bin"] = path
+        self.request = ["MANIFEST", "shared.bin", str(Protocol.piece_size_for(1 << 20))]
+        self.hashed_by = []
+        self.saved_hashes = Protocol.piece_hashes
+        Protocol.piece_hashes = self.counting_hashes
+
+    def tearDown(self):
+        Protocol.piece_hashes = self.saved_hashes
+        Seeder.sharedPaths.pop("shared.bin")
+        Seeder.manifestCache = Seeder.ManifestCache()
+        self.folder.cleanup()
+        super().tearDown()
+
+    def counting_hashes(self, *args):
+        self.hashed_by.append(threading.current_thread())
+        return self.saved_hashes(*args)
+
+    def wait_for_worker(self):
+        deadline = time.monotonic() + 5
+        while not self.server.finished:
+            self.assertLess(time.monotonic(), deadline, "no worker finished the manifest")
+            time.sleep(0.01)
+
+    def test_a_manifest_evicted_before_it_is_answered_is_hashed_again_by_a_worker(self):
+        conn, _ = self.connect(8)
+        self.server.queueManifest(conn, self.request)
+        self.wait_for_worker()
+        Seeder.manifestCache = Seeder.ManifestCache()   #evicted before the loop got to it
+        self.server.finishManifests()
+        self.assertIsInstance(conn.outbuf[0], Seeder.PendingReply)
+        self.wait_for_worker()
+        self.server.finishManifests()
+        self.assertTrue(conn.outbuf[0].startswith(b"MANIFEST "))
+        self.assertEqual(len(self.hashed_by), 2)
+        self.assertNotIn(threading.current_thread(), self.hashed_by)
+
+
+class LibraryTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.settled = time.time() - 2 * Seeder.LIBRARY_SETTLE
+        for name in ("a.bin", "shelf/b.bin"):
+            self.write(name, os.urandom(200000))
+        self.libraries = []
+        self.hashed = []
+        self.saved_hashes = Protocol.piece_hashes
+        Protocol.piece_hashes = lambda path, piece_size: self.hashed.append(path) or self.saved_hashes(path, piece_size)
+
+    def tearDown(self):
+        Protocol.piece_hashes = self.saved_hashes
+        for library in self.libraries:
+            library.close()
+        Seeder.manifestCache = Seeder.ManifestCache()
+        self.folder.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.folder.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+        os.utime(path, (self.settled, self.settled))
+
+    # A seeder publishing the folder, as it does after every start
+    def publish(self):
+        Seeder.manifestCache = Seeder.ManifestCache()
+        library = Seeder.Library(self.folder.name)
+        self.libraries.append(library)
+        changed, removed = library.scan()
+        return library, changed
+
+    def test_a_restart_hashes_nothing_and_reads_the_digests_back(self):
+        first, changed = self.publish()
+        self.assertEqual((first.hashed, sorted(entry.split(":")[0] for entry in changed)), (2, ["a.bin", "shelf/b.bin"]))
+        expected = {name: Seeder.manifestFor(name) for name in ("a.bin", "shelf/b.bin")}
+        first.close()
+        self.hashed.clear()
+
+        second, changed = self.publish()
+        self.assertEqual(second.hashed, 0)
+        self.assertEqual(sorted(changed), sorted(first.entries()))
+        self.assertEqual({name: Seeder.manifestFor(name) for name in expected}, expected)
+        self.assertEqual(self.hashed, [])
+
+    def test_only_a_changed_file_is_hashed_again(self):
+        first, _ = self.publish()
+        first.close()
+        self.write("a.bin", os.urandom(300000))
+        self.hashed.clear()
+        second, _ = self.publish()
+        self.assertEqual(second.hashed, 1)
+        self.assertEqual(self.hashed, [os.path.join(self.folder.name, "a.bin")])
+
+    def test_digests_that_do_not_match_the_root_are_hashed_again(self):
+        first, _ = self.publish()
+        expected = Seeder.manifestFor("a.bin")
+        first.close()
+        with open(os.path.join(self.folder.name, Seeder.LIBRARY_DIGESTS), "r+b") as digests:
+            digests.seek(first.files["a.bin"][3])
+            digests.write(bytes(32))
+        self.hashed.clear()
+        second, _ = self.publish()
+        self.assertEqual(Seeder.manifestFor("a.bin"), expected)
+        self.assertEqual(self.hashed, [os.path.join(self.folder.name, "a.bin")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,255 @@
+'''
+Tests for the Tracker's handling of seeder and leecher messages. Messages are passed to the tracker's message handler
+in-process, and its dictionaries and indexes are checked afterwards.
+
+    python -m unittest test_tracker
+'''
+
+import os
+import tempfile
+import time
+import unittest
+
+import Protocol
+import Tracker
+
+ROOT = bytes(32).hex()
+
+
+def reset_tracker():
+    for table in (Tracker.seeders, Tracker.files_index, Tracker.address_index, Tracker.peer_index, Tracker.leechers,
+                  Tracker.partial_holders, Tracker.response_cache, Tracker.expiry_heap):
+        table.clear()
+    Tracker.cache_stats.update(hits=0, misses=0, bytes=0)
+
+
+def send(message, address=("127.0.0.1", 40000)):
+    return Tracker.handle_message(message.encode(), address).decode()
+
+
+def register(port, *files, version=None, peer=None):
+    entries = ",".join(f"{file_name}:{1 << 20}:{ROOT}" for file_name in files)
+    details = (f" version={version}" if version is not None else "") + (f" peer={peer}" if peer else "")
+    reply = send(f"REGISTER_FILES 127.0.0.1 {port} {entries}{details}")
+    return reply.split()[1]
+
+
+def lookup(file_name):
+    return send(f"REQUEST {file_name} V2")
+
+
+class TrackerTest(unittest.TestCase):
+    def setUp(self):
+        reset_tracker()
+        self.saved_log, Tracker.log = Tracker.log, Tracker.quiet
+
+    def tearDown(self):
+        Tracker.log = self.saved_log
+        reset_tracker()
+
+    # The indexes hold exactly what the seeders dictionary says
+    def assertIndexed(self):
+        files, addresses, peers = {}, {}, {}
+        for seeder_id, seeder_info in Tracker.seeders.items():
+            addresses[(seeder_info.ip, seeder_info.port)] = seeder_id
+            if seeder_info.peer_id:
+                peers[seeder_info.peer_id] = seeder_id
+            for file_info in seeder_info.files.values():
+                files.setdefault(file_info.file_name, {})[seeder_id] = file_info
+        self.assertEqual(Tracker.files_index, files)
+        self.assertEqual(Tracker.address_index, addresses)
+        self.assertEqual(Tracker.peer_index, peers)
+
+
+class IndexTest(TrackerTest):
+    def test_registered_files_are_indexed(self):
+        first = register(7001, "a.bin", "b.bin")
+        second = register(7002, "b.bin", peer="seeder-two")
+        self.assertIndexed()
+        self.assertEqual(set(Tracker.files_index["b.bin"]), {first, second})
+        self.assertEqual(Tracker.peer_index, {"seeder-two": second})
+
+    def test_a_lookup_lists_every_seeder_of_the_file(self):
+        register(7001, "a.bin")
+        register(7002, "a.bin")
+        register(7003, "c.bin")
+        reply = lookup("a.bin").split()
+        self.assertEqual(reply[0], "PEERS")
+        self.assertEqual(set(reply[-2:]), {"127.0.0.1,7001", "127.0.0.1,7002"})
+        self.assertTrue(lookup("missing.bin").startswith("No Seeders"))
+
+    def test_registering_again_replaces_the_file_list(self):
+        seeder_id = register(7001, "a.bin", "b.bin")
+        self.assertEqual(register(7001, "c.bin"), seeder_id)
+        self.assertIndexed()
+        self.assertEqual(set(Tracker.files_index), {"c.bin"})
+
+    def test_a_seeder_keeps_its_id_at_a_new_address(self):
+        seeder_id = register(7001, "a.bin", peer="moving")
+        self.assertEqual(register(7009, "a.bin", peer="moving"), seeder_id)
+        self.assertIndexed()
+        self.assertEqual(Tracker.address_index, {("127.0.0.1", "7009"): seeder_id})
+
+    def test_a_removed_seeder_leaves_no_trace(self):
+        seeder_id = register(7001, "a.bin", peer="leaving")
+        register(7002, "a.bin")
+        Tracker.remove_seeder(seeder_id)
+        self.assertIndexed()
+        self.assertEqual(lookup("a.bin").split()[-1], "127.0.0.1,7002")
+
+
+class ExpiryTest(TrackerTest):
+    # Restart every seeder's timer as if it was last heard from `ago` seconds ago
+    def last_heard(self, **ago):
+        Tracker.expiry_heap.clear()
+        for seeder_id, seconds in ago.items():
+            seeder_info = Tracker.seeders[seeder_id]
+            seeder_info.last_seen = int(time.time()) - seconds
+            Tracker.schedule_expiry(seeder_info, seeder_id)
+
+    def test_only_seeders_past_the_timeout_are_removed(self):
+        stale, fresh = register(7001, "a.bin"), register(7002, "a.bin")
+        self.last_heard(**{stale: Tracker.SEEDER_TIMEOUT + 5, fresh: 1})
+        Tracker.expire_inactive()
+        self.assertEqual(set(Tracker.seeders), {fresh})
+        self.assertIndexed()
+
+    def test_a_heartbeat_since_the_timer_started_keeps_the_seeder(self):
+        seeder_id = register(7001, "a.bin")
+        self.last_heard(**{seeder_id: Tracker.SEEDER_TIMEOUT + 5})
+        send("HEARTBEAT 127.0.0.1 7001")
+        Tracker.expire_inactive()
+        self.assertIn(seeder_id, Tracker.seeders)
+        self.assertEqual(len(Tracker.expiry_heap), 1)  # Timed again from the heartbeat
+
+
+class ResponseCacheTest(TrackerTest):
+    def assertInvalidatedBy(self, message):
+        lookup("a.bin")
+        self.assertIn("a.bin", Tracker.response_cache)
+        send(message)
+        self.assertNotIn("a.bin", Tracker.response_cache, message)
+
+    def test_a_repeated_lookup_is_answered_from_the_cache(self):
+        register(7001, "a.bin")
+        self.assertEqual(lookup("a.bin"), lookup("a.bin"))
+        self.assertEqual((Tracker.cache_stats["hits"], Tracker.cache_stats["misses"]), (1, 1))
+
+    def test_every_change_drops_the_cached_answers(self):
+        register(7001, "a.bin", version=1)
+        bitfield = "gA=="  # The first piece
+        for message in (f"REGISTER_FILES 127.0.0.1 7002 a.bin:{1 << 20}:{ROOT}",
+                        f"REGISTER_MORE 127.0.0.1 7002 b.bin:{1 << 20}:{ROOT},a.bin:{1 << 20}:{ROOT}",
+                        "REMOVE 127.0.0.1 7001 2 a.bin",
+                        f"ADD 127.0.0.1 7001 3 a.bin:{1 << 20}:{ROOT}",
+                        f"HAVE 10.0.0.1 6010 a.bin {Protocol.piece_size_for(1 << 20)} {bitfield}"):
+            self.assertInvalidatedBy(message)
+
+    def test_an_expired_seeder_drops_the_cached_answers(self):
+        seeder_id = register(7001, "a.bin")
+        lookup("a.bin")
+        Tracker.expiry_heap.clear()
+        Tracker.seeders[seeder_id].last_seen -= Tracker.SEEDER_TIMEOUT + 5
+        Tracker.schedule_expiry(Tracker.seeders[seeder_id], seeder_id)
+        Tracker.expire_inactive()
+        self.assertNotIn("a.bin", Tracker.response_cache)
+        self.assertTrue(lookup("a.bin").startswith("No Seeders"))
+
+
+class BatchTest(TrackerTest):
+    def test_a_bulk_announce_registers_every_batch(self):
+        files = [f"library/file{index}.bin" for index in range(200)]
+        prefix = "REGISTER_MORE 127.0.0.1 7001 "
+        batches = Protocol.batch_entries([f"{file_name}:{1 << 20}:{ROOT}" for file_name in files],
+                                         Protocol.BATCH_BYTES - len(prefix))
+        self.assertGreater(len(batches), 1)
+        seeder_id = send(f"REGISTER_FILES 127.0.0.1 7001 {','.join(batches[0])}").split()[1]
+        for batch in batches[1:]:
+            self.assertEqual(send(prefix + ",".join(batch)).split()[:2], ["REGISTERED", seeder_id])
+        self.assertEqual(set(Tracker.files_index), set(files))
+        self.assertIndexed()
+
+    def test_more_files_from_an_unknown_seeder_are_refused(self):
+        self.assertTrue(send(f"REGISTER_MORE 127.0.0.1 7001 a.bin:{1 << 20}:{ROOT}").startswith("ERROR"))
+
+    def test_a_multi_file_lookup_answers_every_file_asked(self):
+        files = [f"file{index}.bin" for index in range(50)]
+        register(7001, *files)
+        asked = files + ["missing.bin"]
+        reply = Tracker.handle_message(Protocol.pack_lookup_many(7, asked), ("127.0.0.1", 40000))
+        action, transaction, body = Protocol.unpack_header(reply)
+        self.assertEqual((action, transaction), (Protocol.PEERS_MANY, 7))
+        pages = Protocol.unpack_peers_many(body)
+        self.assertEqual(list(pages), asked)
+        self.assertIsNone(pages["missing.bin"])
+        self.assertEqual(pages["file0.bin"]["peers"], ["127.0.0.1,7001"])
+
+
+class DeltaTest(TrackerTest):
+    def setUp(self):
+        super().setUp()
+        self.seeder_id = register(7001, "a.bin", version=1)
+
+    def test_changes_in_order_are_applied(self):
+        self.assertEqual(send(f"ADD 127.0.0.1 7001 2 b.bin:{1 << 20}:{ROOT}"), f"UPDATED {self.seeder_id} version=2")
+        self.assertEqual(send("REMOVE 127.0.0.1 7001 3 a.bin"), f"UPDATED {self.seeder_id} version=3")
+        self.assertEqual(set(Tracker.files_index), {"b.bin"})
+        self.assertIndexed()
+
+    def test_a_change_already_applied_is_only_acknowledged(self):
+        send("REMOVE 127.0.0.1 7001 2 a.bin")
+        register(7002, "a.bin")
+        self.assertEqual(send("REMOVE 127.0.0.1 7001 2 a.bin"), f"UPDATED {self.seeder_id} version=2")
+        self.assertIn("a.bin", Tracker.files_index)
+
+    def test_a_gap_in_the_changes_asks_for_a_resync(self):
+        self.assertEqual(send(f"ADD 127.0.0.1 7001 3 b.bin:{1 << 20}:{ROOT}"), f"RESYNC {self.seeder_id}")
+        self.assertNotIn("b.bin", Tracker.files_index)
+        self.assertEqual(send(f"ADD 127.0.0.1 7999 1 b.bin:{1 << 20}:{ROOT}"), "RESYNC -")
+
+    def test_a_heartbeat_at_another_version_asks_for_a_resync(self):
+        self.assertEqual(send("HEARTBEAT 127.0.0.1 7001 5"), f"RESYNC {self.seeder_id}")
+        self.assertTrue(send("HEARTBEAT 127.0.0.1 7001 1").startswith("HEARTBEAT RECEIVED"))
+
+
+class RestoreTest(TrackerTest):
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()
+        self.saved_paths = Tracker.SNAPSHOT_PATH, Tracker.JOURNAL_PATH
+        Tracker.SNAPSHOT_PATH = os.path.join(self.folder.name, "tracker_state.snapshot")
+        Tracker.JOURNAL_PATH = os.path.join(self.folder.name, "tracker_state.journal")
+
+    def tearDown(self):
+        if Tracker.journal is not None:
+            Tracker.journal.close()
+            Tracker.journal = None
+        Tracker.SNAPSHOT_PATH, Tracker.JOURNAL_PATH = self.saved_paths
+        self.folder.cleanup()
+        super().tearDown()
+
+    def test_a_restore_rebuilds_the_state_without_journaling_it_again(self):
+        Tracker.restore()  # Starts from nothing and opens the journal
+        snapshotted = register(7001, "a.bin", "b.bin")
+        Tracker.write_snapshot()
+        journaled = register(7002, "b.bin", "c.bin")
+        Tracker.remove_seeder(snapshotted)
+        Tracker.write_journal(f"EXPIRE {snapshotted}")
+        expected = {seeder_id: {file_info.file_name for file_info in seeder_info.files.values()}
+                    for seeder_id, seeder_info in Tracker.seeders.items()}
+        with open(Tracker.JOURNAL_PATH, encoding="utf-8") as file:
+            written = file.read()
+
+        reset_tracker()
+        Tracker.restore()  # The journal from the first restore() is still open
+        restored = {seeder_id: {file_info.file_name for file_info in seeder_info.files.values()}
+                    for seeder_id, seeder_info in Tracker.seeders.items()}
+        self.assertEqual(restored, expected)
+        self.assertEqual(restored, {journaled: {"b.bin", "c.bin"}})
+        self.assertIndexed()
+        with open(Tracker.JOURNAL_PATH, encoding="utf-8") as file:
+            self.assertEqual(file.read(), written)
+
+
+if __name__ == "__main__":
+    unittest.main()